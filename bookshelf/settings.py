@@ -43,11 +43,13 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'hs.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'hs.middleware.MediaTokenMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -84,6 +86,32 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# CACHE_BACKEND is 'locmem' (per process) or 'file' (shared by the processes of one host).
+
+CACHE_BACKEND = config('CACHE_BACKEND', default='locmem')
+
+if CACHE_BACKEND == 'file':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': config('CACHE_LOCATION', default=str(BASE_DIR / 'cache')),
+            'TIMEOUT': 24 * 60 * 60,
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'bookshelf',
+            'TIMEOUT': 24 * 60 * 60,
+            'OPTIONS': {'MAX_ENTRIES': 1000},
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -184,6 +212,8 @@ THUMBNAIL_ALIASES = {
 }
 
 THUMBNAIL_BASEDIR = 'thumbnails'
+# Thumbnails keep the source extension, so their names do not depend on the image content.
+THUMBNAIL_PRESERVE_EXTENSIONS = True
 
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
@@ -192,5 +222,92 @@ REST_FRAMEWORK = {
     
 }
 
-
-
+# Records per database round trip and cover bytes per read in streamed hs responses.
+HS_STREAM_CHUNK_SIZE = 200
+HS_STREAM_COVER_CHUNK_SIZE = 3 * 64 * 1024
+
+# Thumbnail alias sent by the hs API for covers=thumb when no alias is given.
+HS_THUMB_DEFAULT_ALIAS = 'cover_inline'
+
+# Estimated counts of paginated listings stop at this many rows.
+PAGINATION_ESTIMATE_LIMIT = 1000
+
+# Default and maximum page size of paginated hs listings.
+HS_PAGE_SIZE = 100
+HS_PAGE_MAX_SIZE = 500
+
+# Rows per INSERT when hs/records/add/ writes records with bulk_create.
+HS_BULK_BATCH_SIZE = 500
+
+# Background work (import jobs, media cleanup) runs on a thread pool inside the
+# web process ('thread'), or waits in the database until `manage.py process_imports`
+# and `manage.py cleanup_media` pick it up ('queue').
+BACKGROUND_MODE = config('BACKGROUND_MODE', default='thread')
+BACKGROUND_WORKERS = config('BACKGROUND_WORKERS', default=2, cast=int)
+
+# A running import job that has not reported progress for this many seconds
+# is taken for lost with the process that ran it and is marked as failed.
+IMPORT_JOB_STALE_AFTER = config('IMPORT_JOB_STALE_AFTER', default=15 * 60, cast=int)
+
+# Rows per bulk INSERT of file imports, and how many bad lines an import reports.
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_ERRORS = 100
+
+# Records per database round trip in shelf and library exports.
+EXPORT_CHUNK_SIZE = 2000
+
+# Queued orphaned files removed per batch by the media cleanup.
+MEDIA_CLEANUP_BATCH_SIZE = 500
+
+# Search results per page, in main and hs.
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+# Cached shelf pages and hs payloads are keyed by Shelf.version, the timeout only frees memory.
+SHELF_CACHE_TIMEOUT = 24 * 60 * 60
+# hs payloads above this size (e.g. with inline covers) are not cached.
+SHELF_CACHE_MAX_SIZE = 1024 * 1024
+
+# Changelog entries per page of hs/changes/.
+SYNC_PAGE_SIZE = 500
+SYNC_MAX_PAGE_SIZE = 2000
+
+# Validated hs API tokens kept per process, and for how many seconds a revocation elsewhere may go unnoticed.
+API_TOKEN_CACHE_SIZE = 10000
+API_TOKEN_CACHE_TTL = 60
+
+# Compression of hs responses: smallest body worth it, level per encoding, types sent as they are
+# and input bytes between flushes of a streamed response.
+HS_COMPRESSION_MIN_SIZE = 1024
+HS_COMPRESSION_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+HS_COMPRESSION_SKIP_TYPES = ('image/', 'video/', 'application/zip', 'application/gzip', 'application/zstd')
+HS_COMPRESSION_FLUSH_SIZE = 64 * 1024
+
+# Processes rendering thumbnails of saved covers and userpics; 0 renders them in the saving thread.
+THUMBNAIL_WORKERS = config('THUMBNAIL_WORKERS', default=2, cast=int)
+
+# Uploaded covers and userpics: bounding box, format and quality they are stored with, and what is refused.
+IMAGE_MAX_SIZE = (800, 1200)
+IMAGE_FORMAT = 'WEBP'
+IMAGE_QUALITY = 80
+IMAGE_MAX_PIXELS = 50_000_000
+IMAGE_MAX_UPLOAD_SIZE = 20 * 2**20
+
+# Seconds a just stored or reused cover or userpic is kept even with no row referring to it,
+# for transactions that have not committed yet; `manage.py cleanup_media --sweep` removes it later,
+# and `cleanup_media --loop` sweeps every MEDIA_SWEEP_INTERVAL seconds.
+MEDIA_DEDUP_GRACE = 10 * 60
+MEDIA_SWEEP_INTERVAL = config('MEDIA_SWEEP_INTERVAL', default=60 * 60, cast=int)
+
+# Who sends media files once main.media has checked access: '' streams them from Django,
+# 'x-accel-redirect' hands them to nginx (an `internal` location at MEDIA_ACCEL_PREFIX aliased to MEDIA_ROOT),
+# 'x-sendfile' to Apache mod_xsendfile or lighttpd. Stored names never change content, hence the long max-age
+# of private files, kept by the browser alone. Public covers may be in shared caches, which go on serving
+# a cover whose shelf is made private for up to MEDIA_PUBLIC_MAX_AGE seconds.
+MEDIA_ACCEL = config('MEDIA_ACCEL', default='')
+MEDIA_ACCEL_PREFIX = config('MEDIA_ACCEL_PREFIX', default='/protected-media/')
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+MEDIA_PUBLIC_MAX_AGE = config('MEDIA_PUBLIC_MAX_AGE', default=60 * 60, cast=int)
+
+# Cover and userpic files the async hs views (hs/async/) read concurrently, in threads.
+HS_ASYNC_FILE_CONCURRENCY = 16
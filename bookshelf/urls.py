@@ -1,19 +1,20 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib.staticfiles.views import serve
 from django.views.decorators.cache import never_cache
 
+from main.views import media
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('main.urls')),
     path('hs/', include('hs.urls')),
+    path(settings.MEDIA_URL.lstrip('/') + '<path:name>', media, name='media'),
 ]
 
 if settings.DEBUG:
     urlpatterns.append(path('static/<path:path>', never_cache(serve)))
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
 handler404 = "main.views.page_not_found_view"
 handler403 = 'main.views.forbidden_view'
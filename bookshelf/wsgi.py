@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bookshelf.settings')
 
 application = get_wsgi_application()
+
+# Import jobs left pending or running by the previous server process.
+from main.jobs import recover_on_start
+
+recover_on_start()
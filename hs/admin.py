@@ -1,3 +1,8 @@
 from django.contrib import admin
+from .models import ApiToken
 
-# Register your models here.
+class ApiTokenAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'owner', 'created')
+    readonly_fields = ('digest',)
+
+admin.site.register(ApiToken, ApiTokenAdmin)
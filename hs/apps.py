@@ -1,7 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
 
 
 class HsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'hs'
     verbose_name = 'http-сервис'
+
+    def ready(self):
+        from .authentication import user_saved, user_deleted
+
+        post_save.connect(user_saved, sender=settings.AUTH_USER_MODEL)
+        post_delete.connect(user_deleted, sender=settings.AUTH_USER_MODEL)
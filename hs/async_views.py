@@ -0,0 +1,133 @@
+''' Async versions of the users, shelfs and shelf records endpoints, mounted under hs/async/.
+
+DRF 3.14 has no async views, so async_api_view does the part of
+APIView these endpoints need: token authentication, permissions,
+content negotiation and API errors. Queries go through Django's async
+ORM and image files are read in threads (hs.utilities.represent_images),
+so under ASGI one worker serves many clients at once. Writes are passed
+on to the sync views.
+'''
+
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from rest_framework.exceptions import APIException, NotFound, PermissionDenied, ValidationError
+from rest_framework.exceptions import NotAuthenticated, AuthenticationFailed
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, IsAuthenticatedOrReadOnly
+from rest_framework.request import Request
+
+from main.models import Shelf, BookUser, ShelfRecord
+from main.forms import RecordListForm
+from main.caching import shelf_cache_key, acached
+from . import views
+from .serializers import ShelfSerializer, UserSerializer, ShelfRecordSerializerGET
+from .utilities import images_context, is_paginated, paginated, represent_images, shelf_validators
+from .utilities import shelf_list_totals, representation_etag, not_modified, with_validators
+from .authentication import TokenAuthentication
+from .renderers import RENDERERS, PARSERS
+from bookshelf.settings import SHELF_CACHE_MAX_SIZE
+
+def async_api_view(permission_class, sync_view):
+    ''' Serves GET with the decorated coroutine, other methods with <sync_view> in a thread. '''
+
+    def decorator(handler):
+        @wraps(handler)
+        async def view(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return await sync_to_async(sync_view)(request, *args, **kwargs)
+
+            request = Request(request, parsers=[parser() for parser in PARSERS],
+                              authenticators=[TokenAuthentication()])
+            renderers = [renderer() for renderer in RENDERERS]
+            request.accepted_renderer, request.accepted_media_type = renderers[0], renderers[0].media_type
+            try:
+                # A token missing from the cache is looked up in the database.
+                await sync_to_async(getattr)(request, 'user')
+                request.accepted_renderer, request.accepted_media_type = \
+                    DefaultContentNegotiation().select_renderer(request, renderers)
+                if not permission_class().has_permission(request, None):
+                    if request.successful_authenticator is None:
+                        raise NotAuthenticated()
+                    raise PermissionDenied()
+                return await handler(request, *args, **kwargs)
+            except APIException as e:
+                return error_response(request, e)
+
+        return view
+    return decorator
+
+def error_response(request, exc):
+    detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+    response = HttpResponse(request.accepted_renderer.render(detail), status=exc.status_code,
+                            content_type=request.accepted_renderer.media_type)
+    if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+        response['WWW-Authenticate'] = TokenAuthentication().authenticate_header(request)
+    return response
+
+def rendered(request, data):
+    return HttpResponse(request.accepted_renderer.render(data), content_type=request.accepted_renderer.media_type)
+
+def deferred(context):
+    # Images are filled in afterwards by represent_images.
+    return dict(context, defer_cover=context['covers'] != 'none')
+
+@async_api_view(IsAdminUser, views.users_view)
+async def users_view(request):
+    context = images_context(request)
+    users = [user async for user in BookUser.objects.all()]
+    data = UserSerializer(users, many=True, context=deferred(context)).data
+    await represent_images(data, BookUser._meta.get_field('userpic'), context,
+                           display=lambda name: name.rpartition('/')[2])
+    return rendered(request, data)
+
+@async_api_view(IsAuthenticated, views.shelfs_view)
+async def shelfs_view(request):
+    totals = await Shelf.objects.filter(owner=request.user).aaggregate(**shelf_list_totals())
+    etag = representation_etag('shelfs', request.user.pk, request.accepted_renderer.format, *totals.values())
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    shelfs = [shelf async for shelf in Shelf.objects.filter(owner=request.user)]
+    return with_validators(rendered(request, ShelfSerializer(shelfs, many=True).data), etag)
+
+@async_api_view(IsAuthenticatedOrReadOnly, views.records_view)
+async def records_view(request, shelf_pk):
+    shelf = await Shelf.objects.filter(pk=shelf_pk).afirst()
+    if shelf is None:
+        raise NotFound(detail='Объект не найден')
+    if shelf.private and shelf.owner_id != request.user.pk:
+        raise PermissionDenied(detail='У Вас нет доступа к этой полке')
+
+    etag, last_modified = shelf_validators(request, shelf)
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+
+    form = RecordListForm(request.query_params)
+    if not form.is_valid():
+        raise ValidationError(detail=form.errors)
+    records, keys = form.apply(ShelfRecord.objects.filter(shelf=shelf))
+    context = images_context(request)
+    cover = ShelfRecord._meta.get_field('cover')
+
+    # <stream> is not honoured: Django 4.1 iterates a streamed response on the
+    # event loop, where the records cursor cannot run.
+    async def payload():
+        if is_paginated(request):
+            data = await sync_to_async(paginated)(request, records, ShelfRecordSerializerGET, deferred(context), keys)
+            await represent_images(data['results'], cover, context)
+        else:
+            page = [record async for record in records.order_by(*keys)]
+            data = ShelfRecordSerializerGET(page, many=True, context=deferred(context)).data
+            await represent_images(data, cover, context)
+        return request.accepted_renderer.render(data)
+
+    # The same key as the sync view: both serve the same bytes.
+    params = [*request.query_params.lists(), ('host', [request.get_host()]),
+              ('renderer', [request.accepted_renderer.format])]
+    key = shelf_cache_key('hs_records', shelf, shelf.owner_id == request.user.pk, params)
+    response = HttpResponse(await acached(key, payload, SHELF_CACHE_MAX_SIZE),
+                            content_type=request.accepted_renderer.media_type)
+    return with_validators(response, etag, last_modified)
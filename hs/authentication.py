@@ -0,0 +1,108 @@
+import copy, threading, time
+from collections import OrderedDict
+
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+from .models import ApiToken
+from bookshelf.settings import API_TOKEN_CACHE_SIZE, API_TOKEN_CACHE_TTL
+
+class TokenCache:
+    ''' LRU of validated token digests and their users, each trusted for <ttl> seconds.
+
+    The cache is per process: saving or deleting a user drops its entries here
+    (see user_saved), but a token revoked, or a user deactivated, in another
+    process stays valid here until its entry expires.
+    '''
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, digest):
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                return None
+            user, expires = entry
+            if expires < time.monotonic():
+                del self.entries[digest]
+                return None
+            self.entries.move_to_end(digest)
+            return user
+
+    def put(self, digest, user):
+        with self.lock:
+            self.entries[digest] = (user, time.monotonic() + self.ttl)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, digests):
+        with self.lock:
+            for digest in digests:
+                self.entries.pop(digest, None)
+
+    def discard_owner(self, user_id):
+        with self.lock:
+            for digest in [digest for digest, (user, _) in self.entries.items() if user.pk == user_id]:
+                del self.entries[digest]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+tokens = TokenCache(API_TOKEN_CACHE_SIZE, API_TOKEN_CACHE_TTL)
+
+class TokenAuthentication(BaseAuthentication):
+    ''' "Authorization: Token <key>". A cached token costs a sha256 and a dictionary lookup,
+    instead of the password hasher BasicAuthentication runs on every request.
+    '''
+    keyword = 'Token'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed('Invalid token header. Must be "Token <key>"')
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed('Invalid token header. Token must be ASCII')
+
+        digest = ApiToken.digest_of(key)
+        user = tokens.get(digest)
+        if user is not None:
+            # Every request gets its own instance, the cached one is shared by threads.
+            user = copy.copy(user)
+        else:
+            token = ApiToken.objects.select_related('owner').filter(digest=digest).first()
+            if token is None or not token.owner.is_active:
+                raise AuthenticationFailed('Invalid token')
+            user = token.owner
+            tokens.put(digest, copy.copy(user))
+        return user, digest
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+def revoke(api_tokens):
+    ''' Deletes a queryset of tokens and drops them from this process' cache. '''
+    digests = list(api_tokens.values_list('digest', flat=True))
+    api_tokens.delete()
+    tokens.discard(digests)
+    return len(digests)
+
+def user_saved(sender, instance, **kwargs):
+    ''' Drops the cached tokens of a saved user, so is_active and other changes apply to the next request.
+    A new password (set_password() before the save) revokes every token of the user.
+    '''
+    if instance._password is not None:
+        revoke(ApiToken.objects.filter(owner=instance))
+    tokens.discard_owner(instance.pk)
+
+def user_deleted(sender, instance, **kwargs):
+    tokens.discard_owner(instance.pk)
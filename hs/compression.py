@@ -0,0 +1,83 @@
+''' Content encodings for hs responses: gzip always, zstd and brotli when their packages are installed. '''
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class GzipCompressor:
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+class ZstdCompressor:
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+class BrotliCompressor:
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+# In order of preference when a client accepts several.
+ENCODINGS = {}
+if zstandard is not None:
+    ENCODINGS['zstd'] = ZstdCompressor
+if brotli is not None:
+    ENCODINGS['br'] = BrotliCompressor
+ENCODINGS['gzip'] = GzipCompressor
+
+def accepted_encoding(header):
+    ''' The preferred available encoding allowed by an Accept-Encoding header, or None. '''
+    accepted = {}
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = quality
+
+    for name in ENCODINGS:
+        if accepted.get(name, accepted.get('*', 0)) > 0:
+            return name
+    return None
+
+def compressed(content, encoding, level):
+    compressor = ENCODINGS[encoding](level)
+    return compressor.compress(content) + compressor.finish()
@@ -0,0 +1,253 @@
+import binascii
+from collections import namedtuple
+
+from django.core.files.base import ContentFile
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError, APIException
+
+from main.models import Shelf, ShelfRecord
+from main.utilities import record_fingerprint
+from main.tracking import RecordChanges, RecordState, record_state
+from main.thumbnails import schedule_thumbnails
+from main.images import normalized_image
+from bookshelf.settings import HS_BULK_BATCH_SIZE
+from .serializers import ShelfSerializer, ShelfRecordSerializerBulk
+from .utilities import cover_content
+
+# A checked cover as it was sent, base64 or raw bytes; decoded again by stage_covers.
+SentCover = namedtuple('SentCover', ['name', 'data'])
+
+def ingest(user, incoming_data, on_duplicate=ShelfRecord.DUPLICATES_SKIP, batch_size=HS_BULK_BATCH_SIZE, progress=None):
+    ''' Set-based import of shelfs and records sent to hs/records/add/.
+
+    Everything is validated before the first write, covers are stored
+    before the transaction opens, and records go in with bulk_create.
+    Records already on their shelf (same fingerprint) are skipped, updated
+    or added again, depending on <on_duplicate>.
+    Returns {'shelfs': {code: id}, 'records': {code: id}}.
+    <progress> is called with rows_parsed and rows_inserted counters.
+    '''
+
+    if on_duplicate not in dict(ShelfRecord.DUPLICATES_CHOICES):
+        raise ValidationError(detail=f'Unknown on_duplicate option {on_duplicate}')
+
+    new_shelfs, shelfs = validated_shelfs(user, incoming_data)
+    records = validated_records(incoming_data, shelfs, new_shelfs)
+    check_shelfs(user, {shelfs[record['shelf_code']] for record in records if record['shelf_code'] in shelfs})
+    if progress:
+        progress(rows_parsed=len(records))
+
+    if on_duplicate != ShelfRecord.DUPLICATES_ALLOW:
+        match_duplicates(records, shelfs, batch_size, on_duplicate == ShelfRecord.DUPLICATES_UPDATE)
+
+    inserted = [record for record in records if not (record['existing'] or record['duplicate_of'])]
+    if on_duplicate == ShelfRecord.DUPLICATES_UPDATE:
+        updated = [record for record in records if record['existing'] and not record['duplicate_of']]
+    else:
+        updated = []
+
+    changes = RecordChanges()
+    staged = stage_covers(inserted + updated)
+    replaced = [record['existing'][1] for record in updated if record['data'].get('cover') and record['existing'][1]]
+    try:
+        with transaction.atomic():
+            for code, serializer in new_shelfs.items():
+                shelfs[code] = serializer.save().id
+
+            for record in inserted:
+                record['instance'] = ShelfRecord(**record['data'])
+                record['instance'].shelf_id = shelfs[record['shelf_code']]
+                record['instance'].update_fingerprint()
+            ShelfRecord.objects.bulk_create([record['instance'] for record in inserted], batch_size=batch_size)
+            for record in inserted:
+                changes.added(record_state(record['instance']))
+
+            now = timezone.now()
+            for record in updated:
+                record['instance'] = ShelfRecord(pk=record['existing'][0], updated_at=now, **record['data'])
+                if not record['data'].get('cover'):
+                    record['instance'].cover = record['existing'][1]
+                record['instance'].shelf_id = shelfs[record['shelf_code']]
+                record['instance'].update_fingerprint()
+                old = RecordState(record['instance'].pk, record['instance'].shelf_id, record['existing'][2], 
+                                  record['instance'].read_date, record['existing'][3])
+                changes.updated(old, record_state(record['instance']))
+            ShelfRecord.objects.bulk_update([record['instance'] for record in updated], UPDATED_FIELDS, 
+                                            batch_size=batch_size)
+            changes.save()
+
+            transaction.on_commit(lambda: discard_covers(replaced))
+            schedule_thumbnails(staged)
+    except BaseException:
+        discard_covers(staged)
+        raise
+
+    if progress:
+        progress(rows_inserted=len(inserted))
+
+    ids = {}
+    for record in records:
+        if record.get('instance'):
+            ids[record['code']] = record['instance'].id
+        elif record['existing']:
+            ids[record['code']] = record['existing'][0]
+    for record in records:
+        if record['duplicate_of'] is not None:
+            ids[record['code']] = ids[record['duplicate_of']['code']]
+
+    result = {
+        'shelfs': shelfs,
+        'records': ids,
+    }
+    return result
+
+def match_duplicates(records, shelfs, batch_size, update=False):
+    ''' Marks records already stored on their shelf, or repeated within the upload.
+
+    A repeated record is written once, with <update> from its last occurrence.
+    '''
+
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        keys = [(shelfs[record['shelf_code']], record['fingerprint']) for record in batch if record['shelf_code'] in shelfs]
+        existing = ShelfRecord.fingerprinted(keys, fields=('id', 'cover', 'rating', 'author'))
+        for record in batch:
+            if record['shelf_code'] in shelfs:
+                record['existing'] = existing.get((shelfs[record['shelf_code']], record['fingerprint']))
+
+    seen = {}
+    for record in records:
+        first = seen.setdefault((record['shelf_code'], record['fingerprint']), record)
+        if first is not record:
+            record['duplicate_of'] = first
+            if update:
+                first['data'] = record['data']
+
+def validated_shelfs(user, incoming_data):
+
+    new_shelfs = {}
+    shelfs = {}
+
+    for shelf_data in incoming_data.get('shelfs', []):
+        code = shelf_data['code']
+        if not shelf_data['id']:
+            creation_data = {
+                'name': shelf_data['title'],
+                'private': shelf_data['private'],
+                'owner': user.pk
+            }
+            serializer = ShelfSerializer(data=creation_data)
+            if not serializer.is_valid():
+                detail = {'preamble': f'Problems with saving shelf with code {code}',}
+                detail.update(serializer.errors)
+                raise ValidationError(detail=detail)
+            new_shelfs[code] = serializer
+        else:
+            try:
+                shelfs[code] = int(shelf_data['id'])
+            except (TypeError, ValueError):
+                raise ValidationError(detail=f'Wrong id of shelf with code {code}')
+
+    return new_shelfs, shelfs
+
+def check_shelfs(user, shelf_ids):
+    ''' Resolves all referenced shelfs with a single query. '''
+
+    owners = dict(Shelf.objects.filter(pk__in=shelf_ids).values_list('pk', 'owner_id'))
+
+    for shelf_id in shelf_ids:
+        if shelf_id not in owners:
+            raise NotFound(detail=f'Shelf with id {shelf_id} is not found')
+        if owners[shelf_id] != user.pk:
+            raise PermissionDenied(detail='У Вас нет доступа к этой полке')
+
+def validated_records(incoming_data, shelfs, new_shelfs):
+
+    records = []
+
+    for record_data in incoming_data.get('records', []):
+
+        code = record_data['code']
+        shelf_code = record_data['shelf_code']
+
+        if shelf_code not in shelfs and shelf_code not in new_shelfs:
+            detail = f'Shelf with code {shelf_code} is not found'
+            raise APIException(detail=detail)
+
+        creation_data = {
+            'title': record_data['title'],
+            'author': record_data['author'],
+            'rating': record_data['rating'],
+            'comment': record_data['comment'],
+            'random_cover': record_data['random_cover'],
+            'read_date': record_data['read_date'],
+            'cover': None,
+        }
+
+        cover_data = record_data['cover']
+        if cover_data:
+            if not ('name' in cover_data and 'data' in cover_data):
+                detail = f'Wrong filedata-context in record {code}. Must contain both <name> and <data> fields'
+                raise ValidationError(detail=detail)
+
+            try:
+                binary_data = cover_content(cover_data['data'])
+            except (binascii.Error, TypeError):
+                raise ValidationError(detail=f'Cover data of record {code} is not valid base64')
+            creation_data['cover'] = ContentFile(binary_data, name=cover_data['name'])
+
+        serializer = ShelfRecordSerializerBulk(data=creation_data)
+        if not serializer.is_valid():
+            detail = {'preamble': f'Problems with saving record with code {code}',}
+            detail.update(serializer.errors)
+            raise ValidationError(detail=detail)
+
+        data = serializer.validated_data
+        if cover_data:
+            # The decoded copy is dropped once checked: covers are decoded again one at
+            # a time while staged, instead of all of them sitting next to the upload.
+            data['cover'] = SentCover(cover_data['name'], cover_data['data'])
+        records.append({
+            'code': code,
+            'shelf_code': shelf_code,
+            'data': data,
+            'fingerprint': record_fingerprint(data['title'], data['author'], data['read_date']),
+            'existing': None,
+            'duplicate_of': None,
+        })
+
+    return records
+
+def stage_covers(records):
+    ''' Decodes and writes covers to storage one by one ahead of the transaction, returns stored names. '''
+
+    field = ShelfRecord._meta.get_field('cover')
+    staged = []
+
+    try:
+        for record in records:
+            cover = record['data'].get('cover')
+            if cover:
+                cover = ContentFile(cover_content(cover.data), name=cover.name)
+                try:
+                    cover = normalized_image(cover, cover.name)
+                except DjangoValidationError as e:
+                    raise ValidationError(detail=f'Cover of record {record["code"]}: {e.messages[0]}')
+                name = field.generate_filename(None, cover.name)
+                name = field.storage.save(name, cover, max_length=field.max_length)
+                staged.append(name)
+                record['data']['cover'] = name
+    except BaseException:
+        discard_covers(staged)
+        raise
+
+    return staged
+
+def discard_covers(names):
+    storage = ShelfRecord._meta.get_field('cover').storage
+    for name in names:
+        storage.delete(name)
+
+UPDATED_FIELDS = ['title', 'author', 'comment', 'rating', 'read_date', 'random_cover', 'cover', 'fingerprint', 'updated_at']
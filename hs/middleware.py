@@ -0,0 +1,135 @@
+import asyncio, zlib
+from itertools import chain
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework.exceptions import AuthenticationFailed
+
+from .compression import accepted_encoding, compressed, ENCODINGS
+from .authentication import TokenAuthentication
+from bookshelf.settings import HS_COMPRESSION_MIN_SIZE, HS_COMPRESSION_LEVELS, HS_COMPRESSION_SKIP_TYPES
+from bookshelf.settings import HS_COMPRESSION_FLUSH_SIZE
+
+# A sample that deflate at level 1 cannot shrink by a tenth is taken for already compressed data,
+# e.g. a MessagePack shelf that is mostly raw JPEG covers.
+PROBE_SIZE = 64 * 1024
+PROBE_RATIO = 0.9
+
+class CompressionMiddleware:
+    ''' Compresses hs responses with the best encoding the client accepts.
+
+    Streaming responses are compressed chunk by chunk and flushed every
+    HS_COMPRESSION_FLUSH_SIZE bytes of input, so they stay incremental.
+    Images and payloads that do not compress are sent as they are.
+    '''
+
+    # Under ASGI a sync-only middleware would run every request, async views included, on one thread.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.process(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if response.streaming or len(response.content) > PROBE_SIZE:
+            # Large bodies are compressed, and streams probed, off the event loop.
+            return await asyncio.to_thread(self.process, request, response)
+        return self.process(request, response)
+
+    def process(self, request, response):
+        match = getattr(request, 'resolver_match', None)
+        if match is None or match.app_name != 'hs':
+            return response
+        if response.has_header('Content-Encoding') or request.method == 'HEAD':
+            return response
+        content_type = response.get('Content-Type', '').lower()
+        if content_type.startswith(HS_COMPRESSION_SKIP_TYPES):
+            return response
+
+        # The representation depends on Accept-Encoding even when it is sent uncompressed.
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = accepted_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        # The body may be sent compressed, a different byte sequence, so a strong ETag becomes
+        # weak. Small or incompressible bodies and 304s get the same one, every response to the
+        # request carries one validator.
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+
+        level = HS_COMPRESSION_LEVELS[encoding]
+        if response.streaming:
+            head, rest = probe(response.streaming_content)
+            if (rest is None and len(head) < HS_COMPRESSION_MIN_SIZE) or not compressible(head):
+                response.streaming_content = chain((head,), rest or ())
+                return response
+            response.streaming_content = compress_stream(chain((head,), rest or ()), encoding, level)
+            del response.headers['Content-Length']
+        else:
+            if len(response.content) < HS_COMPRESSION_MIN_SIZE or not compressible(response.content[:PROBE_SIZE]):
+                return response
+            content = compressed(response.content, encoding, level)
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response.headers['Content-Length'] = str(len(content))
+
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+def probe(chunks):
+    ''' Reads the first PROBE_SIZE bytes of a stream; returns them and the rest, None if the stream ended. '''
+    chunks = iter(chunks)
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= PROBE_SIZE:
+            return b''.join(head), chunks
+    return b''.join(head), None
+
+def compressible(sample):
+    return len(zlib.compress(sample, 1)) < len(sample) * PROBE_RATIO
+
+def compress_stream(chunks, encoding, level):
+    compressor = ENCODINGS[encoding](level)
+    pending = 0
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= HS_COMPRESSION_FLUSH_SIZE:
+            data += compressor.flush()
+            pending = 0
+        if data:
+            yield data
+    yield compressor.finish()
+
+class MediaTokenMiddleware(MiddlewareMixin):
+    ''' Lets hs clients fetch /media/ files (main.media) with their "Authorization: Token" header.
+
+    Only the media view is looked at, hs views authenticate through DRF.
+    A missing or invalid token leaves the request anonymous: public files are still served.
+    '''
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.resolver_match.url_name != 'media' or request.user.is_authenticated:
+            return None
+        try:
+            authenticated = TokenAuthentication().authenticate(request)
+        except AuthenticationFailed:
+            authenticated = None
+        if authenticated:
+            request.user = authenticated[0]
+        return None
@@ -1,3 +1,33 @@
+import hashlib, secrets
+
 from django.db import models
+from django.utils import timezone
+
+from main.models import BookUser
+
+class ApiToken(models.Model):
+    ''' Key for the hs API; only its sha256 is stored, the key itself is shown once. '''
+    owner = models.ForeignKey(BookUser, on_delete=models.CASCADE, related_name='api_tokens', verbose_name='Владелец')
+    digest = models.CharField(max_length=64, unique=True, verbose_name='Хэш ключа')
+    name = models.CharField(max_length=50, blank=True, verbose_name='Название')
+    created = models.DateTimeField(default=timezone.now, verbose_name='Создан')
+
+    class Meta:
+        ordering = ['-created']
+        verbose_name = 'Токен API'
+        verbose_name_plural = 'Токены API'
+
+    def __str__(self):
+        return self.name or 'Токен %s' % self.pk
+
+    @staticmethod
+    def digest_of(key):
+        # Keys are random, so a fast hash is enough; no salt or stretching needed.
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
 
-# Create your models here.
+    @classmethod
+    def issue(cls, owner, name=''):
+        ''' Creates a token and returns it with its key. '''
+        key = secrets.token_urlsafe(32)
+        token = cls.objects.create(owner=owner, digest=cls.digest_of(key), name=name)
+        return token, key
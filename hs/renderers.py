@@ -0,0 +1,84 @@
+''' Binary wire formats of the hs API. Covers travel in them as raw bytes, without base64.
+
+msgpack and cbor2 are optional: a format whose package is not installed
+is simply not offered, and JSON stays the default either way.
+'''
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser, FormParser, MultiPartParser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+json_encoder = DjangoJSONEncoder()
+
+def plain(value):
+    # Dates, decimals and the like go over the wire as their JSON strings.
+    return json_encoder.default(value)
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    raw_covers = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=plain)
+
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except Exception as e:
+            raise ParseError(detail=f'MessagePack parse error - {e}')
+
+class CBORRenderer(BaseRenderer):
+    media_type = 'application/cbor'
+    format = 'cbor'
+    charset = None
+    render_style = 'binary'
+    raw_covers = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return cbor2.dumps(data, default=lambda encoder, value: encoder.encode(plain(value)))
+
+    # An indefinite-length array can be written before its length is known.
+    def stream_start(self):
+        return b'\x9f'
+
+    def stream_end(self):
+        return b'\xff'
+
+class CBORParser(BaseParser):
+    media_type = 'application/cbor'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return cbor2.loads(stream.read())
+        except Exception as e:
+            raise ParseError(detail=f'CBOR parse error - {e}')
+
+RENDERERS = [JSONRenderer]
+PARSERS = [JSONParser, FormParser, MultiPartParser]
+if msgpack is not None:
+    RENDERERS.append(MessagePackRenderer)
+    PARSERS.append(MessagePackParser)
+if cbor2 is not None:
+    RENDERERS.append(CBORRenderer)
+    PARSERS.append(CBORParser)
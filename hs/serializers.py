@@ -1,10 +1,10 @@
 from rest_framework import serializers
-from main.models import Shelf, BookUser, ShelfRecord
-from bookshelf.settings import MEDIA_ROOT
-from base64 import b64encode
+from main.models import Shelf, BookUser, ShelfRecord, ImportJob
 from os.path import split
 import logging
 
+from .utilities import represented_image
+
 logger = logging.getLogger(__name__)
 
 class UserSerializer(serializers.ModelSerializer):
@@ -18,15 +18,9 @@ class UserSerializer(serializers.ModelSerializer):
     def get_userpic(self, user):
         userpic = user.userpic
         if userpic:
-            file_path = MEDIA_ROOT / userpic.name
-            with open(file_path, "rb") as image_file:
-                encoded_string = b64encode(image_file.read()).decode('ascii')
-                filename = split(userpic.name)[1]
-                data = {
-                    'name': filename,
-                    'data': encoded_string
-                }
-                return data
+            if self.context.get('defer_cover'):
+                return {'name': userpic.name}
+            return represented_image(userpic, split(userpic.name)[1], self.context)
         else:
             return None
 
@@ -36,6 +30,12 @@ class ShelfSerializer(serializers.ModelSerializer):
         model = Shelf
         fields = ('id', 'name', 'private', 'owner')
 
+class ShelfSerializerSync(serializers.ModelSerializer):
+
+    class Meta:
+        model = Shelf
+        fields = ('id', 'name', 'private', 'owner', 'updated_at')
+
 class ShelfRecordSerializerGET(serializers.ModelSerializer):
 
     cover = serializers.SerializerMethodField()
@@ -47,21 +47,37 @@ class ShelfRecordSerializerGET(serializers.ModelSerializer):
     def get_cover(self, record):
         cover = record.cover
         if cover:
-            file_path = MEDIA_ROOT / cover.name
-            with open(file_path, "rb") as image_file:
-                file_data = b64encode(image_file.read()).decode('ascii')
-            result = {
-                'name': cover.name,
-                'data': file_data,
-            }
-            return result
+            if self.context.get('defer_cover'):
+                return {'name': cover.name}
+            return represented_image(cover, cover.name, self.context)
         else:
             return None
-        
+
+class ShelfRecordSerializerSearch(ShelfRecordSerializerGET):
+
+    class Meta(ShelfRecordSerializerGET.Meta):
+        fields = ShelfRecordSerializerGET.Meta.fields + ('shelf',)
+
+class ShelfRecordSerializerSync(ShelfRecordSerializerGET):
+
+    class Meta(ShelfRecordSerializerGET.Meta):
+        fields = ShelfRecordSerializerGET.Meta.fields + ('shelf', 'updated_at')
+
 class ShelfRecordSerializerPOST(serializers.ModelSerializer):
 
     class Meta:
         model = ShelfRecord
         fields = '__all__'
 
-    
\ No newline at end of file
+class ShelfRecordSerializerBulk(serializers.ModelSerializer):
+
+    class Meta:
+        model = ShelfRecord
+        exclude = ('id', 'shelf')
+
+class ImportJobSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'kind', 'status', 'shelf', 'rows_parsed', 'rows_inserted', 'rows_failed', 
+                  'result', 'error', 'created', 'started', 'finished')
@@ -1,3 +1,960 @@
-from django.test import TestCase
+import datetime, gzip, hashlib, json, os, shutil, tempfile, time, zlib
+from base64 import b64encode, b64decode
+from io import BytesIO, StringIO
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from PIL import Image
+
+from main.models import BookUser, Shelf, ShelfRecord, Change
+from main.storage import content_storage
+from main.thumbnails import thumbnail_name
+from main.images import normalized_image
+from main.tracking import rebuild_shelf_stats
+from .ingest import ingest, validated_records, stage_covers, SentCover
+from .models import ApiToken
+from .authentication import TokenAuthentication, tokens
+from .renderers import msgpack, cbor2
+from .utilities import b64_file_chunks
+from .compression import accepted_encoding, brotli, zstandard, ENCODINGS
+from .middleware import CompressionMiddleware
+
+def image_data(color='red'):
+    content = BytesIO()
+    Image.new('RGB', (8, 8), color).save(content, 'PNG')
+    return b64encode(content.getvalue()).decode('ascii')
+
+def record_data(code, shelf_code, title, rating=3, cover=None):
+    return {'code': code, 'shelf_code': shelf_code, 'title': title, 'author': 'Author', 'rating': rating,
+            'comment': '', 'random_cover': 1, 'read_date': '2020-01-01', 'cover': cover}
+
+def shelf_data(code, shelf=None, title='New'):
+    return {'code': code, 'id': shelf and shelf.pk, 'title': title, 'private': True}
+
+class MediaTestMixin:
+    ''' Stores files in a temporary MEDIA_ROOT, without the grace period of main.storage. '''
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        for patcher in (mock.patch('main.storage.MEDIA_DEDUP_GRACE', 0),
+                        mock.patch('main.thumbnails.THUMBNAIL_WORKERS', 0)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+class IngestDuplicatesTest(MediaTestMixin, TestCase):
+    ''' hs/records/add/ skips, updates or adds again records already on their shelf or repeated in the upload. '''
+
+    def setUp(self):
+        super().setUp()
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.shelf = Shelf.objects.create(name='Shelf', owner=self.owner)
+        self.stored = ShelfRecord.objects.create(title='Stored', author='Author', rating=2,
+                                                 read_date=datetime.date(2020, 1, 1), shelf=self.shelf)
+
+    def upload(self, on_duplicate):
+        return ingest(self.owner, {
+            'shelfs': [shelf_data('s', self.shelf)],
+            'records': [record_data('a', 's', 'Stored', rating=5), record_data('b', 's', 'New', rating=3),
+                        record_data('c', 's', 'New', rating=4), record_data('d', 's', 'Stored', rating=1)],
+        }, on_duplicate)
+
+    def ratings(self):
+        self.shelf.refresh_from_db()
+        stats = (self.shelf.record_count, self.shelf.rating_sum, self.shelf.last_read_date)
+        rebuild_shelf_stats(Shelf.objects.filter(pk=self.shelf.pk))
+        self.shelf.refresh_from_db()
+        self.assertEqual((self.shelf.record_count, self.shelf.rating_sum, self.shelf.last_read_date), stats)
+        return sorted(self.shelf.shelfrecord_set.values_list('title', 'rating'))
+
+    def test_skip(self):
+        ids = self.upload(ShelfRecord.DUPLICATES_SKIP)['records']
+        new = ShelfRecord.objects.get(title='New')
+        self.assertEqual(ids, {'a': self.stored.pk, 'b': new.pk, 'c': new.pk, 'd': self.stored.pk})
+        self.assertEqual(self.ratings(), [('New', 3), ('Stored', 2)])
+
+    def test_update(self):
+        ids = self.upload(ShelfRecord.DUPLICATES_UPDATE)['records']
+        new = ShelfRecord.objects.get(title='New')
+        self.assertEqual(ids, {'a': self.stored.pk, 'b': new.pk, 'c': new.pk, 'd': self.stored.pk})
+        # A record repeated in the upload is written once, from its last occurrence.
+        self.assertEqual(self.ratings(), [('New', 4), ('Stored', 1)])
+
+    def test_duplicate(self):
+        ids = self.upload(ShelfRecord.DUPLICATES_ALLOW)['records']
+        self.assertEqual(len(set(ids.values()) | {self.stored.pk}), 5)
+        self.assertEqual(self.ratings(), [('New', 3), ('New', 4), ('Stored', 1), ('Stored', 2), ('Stored', 5)])
+
+    def test_update_replaces_the_cover(self):
+        ingest(self.owner, {'shelfs': [shelf_data('s', self.shelf)],
+                            'records': [record_data('a', 's', 'Stored', cover={'name': 'a.png', 'data': image_data()})]},
+               ShelfRecord.DUPLICATES_UPDATE)
+        self.stored.refresh_from_db()
+        old = self.stored.cover.name
+        self.assertTrue(content_storage.exists(old))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ingest(self.owner, {'shelfs': [shelf_data('s', self.shelf)],
+                                'records': [record_data('a', 's', 'Stored',
+                                                        cover={'name': 'b.png', 'data': image_data('blue')})]},
+                   ShelfRecord.DUPLICATES_UPDATE)
+        self.stored.refresh_from_db()
+        self.assertNotEqual(self.stored.cover.name, old)
+        self.assertFalse(content_storage.exists(old))
+
+    def test_failed_import_discards_its_covers(self):
+        data = {'shelfs': [shelf_data('n')],
+                'records': [record_data('a', 'n', 'Covered', cover={'name': 'a.png', 'data': image_data()})]}
+        saved = []
+        save = content_storage.save
+
+        def recording_save(*args, **kwargs):
+            saved.append(save(*args, **kwargs))
+            return saved[-1]
+
+        with mock.patch.object(content_storage, 'save', recording_save), \
+                mock.patch.object(ShelfRecord.objects, 'bulk_create', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                ingest(self.owner, data)
+
+        self.assertEqual(len(saved), 1)
+        self.assertFalse(content_storage.exists(saved[0]))
+        self.assertFalse(Shelf.objects.filter(name='New').exists())
+
+class IngestCoversTest(MediaTestMixin, TestCase):
+    ''' Covers sent to hs/records/add/ are normalized; one bad cover rejects the upload and its stored covers. '''
+
+    def setUp(self):
+        super().setUp()
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.key = ApiToken.issue(self.owner)[1]
+
+    def test_cover_is_normalized(self):
+        ids = ingest(self.owner, {'shelfs': [shelf_data('n')],
+                                  'records': [record_data('a', 'n', 'Covered', cover={'name': 'a.png', 'data': image_data()})]})
+        cover = ShelfRecord.objects.get(pk=ids['records']['a']).cover.name
+        self.assertTrue(cover.startswith('covers/') and cover.endswith('.webp'))
+
+    def test_covers_are_decoded_one_at_a_time(self):
+        sent = [{'name': '%s.png' % code, 'data': image_data(color)} for code, color in (('a', 'red'), ('b', 'blue'))]
+        data = {'shelfs': [shelf_data('n')],
+                'records': [record_data(cover['name'][0], 'n', 'Covered', cover=cover) for cover in sent]}
+        records = validated_records(data, {}, {'n': None})
+        # Checked but not kept decoded: the records point at the data as it was sent.
+        for record, cover in zip(records, sent):
+            self.assertEqual(record['data']['cover'], SentCover(cover['name'], cover['data']))
+            self.assertIs(record['data']['cover'].data, cover['data'])
+
+        decoded = []
+        def normalized(cover, name):
+            decoded.append(cover)
+            # The previous cover is stored by now.
+            stored = [name for _, _, files in os.walk(content_storage.path('covers')) for name in files]
+            self.assertEqual(len(stored), len(decoded) - 1)
+            return normalized_image(cover, name)
+
+        with mock.patch('hs.ingest.normalized_image', normalized):
+            staged = stage_covers(records)
+        self.assertEqual(len(staged), 2)
+        self.assertEqual([record['data']['cover'] for record in records], staged)
+
+    def test_bad_cover_rejects_the_upload(self):
+        # A truncated JPEG passes the serializer, its pixels cannot be decoded.
+        content = BytesIO()
+        Image.effect_noise((64, 64), 50).convert('RGB').save(content, 'JPEG')
+        broken = b64encode(content.getvalue()[:content.tell() // 2]).decode('ascii')
+        data = {'shelfs': [shelf_data('n')],
+                'records': [record_data('a', 'n', 'Good', cover={'name': 'a.png', 'data': image_data()}),
+                            record_data('b', 'n', 'Bad', cover={'name': 'b.png', 'data': broken})]}
+        response = self.client.post('/hs/records/add/', data, content_type='application/json',
+                                    HTTP_AUTHORIZATION='Token ' + self.key)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), ['Cover of record b: Не удалось обработать изображение'])
+        self.assertFalse(ShelfRecord.objects.exists())
+        # The good cover, already stored, is removed again.
+        self.assertEqual([files for _, _, files in os.walk(content_storage.path('covers')) if files], [])
+
+class IngestTest(TestCase):
+    ''' hs/records/add/ puts every record on its shelf with a fixed number of queries per batch. '''
+
+    def setUp(self):
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.shelf = Shelf.objects.create(name='Shelf', owner=self.owner)
+        self.key = ApiToken.issue(self.owner)[1]
+
+    def test_codes_map_to_stored_ids(self):
+        result = ingest(self.owner, {
+            'shelfs': [shelf_data('old', self.shelf), shelf_data('new')],
+            'records': [record_data('a', 'old', 'First'), record_data('b', 'new', 'Second'),
+                        record_data('c', 'new', 'Third')],
+        })
+        new = Shelf.objects.get(name='New')
+        self.assertEqual(result['shelfs'], {'old': self.shelf.pk, 'new': new.pk})
+        self.assertEqual(new.owner, self.owner)
+        placed = dict(ShelfRecord.objects.values_list('id', 'shelf_id'))
+        self.assertEqual({code: placed[pk] for code, pk in result['records'].items()},
+                         {'a': self.shelf.pk, 'b': new.pk, 'c': new.pk})
+        self.assertEqual(ShelfRecord.objects.get(pk=result['records']['c']).title, 'Third')
+
+    def queries(self, count, batch_size):
+        data = {'shelfs': [shelf_data('s', self.shelf)],
+                'records': [record_data('%d-%d' % (count, i), 's', 'Book %d-%d' % (count, i)) for i in range(count)]}
+        with CaptureQueriesContext(connection) as context:
+            ingest(self.owner, data, batch_size=batch_size)
+        return len(context)
+
+    def test_queries_per_batch(self):
+        # A fingerprint lookup and an INSERT per batch, everything else once per upload.
+        one, two, three = self.queries(4, 4), self.queries(8, 4), self.queries(12, 4)
+        self.assertEqual(two - one, 2)
+        self.assertEqual(three - two, 2)
+
+    def post(self, data):
+        return self.client.post('/hs/records/add/', data, content_type='application/json',
+                                HTTP_AUTHORIZATION='Token ' + self.key)
+
+    def test_unknown_and_foreign_shelfs(self):
+        other = BookUser.objects.create_user('guest', 'guest@example.com', 'password')
+        foreign = Shelf.objects.create(name='Foreign', owner=other)
+        missing = Shelf(pk=foreign.pk + 100)
+
+        for shelf, status in ((missing, 404), (foreign, 403)):
+            with self.subTest(status=status):
+                response = self.post({'shelfs': [shelf_data('s', shelf)], 'records': [record_data('a', 's', 'Book')]})
+                self.assertEqual(response.status_code, status)
+        self.assertFalse(ShelfRecord.objects.exists())
+
+        response = self.post({'shelfs': [shelf_data('s', self.shelf)], 'records': [record_data('a', 's', 'Book')]})
+        self.assertEqual(response.status_code, 201)
+
+class ShelfValidatorsTest(TestCase):
+    ''' Shelf record lists are cached per Shelf.version and answer conditional requests with 304. '''
+
+    def setUp(self):
+        cache.clear()
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.shelf = Shelf.objects.create(name='Shelf', owner=self.owner, private=False)
+        self.record = ShelfRecord.objects.create(title='Before', author='Author', read_date=datetime.date(2020, 1, 1),
+                                                 shelf=self.shelf)
+        self.key = ApiToken.issue(self.owner)[1]
+
+    def get(self, path, **headers):
+        return self.client.get(path, {'covers': 'none'}, **headers)
+
+    def test_write_changes_payload_and_etag(self):
+        for path in ('/hs/shelf/%d/' % self.shelf.pk, '/hs/async/shelf/%d/' % self.shelf.pk):
+            with self.subTest(path=path):
+                cache.clear()
+                self.record.title = 'Before'
+                self.record.save()
+                response = self.get(path)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(b'Before', response.content)
+                etag = response['ETag']
+
+                # Not a tracked write: the shelf version stays and the cached payload is served.
+                ShelfRecord.objects.filter(pk=self.record.pk).update(title='Untracked')
+                self.assertIn(b'Before', self.get(path).content)
+                self.assertEqual(self.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+                version = Shelf.objects.get(pk=self.shelf.pk).version
+                self.record.title = 'After'
+                self.record.save()
+                self.assertEqual(Shelf.objects.get(pk=self.shelf.pk).version, version + 1)
+
+                response = self.get(path, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(b'After', response.content)
+                self.assertNotEqual(response['ETag'], etag)
+
+    def test_not_modified(self):
+        for path in ('/hs/shelf/%d/' % self.shelf.pk, '/hs/async/shelf/%d/' % self.shelf.pk):
+            with self.subTest(path=path):
+                response = self.get(path)
+                self.assertIn('Accept', response['Vary'].split(', '))
+                self.assertEqual(self.get(path, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+                self.assertEqual(self.get(path, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+                self.assertEqual(self.get(path, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+                if msgpack is not None:
+                    # Another format of the same shelf has an ETag of its own.
+                    other = self.get(path, HTTP_ACCEPT='application/msgpack')
+                    self.assertEqual(other.status_code, 200)
+                    self.assertNotEqual(other['ETag'], response['ETag'])
+
+    def test_shelf_list(self):
+        for path in ('/hs/shelfs/', '/hs/async/shelfs/'):
+            with self.subTest(path=path):
+                headers = {'HTTP_AUTHORIZATION': 'Token ' + self.key}
+                etag = self.client.get(path, **headers)['ETag']
+                self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag, **headers).status_code, 304)
+
+                self.shelf.name = 'Renamed %s' % path[4]
+                self.shelf.save()
+                response = self.client.get(path, HTTP_IF_NONE_MATCH=etag, **headers)
+                self.assertEqual(response.status_code, 200)
+                etag = response['ETag']
+
+                Shelf.objects.create(name='Another', owner=self.owner).delete()
+                self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag, **headers).status_code, 304)
+                self.shelf.delete()
+                self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag, **headers).status_code, 200)
+                self.shelf = Shelf.objects.create(name='Shelf', owner=self.owner, private=False)
+
+class ChangesFeedTest(TestCase):
+    ''' hs/changes/ brings a client copy of the library up to date from any token, also after compaction. '''
+
+    def setUp(self):
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.key = ApiToken.issue(self.owner)[1]
+        self.first = Shelf.objects.create(name='First', owner=self.owner)
+        self.second = Shelf.objects.create(name='Second', owner=self.owner)
+
+    def record(self, title, shelf=None):
+        return ShelfRecord.objects.create(title=title, author='Author', read_date=datetime.date(2020, 1, 1),
+                                          shelf=shelf or self.first)
+
+    def page(self, token=0, limit=500):
+        response = self.client.get('/hs/changes/', {'token': token, 'limit': limit, 'covers': 'none'},
+                                   HTTP_AUTHORIZATION='Token ' + self.key)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def token(self):
+        return self.page()['token']
+
+    def sync(self, copy, token=0, limit=2):
+        ''' Applies pages to <copy> the way a client does; returns the last token. '''
+        while True:
+            page = self.page(token, limit)
+            for shelf in page['shelfs']['updated']:
+                copy['shelfs'][shelf['id']] = shelf['name']
+            for record in page['records']['updated']:
+                copy['records'][record['id']] = (record['title'], record['shelf'])
+            for record_id in page['records']['deleted']:
+                copy['records'].pop(record_id, None)
+            for shelf_id in page['shelfs']['deleted']:
+                copy['shelfs'].pop(shelf_id, None)
+                copy['records'] = {pk: value for pk, value in copy['records'].items() if value[1] != shelf_id}
+            token = page['token']
+            if not page['has_more']:
+                return token
+
+    def library(self):
+        return {
+            'shelfs': dict(Shelf.objects.filter(owner=self.owner).values_list('id', 'name')),
+            'records': {pk: (title, shelf) for pk, title, shelf in
+                        ShelfRecord.objects.filter(shelf__owner=self.owner).values_list('id', 'title', 'shelf')},
+        }
+
+    def test_bulk_deletes_are_logged(self):
+        records = [self.record('Book %d' % number, shelf) for number, shelf in
+                   enumerate((self.first, self.first, self.second, self.second))]
+        copy = {'shelfs': {}, 'records': {}}
+        token = self.sync(copy)
+
+        ShelfRecord.objects.filter(pk__in=[records[0].pk, records[2].pk]).delete()
+        page = self.page(token)
+        self.assertEqual(sorted(page['records']['deleted']), [records[0].pk, records[2].pk])
+        token = self.sync(copy, token)
+        self.assertEqual(copy, self.library())
+
+        # The admin's "delete selected" on shelfs.
+        admin = BookUser.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin)
+        response = self.client.post('/admin/main/shelf/', {
+            'action': 'delete_selected', 'post': 'yes', '_selected_action': [self.second.pk]})
+        self.assertEqual(response.status_code, 302)
+        self.client.logout()
+        self.assertEqual(self.page(token)['shelfs']['deleted'], [self.second.pk])
+        self.sync(copy, token)
+        self.assertEqual(copy, self.library())
+
+    def test_latest_entry_wins(self):
+        token = self.token()
+        kept, dropped = self.record('Kept'), self.record('Dropped')
+        kept.title = 'Kept, renamed'
+        kept.save()
+        dropped_pk = dropped.pk
+        dropped.delete()
+
+        page = self.page(token)
+        self.assertEqual([(record['id'], record['title']) for record in page['records']['updated']],
+                         [(kept.pk, 'Kept, renamed')])
+        self.assertEqual(page['records']['deleted'], [dropped_pk])
+        self.assertEqual(page['shelfs'], {'updated': [], 'deleted': []})
+        self.assertFalse(page['has_more'])
+        self.assertEqual(self.page(page['token'])['token'], page['token'])
+
+    def test_deleted_shelf_is_one_tombstone(self):
+        self.record('One')
+        self.record('Two')
+        token = self.token()
+        first = self.first.pk
+        self.first.delete()
+
+        page = self.page(token)
+        self.assertEqual(page['shelfs'], {'updated': [], 'deleted': [first]})
+        self.assertEqual(page['records'], {'updated': [], 'deleted': []})
+
+    def test_moved_record(self):
+        record = self.record('Moved')
+        token = self.token()
+        record.shelf = self.second
+        record.save()
+
+        page = self.page(token)
+        self.assertEqual([(item['id'], item['shelf']) for item in page['records']['updated']],
+                         [(record.pk, self.second.pk)])
+        self.assertEqual(page['records']['deleted'], [])
+
+        # The shelf the record moved to is gone as well: the record has no tombstone of its own.
+        second = self.second.pk
+        self.second.delete()
+        page = self.page(token)
+        self.assertEqual(page['records'], {'updated': [], 'deleted': [record.pk]})
+        self.assertEqual(page['shelfs']['deleted'], [second])
+
+    def test_moved_record_across_pages(self):
+        record = self.record('Moved')
+        copy = {'shelfs': {}, 'records': {}}
+        token = self.sync(copy)
+        record.shelf = self.second
+        record.save()
+        self.second.delete()
+
+        for limit in (1, 2, 10):
+            with self.subTest(limit=limit):
+                stale = {'shelfs': dict(copy['shelfs']), 'records': dict(copy['records'])}
+                self.sync(stale, token, limit)
+                self.assertEqual(stale, self.library())
+
+    def edit(self, records):
+        records[0].title = 'Renamed'
+        records[0].save()
+        records[1].shelf = self.second
+        records[1].save()
+        records[2].delete()
+        self.second.name = 'Second, renamed'
+        self.second.save()
+        third = Shelf.objects.create(name='Third', owner=self.owner)
+        self.record('On third', third)
+        records[3].shelf = third
+        records[3].save()
+        third.delete()
+
+    def test_paging_survives_compaction(self):
+        records = [self.record('Book %d' % i, self.first if i % 2 else self.second) for i in range(6)]
+        before = {'shelfs': {}, 'records': {}}
+        middle = self.sync(before)
+        self.edit(records)
+        self.record('Added')
+        old = {'shelfs': dict(before['shelfs']), 'records': dict(before['records'])}
+        self.sync(before, middle)
+        self.assertEqual(before, self.library())
+
+        entries = Change.objects.count()
+        call_command('compact_changes', stdout=StringIO())
+        self.assertLess(Change.objects.count(), entries)
+
+        for limit in (1, 2, 3, 500):
+            with self.subTest(limit=limit):
+                copy = {'shelfs': {}, 'records': {}}
+                self.sync(copy, 0, limit)
+                self.assertEqual(copy, self.library())
+
+                # A token handed out before the compaction still brings an older copy up to date.
+                copy = {'shelfs': dict(old['shelfs']), 'records': dict(old['records'])}
+                self.sync(copy, middle, limit)
+                self.assertEqual(copy, self.library())
+
+class TokenAuthenticationTest(TestCase):
+    ''' Tokens are issued for a login and password, and stop working when revoked, expired or their user changes. '''
+
+    def setUp(self):
+        tokens.clear()
+        self.addCleanup(tokens.clear)
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+
+    def basic(self, password='password'):
+        return 'Basic ' + b64encode(('reader:' + password).encode()).decode('ascii')
+
+    def issue(self):
+        response = self.client.post('/hs/token/', HTTP_AUTHORIZATION=self.basic())
+        self.assertEqual(response.status_code, 201)
+        return response.json()['token']
+
+    def status(self, key):
+        return self.client.get('/hs/shelfs/', HTTP_AUTHORIZATION='Token ' + key).status_code
+
+    def test_issue_needs_login_and_password(self):
+        key = self.issue()
+        self.assertEqual(self.status(key), 200)
+        self.assertEqual(self.client.post('/hs/token/', HTTP_AUTHORIZATION='Token ' + key).status_code, 403)
+        self.assertEqual(self.client.post('/hs/token/', HTTP_AUTHORIZATION=self.basic('wrong')).status_code, 401)
+        self.assertEqual(self.client.post('/hs/token/').status_code, 401)
+        # Basic credentials open only the token endpoint.
+        self.assertEqual(self.client.get('/hs/shelfs/', HTTP_AUTHORIZATION=self.basic()).status_code, 401)
+
+    def test_bad_token(self):
+        self.assertEqual(self.status('unknown'), 401)
+        response = self.client.get('/hs/shelfs/', HTTP_AUTHORIZATION='Token two parts')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Token')
+
+    def test_revoke_one(self):
+        first, second = self.issue(), self.issue()
+        self.assertEqual(self.status(first), 200)
+        response = self.client.delete('/hs/token/', HTTP_AUTHORIZATION='Token ' + first)
+        self.assertEqual(response.json(), {'revoked': 1})
+        self.assertEqual(self.status(first), 401)
+        self.assertEqual(self.status(second), 200)
+
+    def test_revoke_all(self):
+        first, second = self.issue(), self.issue()
+        self.assertEqual((self.status(first), self.status(second)), (200, 200))
+        response = self.client.delete('/hs/token/', HTTP_AUTHORIZATION=self.basic())
+        self.assertEqual(response.json(), {'revoked': 2})
+        self.assertEqual((self.status(first), self.status(second)), (401, 401))
+
+    def test_cached_token_expires(self):
+        key = self.issue()
+        self.assertEqual(self.status(key), 200)
+        # Deleted behind the cache, as by another process: trusted until the entry expires.
+        ApiToken.objects.all().delete()
+        self.assertEqual(self.status(key), 200)
+        later = time.monotonic() + tokens.ttl + 1
+        with mock.patch('hs.authentication.time.monotonic', return_value=later):
+            self.assertEqual(self.status(key), 401)
+
+    def test_user_changes_apply_at_once(self):
+        key = self.issue()
+        self.assertEqual(self.status(key), 200)
+        self.owner.is_active = False
+        self.owner.save()
+        self.assertEqual(self.status(key), 401)
+
+        self.owner.is_active = True
+        self.owner.save()
+        self.assertEqual(self.status(key), 200)
+        self.owner.set_password('changed')
+        self.owner.save()
+        self.assertEqual(self.status(key), 401)
+        self.assertFalse(ApiToken.objects.exists())
+
+    def test_requests_get_their_own_user(self):
+        key = ApiToken.issue(self.owner)[1]
+        request = mock.Mock(META={'HTTP_AUTHORIZATION': 'Token ' + key})
+        first, second = TokenAuthentication().authenticate(request)[0], TokenAuthentication().authenticate(request)[0]
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+
+class AsyncViewsTest(MediaTestMixin, TestCase):
+    ''' hs/async/ views answer with the same bytes, status codes and validators as the sync views. '''
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        tokens.clear()
+        self.addCleanup(tokens.clear)
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.other = BookUser.objects.create_user('other', 'other@example.com', 'password')
+        self.staff = BookUser.objects.create_user('staff', 'staff@example.com', 'password', is_staff=True)
+        self.shelf = Shelf.objects.create(name='Shelf', owner=self.owner)
+        ingest(self.owner, {'shelfs': [shelf_data('s', self.shelf)],
+                            'records': [record_data('a', 's', 'First', cover={'name': 'a.png', 'data': image_data()}),
+                                        record_data('b', 's', 'Second'),
+                                        record_data('c', 's', 'Third', cover={'name': 'c.png', 'data': image_data('blue')})]})
+        self.keys = {user.username: ApiToken.issue(user)[1] for user in (self.owner, self.other, self.staff)}
+
+    def responses(self, path, params=None, user='reader', **headers):
+        ''' The sync and the async response to one request, each computed with an empty cache. '''
+        if user:
+            headers['HTTP_AUTHORIZATION'] = 'Token ' + self.keys.get(user, user)
+        cache.clear()
+        sync = self.client.get('/hs/' + path, params or {}, **headers)
+        cache.clear()
+        asgi_headers = {name[len('HTTP_'):].lower(): value for name, value in headers.items()}
+        response = async_to_sync(self.async_client.get)('/hs/async/' + path, params or {}, **asgi_headers)
+        return sync, response
+
+    def assertSame(self, path, params=None, status=200, **headers):
+        sync, response = self.responses(path, params, **headers)
+        self.assertEqual(sync.status_code, status)
+        self.assertEqual(response.status_code, status)
+        self.assertEqual(response.content, sync.content)
+        for header in ('Content-Type', 'ETag', 'Last-Modified', 'WWW-Authenticate'):
+            self.assertEqual(response.get(header), sync.get(header), header)
+        return response
+
+    def test_same_responses(self):
+        records = 'shelf/%d/' % self.shelf.pk
+        for covers in ('none', 'url', 'inline', 'thumb'):
+            with self.subTest(covers=covers):
+                self.assertSame(records, {'covers': covers})
+                self.assertSame('users/', {'covers': covers}, user='staff')
+        self.assertSame('shelfs/')
+        self.assertSame(records, {'covers': 'url', 'limit': 2})
+        self.assertSame(records, {'covers': 'none', 'sort': 'rating', 'limit': 1})
+        self.assertSame(records, {'covers': 'none', 'sort': 'popularity'}, status=400)
+        if msgpack is not None:
+            self.assertSame(records, {'covers': 'inline'}, HTTP_ACCEPT='application/msgpack')
+
+    def test_same_errors(self):
+        records = 'shelf/%d/' % self.shelf.pk
+        self.assertSame(records, {'covers': 'pictures'}, status=400)
+        self.assertSame(records, {'cursor': 'broken'}, status=400)
+        self.assertSame(records, status=403, user='other')
+        self.assertSame('shelf/%d/' % (self.shelf.pk + 100), status=404)
+        self.assertSame('users/', status=403)
+        self.assertSame('shelfs/', status=401, user=None)
+        self.assertSame('shelfs/', status=401, user='unknown')
+        self.assertSame(records, status=401, user='unknown')
+
+    def test_not_modified(self):
+        for path in ('shelfs/', 'shelf/%d/' % self.shelf.pk):
+            with self.subTest(path=path):
+                etag = self.assertSame(path, {'covers': 'none'})['ETag']
+                self.assertSame(path, {'covers': 'none'}, status=304, HTTP_IF_NONE_MATCH=etag)
+                self.assertSame(path, {'covers': 'none'}, HTTP_IF_NONE_MATCH='"stale"')
+
+    def test_stream_is_a_regular_response(self):
+        sync, response = self.responses('shelf/%d/' % self.shelf.pk, {'covers': 'inline', 'stream': 1})
+        self.assertTrue(sync.streaming)
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.json(), json.loads(b''.join(sync.streaming_content)))
+        self.assertEqual(response['ETag'], sync['ETag'])
+        self.assertEqual([record['title'] for record in response.json()], ['Third', 'Second', 'First'])
+
+class CompressionTest(TestCase):
+    ''' hs responses are compressed with the best accepted encoding, streams chunk by chunk, with one weak ETag. '''
+
+    def setUp(self):
+        cache.clear()
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.shelf = Shelf.objects.create(name='Shelf', owner=self.owner, private=False)
+        ShelfRecord.objects.bulk_create([ShelfRecord(title='Book %d' % number, author='Author', shelf=self.shelf,
+                                                     read_date=datetime.date(2020, 1, 1)) for number in range(50)])
+        self.path = '/hs/shelf/%d/' % self.shelf.pk
+
+    def middleware(self, response, encoding='gzip'):
+        request = RequestFactory().get('/hs/shelfs/', HTTP_ACCEPT_ENCODING=encoding)
+        request.resolver_match = resolve('/hs/shelfs/')
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def test_negotiation(self):
+        self.assertEqual(accepted_encoding('gzip'), 'gzip')
+        self.assertEqual(accepted_encoding('gzip, deflate, br'), 'br' if 'br' in ENCODINGS else 'gzip')
+        self.assertEqual(accepted_encoding('*'), next(iter(ENCODINGS)))
+        self.assertEqual(accepted_encoding('br;q=0, zstd;q=0, gzip;q=0.5'), 'gzip')
+        self.assertEqual(accepted_encoding('*, gzip;q=0, br;q=0, zstd;q=0'), None)
+        self.assertEqual(accepted_encoding('gzip;q=0'), None)
+        self.assertEqual(accepted_encoding('gzip;q=high'), None)
+        self.assertEqual(accepted_encoding('identity'), None)
+        self.assertEqual(accepted_encoding(''), None)
+
+    def test_compressed_response(self):
+        plain = self.client.get(self.path, {'covers': 'none'})
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertIn('Accept-Encoding', plain['Vary'])
+        self.assertGreater(len(plain.content), 1024)
+
+        for encoding, decompress in (('gzip', gzip.decompress), ('br', brotli and brotli.decompress),
+                                     ('zstd', zstandard and (lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data)))):
+            if encoding not in ENCODINGS:
+                continue
+            with self.subTest(encoding=encoding):
+                response = self.client.get(self.path, {'covers': 'none'}, HTTP_ACCEPT_ENCODING=encoding)
+                self.assertEqual(response['Content-Encoding'], encoding)
+                self.assertIn('Accept-Encoding', response['Vary'])
+                self.assertEqual(decompress(response.content), plain.content)
+                self.assertEqual(response['Content-Length'], str(len(response.content)))
+                self.assertEqual(response['ETag'], 'W/' + plain['ETag'])
+
+        response = self.client.get(self.path, {'covers': 'none'}, HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['ETag'], plain['ETag'])
+
+    def test_not_modified_has_the_same_etag(self):
+        etag = self.client.get(self.path, {'covers': 'none'}, HTTP_ACCEPT_ENCODING='gzip')['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response = self.client.get(self.path, {'covers': 'none'}, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # Too small to compress, still the validator of a response that may be compressed.
+        small = self.client.get('/hs/shelf/%d/' % self.shelf.pk, {'covers': 'none', 'limit': 1},
+                                HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', small)
+        self.assertTrue(small['ETag'].startswith('W/'))
+
+    def test_skipped_bodies(self):
+        text = b'{"title": "Book"}' * 200
+        response = self.middleware(HttpResponse(text, content_type='image/svg+xml'))
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response.content, text)
+
+        response = self.middleware(HttpResponse(text[:500], content_type='application/json'))
+        self.assertNotIn('Content-Encoding', response)
+
+        # Already compressed data, e.g. raw covers in MessagePack, fails the probe.
+        noise = os.urandom(8192)
+        response = self.middleware(HttpResponse(noise, content_type='application/msgpack'))
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response.content, noise)
+        response = self.middleware(StreamingHttpResponse(iter([noise[:4096], noise[4096:]]),
+                                                         content_type='application/msgpack'))
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(b''.join(response.streaming_content), noise)
+
+        response = self.middleware(HttpResponse(text, content_type='application/json'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    def test_stream_is_flushed_as_it_goes(self):
+        chunks = [('{"part": %d, "text": "%s"}' % (number, 'x' * 1000)).encode() for number in range(10)]
+        with mock.patch('hs.middleware.HS_COMPRESSION_FLUSH_SIZE', 1000), mock.patch('hs.middleware.PROBE_SIZE', 1):
+            response = self.middleware(StreamingHttpResponse(iter(chunks), content_type='application/json'))
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertFalse(response.has_header('Content-Length'))
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            received = b''
+            for number, piece in enumerate(response.streaming_content):
+                received += decompressor.decompress(piece)
+                # Every chunk can be decoded as soon as its piece arrives.
+                if number < len(chunks):
+                    self.assertEqual(received, b''.join(chunks[:number + 1]))
+        self.assertEqual(received, b''.join(chunks))
+
+@skipIf(msgpack is None or cbor2 is None, 'msgpack and cbor2 are needed')
+class WireFormatsTest(MediaTestMixin, TestCase):
+    ''' MessagePack and CBOR carry covers as raw bytes both ways, CBOR streams, every format has its own ETag. '''
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.key = ApiToken.issue(self.owner)[1]
+        self.shelf = Shelf.objects.create(name='Shelf', owner=self.owner)
+        ingest(self.owner, {'shelfs': [shelf_data('s', self.shelf)],
+                            'records': [record_data('a', 's', 'First', cover={'name': 'a.png', 'data': image_data()}),
+                                        record_data('b', 's', 'Second')]})
+        self.cover = ShelfRecord.objects.get(title='First').cover
+        self.path = '/hs/shelf/%d/' % self.shelf.pk
+
+    def get(self, media_type, params=None, **headers):
+        return self.client.get(self.path, params or {'covers': 'inline'}, HTTP_ACCEPT=media_type,
+                               HTTP_AUTHORIZATION='Token ' + self.key, **headers)
+
+    def post(self, media_type, content):
+        return self.client.post('/hs/records/add/', content, content_type=media_type,
+                                HTTP_AUTHORIZATION='Token ' + self.key)
+
+    def test_covers_are_raw_bytes(self):
+        with content_storage.open(self.cover.name) as f:
+            stored = f.read()
+        records = self.get('application/json').json()
+        self.assertEqual(b64decode(records[1]['cover']['data']), stored)
+
+        for media_type, loads in (('application/msgpack', msgpack.unpackb), ('application/cbor', cbor2.loads)):
+            with self.subTest(media_type=media_type):
+                response = self.get(media_type)
+                self.assertEqual(response['Content-Type'], media_type)
+                data = loads(response.content)
+                self.assertEqual(data[1]['cover'], {'name': self.cover.name, 'data': stored})
+                self.assertEqual(data[1]['read_date'], '2020-01-01')
+                self.assertEqual([record['title'] for record in data], [record['title'] for record in records])
+
+    def test_uploaded_raw_covers(self):
+        cover = b64decode(image_data('green'))
+        data = {'shelfs': [shelf_data('s', self.shelf)], 'records': [record_data('j', 's', 'JSON', cover=None)]}
+        data['records'][0]['cover'] = {'name': 'j.png', 'data': image_data('green')}
+        self.assertEqual(self.post('application/json', json.dumps(data)).status_code, 201)
+
+        for media_type, dumps, code in (('application/msgpack', msgpack.packb, 'm'), ('application/cbor', cbor2.dumps, 'c')):
+            with self.subTest(media_type=media_type):
+                data = {'shelfs': [shelf_data('s', self.shelf)],
+                        'records': [record_data(code, 's', code, cover={'name': code + '.png', 'data': cover})]}
+                response = self.post(media_type, dumps(data))
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(set(response.json()['records']), {code})
+
+        # The same picture, sent as base64 and as raw bytes, is one stored file.
+        covers = set(ShelfRecord.objects.filter(title__in=['JSON', 'm', 'c']).values_list('cover', flat=True))
+        self.assertEqual(len(covers), 1)
+
+    def test_bad_bodies(self):
+        response = self.post('application/msgpack', b'\xc1')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('MessagePack parse error', response.json()['detail'])
+        response = self.post('application/cbor', b'\x9f\x01')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('CBOR parse error', response.json()['detail'])
+
+    def test_cbor_stream(self):
+        whole = self.get('application/cbor')
+        response = self.get('application/cbor', {'covers': 'inline', 'stream': 1})
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content)
+        # An indefinite-length array: opened before the records are read, closed by a break.
+        self.assertEqual((content[:1], content[-1:]), (b'\x9f', b'\xff'))
+        self.assertEqual(cbor2.loads(content), cbor2.loads(whole.content))
+        self.assertEqual(self.get('application/cbor', {'covers': 'inline', 'stream': 1},
+                                  HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        # A MessagePack array needs its length up front, that format is not streamed.
+        response = self.get('application/msgpack', {'covers': 'inline', 'stream': 1})
+        self.assertFalse(response.streaming)
+        self.assertEqual(msgpack.unpackb(response.content), cbor2.loads(content))
+
+    def test_etag_per_format(self):
+        etags = {media_type: self.get(media_type)['ETag']
+                 for media_type in ('application/json', 'application/msgpack', 'application/cbor')}
+        self.assertEqual(len(set(etags.values())), 3)
+        for media_type, etag in etags.items():
+            with self.subTest(media_type=media_type):
+                self.assertIn('Accept', self.get(media_type)['Vary'])
+                self.assertEqual(self.get(media_type, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+                other = next(value for key, value in etags.items() if key != media_type)
+                self.assertEqual(self.get(media_type, HTTP_IF_NONE_MATCH=other).status_code, 200)
+
+class StreamRecordsTest(MediaTestMixin, TestCase):
+    ''' ?stream=1 sends the JSON of the records piece by piece, the same JSON as without it. '''
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.key = ApiToken.issue(self.owner)[1]
+        self.shelf = Shelf.objects.create(name='Shelf', owner=self.owner)
+        ingest(self.owner, {'shelfs': [shelf_data('s', self.shelf)],
+                            'records': [record_data('a', 's', 'First', rating=5,
+                                                    cover={'name': 'a.png', 'data': image_data()}),
+                                        record_data('b', 's', '"Quoted", \\ Юникод', rating=2),
+                                        record_data('c', 's', 'Third', rating=4,
+                                                    cover={'name': 'c.png', 'data': image_data('blue')})]})
+        self.path = '/hs/shelf/%d/' % self.shelf.pk
+
+    def get(self, params):
+        return self.client.get(self.path, params, HTTP_AUTHORIZATION='Token ' + self.key)
+
+    def test_same_as_regular_response(self):
+        for params in ({}, {'covers': 'url'}, {'covers': 'thumb'}, {'covers': 'none'}, {'sort': 'rating'},
+                       {'rating': 4}, {'covers': 'thumb', 'alias': 'cover'}):
+            with self.subTest(params=params):
+                whole = self.get(params)
+                response = self.get({**params, 'stream': 'true'})
+                self.assertTrue(response.streaming)
+                self.assertEqual(json.loads(b''.join(response.streaming_content)), whole.json())
+
+        data = json.loads(b''.join(self.get({'stream': 1}).streaming_content))
+        self.assertEqual([record['title'] for record in data if not record['cover']], ['"Quoted", \\ Юникод'])
+        for record in data:
+            if record['cover']:
+                with content_storage.open(record['cover']['name']) as f:
+                    self.assertEqual(b64decode(record['cover']['data']), f.read())
+
+    def test_empty_shelf(self):
+        ShelfRecord.objects.filter(shelf=self.shelf).delete()
+        response = self.get({'stream': 1})
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), [])
+
+    def test_stream_is_a_boolean(self):
+        for value in ('0', 'false', 'False', 'no', 'off', ''):
+            with self.subTest(value=value):
+                response = self.get({'stream': value})
+                self.assertFalse(response.streaming)
+                self.assertEqual(len(response.json()), 3)
+        for value in ('1', 'true', 'yes', 'on'):
+            with self.subTest(value=value):
+                self.assertTrue(self.get({'stream': value}).streaming)
+        response = self.get({'stream': 'maybe'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['detail'], '<stream> must be a boolean')
+
+    def test_cover_chunks(self):
+        path = content_storage.path(ShelfRecord.objects.get(title='First').cover.name)
+        with open(path, 'rb') as f:
+            content = f.read()
+        for chunk_size in (1, 3, 7, 64, len(content) + 1):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(b64decode(''.join(b64_file_chunks(path, chunk_size))), content)
+
+class CoverModesTest(MediaTestMixin, TestCase):
+    ''' The covers option picks how a cover is sent: not at all, as a url, as a thumbnail or whole. '''
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.key = ApiToken.issue(self.owner)[1]
+        self.shelf = Shelf.objects.create(name='Shelf', owner=self.owner)
+        content = BytesIO()
+        Image.new('RGB', (200, 300), 'red').save(content, 'PNG')
+        cover = {'name': 'big.png', 'data': b64encode(content.getvalue()).decode('ascii')}
+        ingest(self.owner, {'shelfs': [shelf_data('s', self.shelf)],
+                            'records': [record_data('a', 's', 'Covered', cover=cover),
+                                        record_data('b', 's', 'Bare')]})
+        self.record = ShelfRecord.objects.get(title='Covered')
+
+    def covers(self, **params):
+        response = self.client.get('/hs/shelf/%d/' % self.shelf.pk, params, HTTP_AUTHORIZATION='Token ' + self.key)
+        self.assertEqual(response.status_code, 200)
+        return {record['title']: record['cover'] for record in response.json()}
+
+    def test_none(self):
+        self.assertEqual(self.covers(covers='none'), {'Covered': None, 'Bare': None})
+
+    def test_url(self):
+        covers = self.covers(covers='url')
+        self.assertIsNone(covers['Bare'])
+        cover = covers['Covered']
+        self.assertEqual(cover['url'], 'http://testserver' + self.record.cover.url)
+        with content_storage.open(self.record.cover.name) as f:
+            self.assertEqual(cover['hash'], hashlib.sha256(f.read()).hexdigest())
+        self.assertNotIn('data', cover)
+
+    def test_inline(self):
+        covers = self.covers()
+        self.assertIsNone(covers['Bare'])
+        self.assertEqual(covers, self.covers(covers='inline'))
+        with content_storage.open(self.record.cover.name) as f:
+            self.assertEqual(b64decode(covers['Covered']['data']), f.read())
+        self.assertEqual(covers['Covered']['name'], self.covers(covers='url')['Covered']['name'])
+
+    def test_thumb(self):
+        expected = {None: 50, 'default': 125, 'cover_inline': 50, 'cover': 150}
+        for alias, width in expected.items():
+            with self.subTest(alias=alias):
+                params = {'covers': 'thumb'} if alias is None else {'covers': 'thumb', 'alias': alias}
+                cover = self.covers(**params)['Covered']
+                with Image.open(BytesIO(b64decode(cover['data']))) as image:
+                    self.assertEqual(image.width, width)
+
+        # A thumbnail the workers have not made yet is rendered on demand.
+        name = default_storage.path(thumbnail_name(self.record.cover.name, 'cover'))
+        os.remove(name)
+        cache.clear()
+        cover = self.covers(covers='thumb', alias='cover')['Covered']
+        with open(name, 'rb') as f:
+            self.assertEqual(b64decode(cover['data']), f.read())
+
+    def test_unknown_options(self):
+        url = '/hs/shelf/%d/' % self.shelf.pk
+        for params, detail in (({'covers': 'all'}, 'Unknown covers mode all. Must be one of: none, url, thumb, inline'),
+                               ({'covers': 'thumb', 'alias': 'huge'}, 'Unknown thumbnail alias huge'),
+                               ({'alias': ''}, 'Unknown thumbnail alias ')):
+            with self.subTest(params=params):
+                response = self.client.get(url, params, HTTP_AUTHORIZATION='Token ' + self.key)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()['detail'], detail)
@@ -1,6 +1,9 @@
 from django.urls import path
 
-from .views import users_view, shelfs_view, records_view, records_add
+from .views import users_view, shelfs_view, records_view, records_add, job_view
+from .views import shelf_export_view, library_export_view, search_view, stats_view, changes_view
+from .views import token_view
+from . import async_views
 
 app_name = 'hs'
 
@@ -8,5 +11,15 @@ urlpatterns = [
     path('users/', users_view),
     path('shelfs/', shelfs_view),
     path('shelf/<int:shelf_pk>/', records_view),
+    path('shelf/<int:shelf_pk>/export/', shelf_export_view),
+    path('export/', library_export_view),
     path('records/add/', records_add),
+    path('search/', search_view),
+    path('stats/', stats_view),
+    path('changes/', changes_view),
+    path('token/', token_view),
+    path('jobs/<int:job_pk>/', job_view, name='job'),
+    path('async/users/', async_views.users_view),
+    path('async/shelfs/', async_views.shelfs_view),
+    path('async/shelf/<int:shelf_pk>/', async_views.records_view),
 ]
\ No newline at end of file
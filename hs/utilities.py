@@ -0,0 +1,278 @@
+import asyncio, json, hashlib
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
+from base64 import b64encode, b64decode
+from functools import lru_cache
+
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Sum, Max
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from rest_framework.exceptions import ParseError
+from rest_framework.fields import BooleanField
+
+from bookshelf.settings import HS_STREAM_CHUNK_SIZE, HS_STREAM_COVER_CHUNK_SIZE, HS_ASYNC_FILE_CONCURRENCY
+from bookshelf.settings import THUMBNAIL_ALIASES, HS_THUMB_DEFAULT_ALIAS, HS_PAGE_SIZE, HS_PAGE_MAX_SIZE
+from main.models import Shelf, ShelfRecord, Change
+from main.thumbnails import ensure_thumbnail
+from main.storage import content_digest
+from main.pagination import KeysetPaginator, InvalidCursor
+
+COVER_MODES = ('none', 'url', 'thumb', 'inline')
+
+# Threads of the async hs views reading image files, created on first use.
+file_executor = None
+
+def images_context(request):
+    ''' Reads <covers> and <alias> query options into a serializer context. '''
+
+    mode = request.query_params.get('covers', 'inline')
+    if mode not in COVER_MODES:
+        raise ParseError(detail=f'Unknown covers mode {mode}. Must be one of: {", ".join(COVER_MODES)}')
+
+    alias = request.query_params.get('alias', HS_THUMB_DEFAULT_ALIAS)
+    if alias not in THUMBNAIL_ALIASES['']:
+        raise ParseError(detail=f'Unknown thumbnail alias {alias}')
+
+    # Binary formats (hs.renderers) carry cover bytes as they are, JSON as base64.
+    raw_covers = getattr(getattr(request, 'accepted_renderer', None), 'raw_covers', False)
+    return {'request': request, 'covers': mode, 'alias': alias, 'raw_covers': raw_covers}
+
+def query_flag(request, name):
+    ''' A boolean query option: ?<name>=1/true/yes/on turns it on, 0/false/no/off or nothing leaves it off. '''
+
+    value = request.query_params.get(name)
+    if value in BooleanField.TRUE_VALUES:
+        return True
+    if value in BooleanField.FALSE_VALUES or value in BooleanField.NULL_VALUES:
+        return False
+    raise ParseError(detail=f'<{name}> must be a boolean')
+
+def is_paginated(request):
+    return 'cursor' in request.query_params or 'limit' in request.query_params
+
+def paginated(request, queryset, serializer_class, context=None, keys=('-read_date', '-id')):
+    ''' Serializes one keyset page with its next/previous cursors and an optional count. '''
+
+    try:
+        limit = int(request.query_params.get('limit', HS_PAGE_SIZE))
+    except ValueError:
+        raise ParseError(detail='<limit> must be an integer')
+    limit = max(1, min(limit, HS_PAGE_MAX_SIZE))
+
+    count = request.query_params.get('count', 'none')
+    if count not in ('none', 'estimate', 'exact'):
+        raise ParseError(detail='<count> must be one of: none, estimate, exact')
+
+    paginator = KeysetPaginator(queryset, limit, keys)
+    try:
+        page = paginator.get_page(request.query_params.get('cursor'), count=count)
+    except InvalidCursor:
+        raise ParseError(detail='Invalid cursor')
+
+    serializer = serializer_class(page.object_list, many=True, context=context)
+    return {
+        'results': serializer.data,
+        'next': page.next_cursor,
+        'previous': page.previous_cursor,
+        'count': page.count,
+        'count_is_estimate': page.count_is_estimate,
+    }
+
+def representation_etag(*parts):
+    return '"%s"' % hashlib.md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+def shelf_validators(request, shelf):
+    ''' ETag and Last-Modified of a shelf representation: version, query options, host and format. '''
+    params = sorted(request.query_params.lists())
+    etag = representation_etag('shelf', shelf.pk, shelf.version, params, request.get_host(),
+                               request.accepted_renderer.format)
+    return etag, timegm(shelf.updated_at.utctimetuple())
+
+def shelf_list_etag(user, format='json'):
+    ''' ETag of the user's shelf list from one aggregate over the owner index.
+
+    There is no Last-Modified for the list: a deleted shelf leaves no newer
+    timestamp behind, while it does change the count and the id sum.
+    '''
+    totals = Shelf.objects.filter(owner=user).aggregate(**shelf_list_totals())
+    return representation_etag('shelfs', user.pk, format, *totals.values())
+
+def shelf_list_totals():
+    return {'count': Count('id'), 'ids': Sum('id'), 'versions': Sum('version'), 'updated_at': Max('updated_at')}
+
+def not_modified(request, etag, last_modified=None):
+    ''' A 304 response if the client copy is current, None otherwise. '''
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        with_validators(response, etag, last_modified)
+    return response
+
+def with_validators(response, etag, last_modified=None):
+    # Every format has its own ETag, chosen by the Accept header.
+    patch_vary_headers(response, ['Accept'])
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(last_modified)
+    return response
+
+def file_hash(name):
+    # Content-addressed names (main.storage) are the hash, the file is not read.
+    return content_digest(name) or stored_file_hash(name)
+
+@lru_cache(maxsize=4096)
+def stored_file_hash(name):
+    # Files stored before content addressing have unique names and are never
+    # rewritten in place, so a hash computed once stays valid for the life of the process.
+    digest = hashlib.sha256()
+    with open(default_storage.path(name), 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(HS_STREAM_COVER_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def represented_image(image, name, context):
+    mode = context.get('covers', 'inline')
+
+    if mode == 'none':
+        return None
+
+    if mode == 'url':
+        url = image.url
+        request = context.get('request')
+        if request is not None:
+            url = request.build_absolute_uri(url)
+        return {'name': name, 'url': url, 'hash': file_hash(image.name)}
+
+    if mode == 'thumb':
+        file_path = default_storage.path(ensure_thumbnail(image.name, context.get('alias', HS_THUMB_DEFAULT_ALIAS)))
+    else:
+        file_path = default_storage.path(image.name)
+
+    with open(file_path, 'rb') as image_file:
+        content = image_file.read()
+    if context.get('raw_covers'):
+        return {'name': name, 'data': content}
+    return {'name': name, 'data': b64encode(content).decode('ascii')}
+
+async def represent_images(items, field, context, display=None):
+    ''' Fills in the images of serialized <items>, left as {'name': ...} by the defer_cover option.
+
+    Files are read by HS_ASYNC_FILE_CONCURRENCY threads shared by all
+    requests (the default executor of asyncio.to_thread may have far fewer),
+    in at most as many batches per request: a hop to a thread costs more
+    than reading a cached file. <display> turns a stored name into the name
+    clients see.
+    '''
+
+    global file_executor
+    if file_executor is None:
+        file_executor = ThreadPoolExecutor(max_workers=HS_ASYNC_FILE_CONCURRENCY, thread_name_prefix='hs-files')
+    loop = asyncio.get_running_loop()
+
+    def represent(batch):
+        for item in batch:
+            name = item[field.name]['name']
+            image = field.attr_class(None, field, name)
+            item[field.name] = represented_image(image, display(name) if display else name, context)
+
+    items = [item for item in items if item.get(field.name)]
+    await asyncio.gather(*(loop.run_in_executor(file_executor, represent, items[start::HS_ASYNC_FILE_CONCURRENCY])
+                           for start in range(min(len(items), HS_ASYNC_FILE_CONCURRENCY))))
+
+def cover_content(data):
+    ''' Cover bytes as sent: raw in binary formats, base64 in JSON. Raises binascii.Error on bad base64. '''
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    return b64decode(data)
+
+def b64_file_chunks(file_path, chunk_size=HS_STREAM_COVER_CHUNK_SIZE):
+    # Chunk size is kept a multiple of 3, so the encoded chunks
+    # concatenate into one valid base64 string without padding in between.
+    chunk_size = max(3, chunk_size - chunk_size % 3)
+    with open(file_path, 'rb') as image_file:
+        while True:
+            chunk = image_file.read(chunk_size)
+            if not chunk:
+                break
+            yield b64encode(chunk).decode('ascii')
+
+def dumped(data):
+    return json.dumps(data, cls=DjangoJSONEncoder)
+
+def stream_records(records, serializer_class, context=None):
+    ''' Yields a JSON array of records piece by piece, covers are encoded on the fly. '''
+
+    context = dict(context or {})
+    context['defer_cover'] = (context.get('covers', 'inline') == 'inline')
+
+    yield '['
+    first = True
+    for record in records.iterator(chunk_size=HS_STREAM_CHUNK_SIZE):
+        if not first:
+            yield ','
+        first = False
+        yield from stream_record(record, serializer_class, context)
+    yield ']'
+
+def stream_rendered(records, serializer_class, renderer, context=None):
+    ''' stream_records for binary formats that can open an array before its length is known. '''
+
+    yield renderer.stream_start()
+    for record in records.iterator(chunk_size=HS_STREAM_CHUNK_SIZE):
+        yield renderer.render(serializer_class(record, context=context).data)
+    yield renderer.stream_end()
+
+def stream_record(record, serializer_class, context):
+
+    data = serializer_class(record, context=context).data
+
+    if not (context['defer_cover'] and data.get('cover')):
+        yield dumped(data)
+        return
+
+    cover = data.pop('cover')
+    yield dumped(data)[:-1]
+    yield ', "cover": {"name": %s, "data": "' % dumped(cover['name'])
+    yield from b64_file_chunks(default_storage.path(record.cover.name))
+    yield '"}}'
+
+def changes_page(request, token, limit):
+    ''' Shelfs and records of the user changed after <token>, each in its latest state.
+
+    A deleted shelf is reported once, without separate tombstones for its
+    records. A changed object that is gone by now is reported deleted: a
+    record moved to a shelf that was deleted afterwards has no tombstone
+    of its own. Returns the new token and whether more changes are waiting past <limit>.
+    '''
+    from .serializers import ShelfSerializerSync, ShelfRecordSerializerSync
+
+    entries = list(Change.objects.filter(owner=request.user, id__gt=token).order_by('id')
+                   .values_list('id', 'kind', 'object_id', 'deleted')[:limit])
+    latest = {}
+    for _, kind, object_id, deleted in entries:
+        latest[(kind, object_id)] = deleted
+
+    def changed(kind, deleted):
+        return [object_id for (entry_kind, object_id), entry_deleted in latest.items()
+                if entry_kind == kind and entry_deleted == deleted]
+
+    def gone(kind, objects):
+        found = {obj.pk for obj in objects}
+        return [object_id for object_id in changed(kind, False) if object_id not in found]
+
+    shelfs = list(Shelf.objects.filter(owner=request.user, pk__in=changed(Change.SHELF, False)))
+    records = list(ShelfRecord.objects.filter(shelf__owner=request.user, pk__in=changed(Change.RECORD, False)))
+
+    return {
+        'shelfs': {
+            'updated': ShelfSerializerSync(shelfs, many=True).data,
+            'deleted': changed(Change.SHELF, True) + gone(Change.SHELF, shelfs),
+        },
+        'records': {
+            'updated': ShelfRecordSerializerSync(records, many=True, context=images_context(request)).data,
+            'deleted': changed(Change.RECORD, True) + gone(Change.RECORD, records),
+        },
+        'token': entries[-1][0] if entries else token,
+        'has_more': len(entries) == limit,
+    }
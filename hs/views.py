@@ -1,39 +1,62 @@
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
+from rest_framework.decorators import renderer_classes, parser_classes
+from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.exceptions import NotFound, PermissionDenied, ParseError, ValidationError, APIException
+from rest_framework.exceptions import NotFound, PermissionDenied, ParseError, ValidationError
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, IsAuthenticatedOrReadOnly
 from rest_framework.authentication import BasicAuthentication
-from django.http import JsonResponse
+from django.http import StreamingHttpResponse, HttpResponse
 from django.urls import reverse
 from django.core.files.base import ContentFile
-from django.db import transaction
-from django.db.transaction import rollback
 
 from random import randint
-import logging, base64
+import logging, binascii
 
-from main.models import Shelf, BookUser, ShelfRecord
+from main.models import Shelf, BookUser, ShelfRecord, ImportJob
+from main.forms import RecordListForm
+from main.jobs import create_hs_job, checked
+from main.exports import EXPORT_TYPES, export_response, shelf_records, library_records
+from main.search import search_records
+from main.analytics import reading_stats
+from main.caching import shelf_cache_key, cached
 from .serializers import ShelfSerializer, UserSerializer, ShelfRecordSerializerGET, ShelfRecordSerializerPOST
+from .serializers import ImportJobSerializer, ShelfRecordSerializerSearch
+from .utilities import stream_records, stream_rendered, images_context, is_paginated, paginated, cover_content
+from .utilities import shelf_validators, shelf_list_etag, not_modified, with_validators, changes_page, query_flag
+from .ingest import ingest
+from .models import ApiToken
+from .authentication import TokenAuthentication, revoke
+from .renderers import RENDERERS, PARSERS
+from bookshelf.settings import SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE, SHELF_CACHE_MAX_SIZE
+from bookshelf.settings import SYNC_PAGE_SIZE, SYNC_MAX_PAGE_SIZE
 
 logger = logging.getLogger(__name__)
 
 @api_view(['GET'])
-@authentication_classes([BasicAuthentication])
+@renderer_classes(RENDERERS)
+@parser_classes(PARSERS)
+@authentication_classes([TokenAuthentication])
 @permission_classes([IsAdminUser])
 def users_view(request):
     if request.method == 'GET':
         users = BookUser.objects.all()
-        serializer = UserSerializer(users, many=True)
-        return JsonResponse(serializer.data, safe=False)
+        serializer = UserSerializer(users, many=True, context=images_context(request))
+        return Response(serializer.data)
 
 @api_view(['GET', 'POST'])
-@authentication_classes([BasicAuthentication])
+@renderer_classes(RENDERERS)
+@parser_classes(PARSERS)
+@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def shelfs_view(request):
     if request.method == 'GET':
+        etag = shelf_list_etag(request.user, request.accepted_renderer.format)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
         shelfs = Shelf.objects.filter(owner=request.user)
         serializer = ShelfSerializer(shelfs, many=True)
-        return JsonResponse(serializer.data, safe=False)
+        return with_validators(Response(serializer.data), etag)
     elif request.method == 'POST':
         data = request.data
         data['owner'] = request.user.pk
@@ -41,12 +64,14 @@ def shelfs_view(request):
         if serializer.is_valid():
             shelf = serializer.save()
             urn = reverse('main:shelf_detail', args=(shelf.pk,))
-            return JsonResponse({'urn': urn}, status=status.HTTP_201_CREATED)
+            return Response({'urn': urn}, status=status.HTTP_201_CREATED)
         else:
-            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
 @api_view(['GET', 'POST'])
-@authentication_classes([BasicAuthentication])
+@renderer_classes(RENDERERS)
+@parser_classes(PARSERS)
+@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticatedOrReadOnly])
 def records_view(request, shelf_pk):
     try:
@@ -55,13 +80,45 @@ def records_view(request, shelf_pk):
         raise NotFound(detail='Объект не найден')
     
     if shelf.private:
-        if shelf.owner != request.user:
+        if shelf.owner_id != request.user.pk:
             raise PermissionDenied(detail='У Вас нет доступа к этой полке')
         
     if request.method == 'GET':
-        records = ShelfRecord.objects.filter(shelf=shelf)
-        serializer = ShelfRecordSerializerGET(records, many=True)
-        return JsonResponse(serializer.data, safe=False)
+        etag, last_modified = shelf_validators(request, shelf)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+
+        form = RecordListForm(request.query_params)
+        if not form.is_valid():
+            raise ValidationError(detail=form.errors)
+        records, keys = form.apply(ShelfRecord.objects.filter(shelf=shelf))
+        context = images_context(request)
+        renderer = request.accepted_renderer
+        # A MessagePack array needs its length up front, so that format is never streamed.
+        if query_flag(request, 'stream') and not is_paginated(request):
+            if renderer.format == 'json':
+                content = stream_records(records.order_by(*keys), ShelfRecordSerializerGET, context)
+            elif hasattr(renderer, 'stream_start'):
+                content = stream_rendered(records.order_by(*keys), ShelfRecordSerializerGET, renderer, context)
+            else:
+                content = None
+            if content is not None:
+                response = StreamingHttpResponse(content, content_type=renderer.media_type)
+                return with_validators(response, etag, last_modified)
+
+        def payload():
+            if is_paginated(request):
+                data = paginated(request, records, ShelfRecordSerializerGET, context, keys)
+            else:
+                data = ShelfRecordSerializerGET(records.order_by(*keys), many=True, context=context).data
+            return renderer.render(data)
+
+        # Cover urls are absolute, so the host is part of the key.
+        params = [*request.query_params.lists(), ('host', [request.get_host()]), ('renderer', [renderer.format])]
+        key = shelf_cache_key('hs_records', shelf, shelf.owner_id == request.user.pk, params)
+        response = HttpResponse(cached(key, payload, SHELF_CACHE_MAX_SIZE), content_type=renderer.media_type)
+        return with_validators(response, etag, last_modified)
     elif request.method == 'POST':
         if shelf.owner != request.user:
             raise PermissionDenied(detail='У Вас нет доступа к этой полке')
@@ -73,7 +130,10 @@ def records_view(request, shelf_pk):
             if not ('name' in cover_meta and 'data' in cover_meta):
                 raise ParseError(detail='Wrong context. Must contain both <name> and <data> fields')
             
-            b_data = base64.b64decode(cover_meta['data'])
+            try:
+                b_data = cover_content(cover_meta['data'])
+            except (binascii.Error, TypeError):
+                raise ParseError(detail='Cover data is not valid base64')
             name = cover_meta['name']
             cover = ContentFile(b_data, name=name)
             data['cover'] = cover
@@ -84,107 +144,142 @@ def records_view(request, shelf_pk):
         if serializer.is_valid():
             record = serializer.save()
             urn = reverse('main:record_detail', args=(record.pk,))
-            return JsonResponse({'urn': urn}, status=status.HTTP_201_CREATED)
+            return Response({'urn': urn}, status=status.HTTP_201_CREATED)
         else:
-            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 @api_view(['POST'])
-@authentication_classes([BasicAuthentication])
+@renderer_classes(RENDERERS)
+@parser_classes(PARSERS)
+@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
-@transaction.atomic
 def records_add(request):
+    options = {'on_duplicate': request.query_params.get('on_duplicate', ShelfRecord.DUPLICATES_SKIP)}
+    if options['on_duplicate'] not in dict(ShelfRecord.DUPLICATES_CHOICES):
+        raise ParseError(detail=f'Unknown on_duplicate option {options["on_duplicate"]}')
 
-    shelfs = shelfs_processing(request)
-    records = records_processing(request, shelfs)
+    if query_flag(request, 'async'):
+        job = create_hs_job(request.user, request.data, options)
+        urn = reverse('hs:job', args=(job.pk,))
+        return Response({'job': job.pk, 'urn': urn}, status=status.HTTP_202_ACCEPTED)
 
-    result = {
-        'shelfs': shelfs,
-        'records': records,
-    }
+    result = ingest(request.user, request.data, **options)
+    return Response(result, status=status.HTTP_201_CREATED)
 
-    return JsonResponse(result, status=status.HTTP_201_CREATED)
+@api_view(['GET'])
+@renderer_classes(RENDERERS)
+@parser_classes(PARSERS)
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def job_view(request, job_pk):
+    try:
+        job = ImportJob.objects.get(pk=job_pk, owner=request.user)
+    except ImportJob.DoesNotExist:
+        raise NotFound(detail='Объект не найден')
 
-def shelfs_processing(request):
-    
-    incoming_data = request.data
-    shelfs = {}
-
-    if 'shelfs' in incoming_data:
-        for shelf_data in incoming_data['shelfs']:
-            code = shelf_data['code']
-            if not shelf_data['id']:
-                creation_data = {
-                    'name': shelf_data['title'],
-                    'private': shelf_data['private'],
-                    'owner': request.user.pk
-                }
-                serializer = ShelfSerializer(data=creation_data)
-                if serializer.is_valid():
-                    shelf = serializer.save()
-                    shelfs[code] = shelf.id
-                else:
-                    detail = {'preamble': f'Problems with saving shelf with code {code}',}
-                    detail.update(serializer.errors)
-                    raise ValidationError(detail=detail)
-            else:
-                shelfs[code] = shelf_data['id']
+    serializer = ImportJobSerializer(checked(job))
+    return Response(serializer.data)
 
-    return shelfs
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticatedOrReadOnly])
+def shelf_export_view(request, shelf_pk):
+    try:
+        shelf = Shelf.objects.get(pk=shelf_pk)
+    except Shelf.DoesNotExist:
+        raise NotFound(detail='Объект не найден')
 
-def records_processing(request, shelfs):
+    if shelf.private and shelf.owner != request.user:
+        raise PermissionDenied(detail='У Вас нет доступа к этой полке')
 
-    incoming_data = request.data
-    records = {}
+    export_type = export_type_param(request)
+    return export_response(shelf_records(shelf), export_type, 'shelf_%d' % shelf.pk)
 
-    if 'records' in incoming_data:
-        for record_data in incoming_data['records']:
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def library_export_view(request):
+    export_type = export_type_param(request)
+    return export_response(library_records(request.user), export_type, 'library')
 
-            code = record_data['code']
-            shelf_code = record_data['shelf_code']
+def export_type_param(request):
+    export_type = request.query_params.get('type', 'ndjson')
+    if export_type not in EXPORT_TYPES:
+        raise ParseError(detail=f'Unknown export type {export_type}. Must be one of: {", ".join(EXPORT_TYPES)}')
+    return export_type
 
-            shelf_id = shelfs.get(shelf_code)
+@api_view(['GET'])
+@renderer_classes(RENDERERS)
+@parser_classes(PARSERS)
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticatedOrReadOnly])
+def search_view(request):
+    query = request.query_params.get('q', '')
+    try:
+        limit = int(request.query_params.get('limit', SEARCH_PAGE_SIZE))
+        offset = int(request.query_params.get('offset', 0))
+    except ValueError:
+        raise ParseError(detail='<limit> and <offset> must be integers')
+    limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+    offset = max(0, offset)
 
-            if not shelf_id:
-                detail = f'Shelf with code {shelf_code} is not found'
-                raise APIException(detail=detail)
-                        
-            try:
-                shelf = Shelf.objects.get(pk=shelf_id)
-            except Shelf.DoesNotExist:
-                raise NotFound(detail=f'Shelf with id {shelf_id} is not found')
-            
-            if shelf.owner != request.user:
-                raise PermissionDenied(detail='У Вас нет доступа к этой полке')
-
-            creation_data = {
-                'title': record_data['title'],
-                'author': record_data['author'],
-                'rating': record_data['rating'],
-                'comment': record_data['comment'],
-                'shelf': shelf.pk,
-                'random_cover': record_data['random_cover'],
-                'read_date': record_data['read_date'],
-                'cover': None,
-            }
-
-            cover_data = record_data['cover']
-            if cover_data:
-                if not ('name' in cover_data and 'data' in cover_data):
-                    detail = f'Wrong filedata-context in record {code}. Must contain both <name> and <data> fields'
-                    raise ValidationError(detail=detail)
-                
-                binary_data = base64.b64decode(cover_data['data'])
-                name = cover_data['name']
-                cover = ContentFile(binary_data, name=name)
-                creation_data['cover'] = cover
-
-            serializer = ShelfRecordSerializerPOST(data=creation_data)
-            if serializer.is_valid():
-                record = serializer.save()
-                records[code] = record.id
-            else:
-                detail = {'preamble': f'Problems with saving record with code {code}',}
-                detail.update(serializer.errors)
-                raise ValidationError(detail=detail)
-            
-    return records
\ No newline at end of file
+    shelf = None
+    if 'shelf' in request.query_params:
+        try:
+            shelf = Shelf.objects.get(pk=request.query_params['shelf'])
+        except (Shelf.DoesNotExist, ValueError):
+            raise NotFound(detail='Объект не найден')
+        if shelf.private and shelf.owner != request.user:
+            raise PermissionDenied(detail='У Вас нет доступа к этой полке')
+
+    records, has_more = search_records(query, request.user, shelf=shelf, limit=limit, offset=offset)
+    serializer = ShelfRecordSerializerSearch(records, many=True, context=images_context(request))
+    return Response({
+        'results': serializer.data,
+        'next_offset': offset + limit if has_more else None,
+    })
+
+@api_view(['GET'])
+@renderer_classes(RENDERERS)
+@parser_classes(PARSERS)
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def stats_view(request):
+    return Response(reading_stats(request.user))
+
+@api_view(['GET'])
+@renderer_classes(RENDERERS)
+@parser_classes(PARSERS)
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def changes_view(request):
+    try:
+        token = int(request.query_params.get('token', 0))
+        limit = int(request.query_params.get('limit', SYNC_PAGE_SIZE))
+    except ValueError:
+        raise ParseError(detail='<token> and <limit> must be integers')
+    limit = max(1, min(limit, SYNC_MAX_PAGE_SIZE))
+
+    return Response(changes_page(request, token, limit))
+
+@api_view(['POST', 'DELETE'])
+@renderer_classes(RENDERERS)
+@parser_classes(PARSERS)
+@authentication_classes([BasicAuthentication, TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def token_view(request):
+    ''' POST with login and password issues a token for the other hs views.
+    DELETE revokes the token it is called with, or with Basic credentials every token of the user.
+    '''
+    if request.method == 'POST':
+        if not isinstance(request.successful_authenticator, BasicAuthentication):
+            raise PermissionDenied(detail='Токен выдается только по логину и паролю')
+        name = str(request.data.get('name', ''))[:ApiToken._meta.get_field('name').max_length]
+        token, key = ApiToken.issue(request.user, name)
+        return Response({'token': key, 'id': token.pk}, status=status.HTTP_201_CREATED)
+    elif request.method == 'DELETE':
+        if isinstance(request.successful_authenticator, TokenAuthentication):
+            revoked = revoke(ApiToken.objects.filter(digest=request.auth))
+        else:
+            revoked = revoke(ApiToken.objects.filter(owner=request.user))
+        return Response({'revoked': revoked})
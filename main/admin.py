@@ -1,10 +1,19 @@
 from django.contrib import admin
-from .models import BookUser, Shelf, ShelfRecord
+from .models import BookUser, Shelf, ShelfRecord, ImportJob, OrphanedFile
 
 class BookUserAdmin(admin.ModelAdmin):
     list_display = ('username', 'first_name', 'last_name', 'email', 'is_active', 'is_activated', 'is_superuser', 'last_login')
     list_display_links = ('username',)
 
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'owner', 'status', 'rows_parsed', 'rows_inserted', 'rows_failed', 'created')
+    list_filter = ('status', 'kind')
+
+class OrphanedFileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'created')
+
 admin.site.register(BookUser, BookUserAdmin)
 admin.site.register(Shelf)
-admin.site.register(ShelfRecord)
\ No newline at end of file
+admin.site.register(ShelfRecord)
+admin.site.register(ImportJob, ImportJobAdmin)
+admin.site.register(OrphanedFile, OrphanedFileAdmin)
\ No newline at end of file
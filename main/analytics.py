@@ -0,0 +1,134 @@
+from collections import defaultdict
+
+from django.db import connections, router, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import ExtractYear, ExtractMonth
+
+from .models import ShelfRecord, MonthlyRollup, AuthorRollup
+
+RATINGS = range(0, 6)
+
+def update_rollups(changes, owners):
+    ''' Applies {RecordState: +n or -n} to the rollups of the shelf owners, <owners> maps shelf ids to them. '''
+
+    if not changes:
+        return
+
+    months = defaultdict(int)
+    authors = defaultdict(lambda: [0, 0])
+    for state, sign in changes.items():
+        owner = owners.get(state.shelf_id)
+        if owner is None:
+            continue
+        months[(owner, state.read_date.year, state.read_date.month, state.rating)] += sign
+        totals = authors[(owner, state.author)]
+        totals[0] += sign
+        totals[1] += sign * state.rating
+    add_to_rollups(months, authors)
+
+def subtract_records(records):
+    ''' Takes a whole queryset of records out of the rollups, e.g. before a shelf is deleted. '''
+
+    records = records.order_by()
+    months = {}
+    for row in records.annotate(year=ExtractYear('read_date'), month=ExtractMonth('read_date'))\
+            .values('shelf__owner', 'year', 'month', 'rating').annotate(count=Count('id')):
+        months[(row['shelf__owner'], row['year'], row['month'], row['rating'])] = -row['count']
+    authors = {}
+    for row in records.values('shelf__owner', 'author').annotate(count=Count('id'), rating_sum=Sum('rating')):
+        authors[(row['shelf__owner'], row['author'])] = [-row['count'], -row['rating_sum']]
+    add_to_rollups(months, authors)
+
+def add_to_rollups(months, authors):
+    add_to(MonthlyRollup, ('owner', 'year', 'month', 'rating'), ('record_count',),
+           [key + (count,) for key, count in months.items() if count])
+    add_to(AuthorRollup, ('owner', 'author'), ('record_count', 'rating_sum'),
+           [key + tuple(totals) for key, totals in authors.items() if any(totals)])
+
+def add_to(model, keys, counters, rows, batch_size=500):
+    ''' Adds counters to rollup rows, creating missing rows, one statement per batch.
+
+    Django's bulk_create(update_conflicts=True) can only overwrite values,
+    so the relative upsert is written out by hand.
+    '''
+
+    if not rows:
+        return
+
+    connection = connections[router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    key_columns = [qn(model._meta.get_field(name).column) for name in keys]
+    counter_columns = [qn(model._meta.get_field(name).column) for name in counters]
+    placeholder = '(%s)' % ', '.join(['%s'] * (len(keys) + len(counters)))
+    updates = ', '.join(f'{column} = {table}.{column} + excluded.{column}' for column in counter_columns)
+
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            cursor.execute(
+                f'INSERT INTO {table} ({", ".join(key_columns + counter_columns)}) '
+                f'VALUES {", ".join([placeholder] * len(batch))} '
+                f'ON CONFLICT ({", ".join(key_columns)}) DO UPDATE SET {updates}',
+                [value for row in batch for value in row])
+
+def rebuild_rollups(users):
+    ''' Recomputes the rollups of <users> (a BookUser queryset) from their records. '''
+
+    records = ShelfRecord.objects.filter(shelf__owner__in=users).order_by()
+    months = records.annotate(year=ExtractYear('read_date'), month=ExtractMonth('read_date'))\
+        .values('shelf__owner', 'year', 'month', 'rating').annotate(count=Count('id'))
+    authors = records.values('shelf__owner', 'author').annotate(count=Count('id'), rating_sum=Sum('rating'))
+
+    with transaction.atomic():
+        MonthlyRollup.objects.filter(owner__in=users).delete()
+        AuthorRollup.objects.filter(owner__in=users).delete()
+        MonthlyRollup.objects.bulk_create([
+            MonthlyRollup(owner_id=row['shelf__owner'], year=row['year'], month=row['month'], rating=row['rating'],
+                          record_count=row['count'])
+            for row in months
+        ], batch_size=1000)
+        AuthorRollup.objects.bulk_create([
+            AuthorRollup(owner_id=row['shelf__owner'], author=row['author'], record_count=row['count'],
+                         rating_sum=row['rating_sum'])
+            for row in authors
+        ], batch_size=1000)
+
+def reading_stats(user, authors=20):
+    ''' Year, month, rating and author breakdowns of <user>'s reading, from two indexed reads. '''
+
+    years = {}
+    ratings = dict.fromkeys(RATINGS, 0)
+    total = rating_sum = 0
+    rows = MonthlyRollup.objects.filter(owner=user, record_count__gt=0)\
+        .values_list('year', 'month', 'rating', 'record_count')
+    for year, month, rating, count in rows:
+        totals = years.setdefault(year, {'year': year, 'count': 0, 'rating_sum': 0, 'months': [0] * 12})
+        totals['count'] += count
+        totals['rating_sum'] += rating * count
+        totals['months'][month - 1] += count
+        ratings[rating] = ratings.get(rating, 0) + count
+        total += count
+        rating_sum += rating * count
+
+    for totals in years.values():
+        totals['average_rating'] = average(totals.pop('rating_sum'), totals['count'])
+
+    top_authors = AuthorRollup.objects.filter(owner=user, record_count__gt=0)\
+        .order_by('-record_count', 'author')[:authors]
+
+    return {
+        'count': total,
+        'average_rating': average(rating_sum, total),
+        'years': sorted(years.values(), key=lambda totals: totals['year'], reverse=True),
+        'ratings': [{'rating': rating, 'count': count} for rating, count in sorted(ratings.items())],
+        'authors': [
+            {'author': rollup.author, 'count': rollup.record_count, 'average_rating': average(rollup.rating_sum, rollup.record_count)}
+            for rollup in top_authors
+        ],
+    }
+
+def average(rating_sum, count):
+    if not count:
+        return None
+    return round(rating_sum / count, 2)
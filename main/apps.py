@@ -1,5 +1,6 @@
 from django.apps import AppConfig
 from django.dispatch import Signal
+from django.db.models.signals import post_migrate
 
 from .utilities import send_activation_notification
 
@@ -10,7 +11,14 @@ def user_registered_dispatcher(sender, **kwargs):
 
 user_registered.connect(user_registered_dispatcher)
 
+def search_index_installer(sender, using, **kwargs):
+    from .search import install_search_index
+    install_search_index(using)
+
 class MainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main'
     verbose_name = 'Bookshelf'
+
+    def ready(self):
+        post_migrate.connect(search_index_installer, sender=self)
@@ -0,0 +1,34 @@
+import hashlib
+
+from django.core.cache import cache
+
+from bookshelf.settings import SHELF_CACHE_TIMEOUT
+
+def shelf_cache_key(prefix, shelf, is_owner, params=()):
+    ''' Key of a cached shelf view; a write to the shelf or its records changes Shelf.version.
+
+    The shelf has to be read before the cached content is built: content
+    built from newer data then lands under an old version nobody asks for
+    any more, never the other way round.
+    '''
+    query = '&'.join('%s=%s' % item for item in sorted(params))
+    digest = hashlib.md5(query.encode('utf-8')).hexdigest()
+    return '%s:%s:%s:%d:%s' % (prefix, shelf.pk, shelf.version, is_owner, digest)
+
+def cached(key, build, max_size=None):
+    ''' Returns the cached string or bytes under <key>, building and storing it on a miss. '''
+    content = cache.get(key)
+    if content is None:
+        content = build()
+        if max_size is None or len(content) <= max_size:
+            cache.set(key, content, SHELF_CACHE_TIMEOUT)
+    return content
+
+async def acached(key, build, max_size=None):
+    ''' cached() for async views, <build> is a coroutine function. '''
+    content = await cache.aget(key)
+    if content is None:
+        content = await build()
+        if max_size is None or len(content) <= max_size:
+            await cache.aset(key, content, SHELF_CACHE_TIMEOUT)
+    return content
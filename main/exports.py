@@ -0,0 +1,66 @@
+import csv, json
+
+from django.http import StreamingHttpResponse
+
+from .models import ShelfRecord
+from .utilities import formatted_read_date
+from bookshelf.settings import EXPORT_CHUNK_SIZE
+
+EXPORT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+class Echo:
+    ''' File-like object for csv.writer that hands every written row back. '''
+
+    def write(self, value):
+        return value
+
+def exported_records(records):
+    ''' All records in one query, read in chunks and ordered by shelf. '''
+    records = records.select_related('shelf').order_by('shelf_id', '-read_date', '-id')
+    return records.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+def csv_lines(records):
+    ''' Rows in the format handle_shelf_file reads back; the unused third column holds the shelf name. '''
+    writer = csv.writer(Echo())
+    for record in exported_records(records):
+        yield writer.writerow([
+            record.title,
+            record.author,
+            record.shelf.name,
+            '*' * max(record.rating, 0),
+            formatted_read_date(record.read_date),
+        ])
+
+def ndjson_lines(records):
+    for record in exported_records(records):
+        data = {
+            'id': record.id,
+            'shelf': record.shelf_id,
+            'shelf_name': record.shelf.name,
+            'title': record.title,
+            'author': record.author,
+            'comment': record.comment,
+            'rating': record.rating,
+            'read_date': record.read_date.isoformat(),
+            'random_cover': record.random_cover,
+            'cover': record.cover.name or None,
+        }
+        yield json.dumps(data, ensure_ascii=False) + '\n'
+
+def export_response(records, export_type, filename):
+    if export_type == 'ndjson':
+        content = ndjson_lines(records)
+    else:
+        content = csv_lines(records)
+    response = StreamingHttpResponse(content, content_type=EXPORT_TYPES[export_type])
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (filename, export_type)
+    return response
+
+def shelf_records(shelf):
+    return ShelfRecord.objects.filter(shelf=shelf)
+
+def library_records(user):
+    return ShelfRecord.objects.filter(shelf__owner=user)
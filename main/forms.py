@@ -1,5 +1,7 @@
 import datetime
 from django import forms
+from django.db.models import F, Func
+from django.db.models.lookups import Exact, GreaterThanOrEqual, LessThanOrEqual
 from django.contrib.auth.forms import AuthenticationForm, UserCreationForm
 
 from .apps import user_registered
@@ -109,3 +111,108 @@ class UploadFileForm(forms.Form):
         label='Файл с книгами',
         widget=forms.FileInput(attrs={'class': 'form-control', 'accept': 'text'})
     )
+    on_duplicate = forms.ChoiceField(
+        label='Уже загруженные книги',
+        choices=ShelfRecord.DUPLICATES_CHOICES,
+        initial=ShelfRecord.DUPLICATES_SKIP,
+        widget=forms.widgets.Select(attrs={'size': 1, 'class': 'form-control'})
+    )
+
+class RecordListForm(forms.Form):
+    ''' Sort and filter options of shelf listings; every combination is served by an index. '''
+
+    SORT_KEYS = {
+        'date': ('-read_date', '-id'),
+        'rating': ('-rating', '-read_date', '-id'),
+        'author': ('author', '-read_date', '-id'),
+    }
+
+    sort = forms.ChoiceField(
+        label='Порядок',
+        required=False,
+        choices=[('date', 'По дате'), ('rating', 'По оценке'), ('author', 'По автору')],
+        widget=forms.widgets.Select(attrs={'size': 1, 'class': 'form-control'})
+    )
+    rating = forms.TypedChoiceField(
+        label='Оценка',
+        required=False,
+        coerce=int,
+        empty_value=None,
+        choices=[('', 'Любая')] + [(i, str(i)) for i in range(0, 6)],
+        widget=forms.widgets.Select(attrs={'size': 1, 'class': 'form-control'})
+    )
+    author = forms.CharField(
+        label='Автор',
+        required=False,
+        max_length=250,
+        widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Автор'})
+    )
+    date_from = forms.DateField(
+        label='С',
+        required=False,
+        widget=DateInput(attrs={'class': 'form-control'}, format='%Y-%m-%d')
+    )
+    date_to = forms.DateField(
+        label='По',
+        required=False,
+        widget=DateInput(attrs={'class': 'form-control'}, format='%Y-%m-%d')
+    )
+
+    def is_filtered(self):
+        if not self.is_valid():
+            return False
+        data = self.cleaned_data
+        return any(data.get(name) not in (None, '') for name in ('rating', 'author', 'date_from', 'date_to'))
+
+    def apply(self, records):
+        ''' Returns the filtered queryset and the keyset ordering for it. '''
+        data = self.cleaned_data if self.is_valid() else {}
+        sort = data.get('sort') or 'date'
+        rating = data.get('rating')
+        author = data.get('author')
+
+        # Pick the one index that serves the order; a sort column pinned by an
+        # equality filter leaves the date order inside that index.
+        if sort == 'rating':
+            index = 'rating'
+        elif sort == 'author':
+            index = 'author'
+        elif rating is not None:
+            index = 'rating'
+        elif author:
+            index = 'author'
+        else:
+            index = 'read_date'
+        if (index == 'rating' and rating is not None) or (index == 'author' and author):
+            sort = 'date'
+
+        def column(name):
+            # Conditions outside that index must not tempt the planner into
+            # searching another index and sorting the result afterwards.
+            if name == index or (name == 'read_date' and sort == 'date'):
+                return F(name)
+            return Unindexed(name)
+
+        if rating is not None:
+            records = records.filter(Exact(column('rating'), rating))
+        if author:
+            records = records.filter(Exact(column('author'), author))
+        if data.get('date_from'):
+            records = records.filter(GreaterThanOrEqual(column('read_date'), data['date_from']))
+        if data.get('date_to'):
+            records = records.filter(LessThanOrEqual(column('read_date'), data['date_to']))
+
+        return records, self.SORT_KEYS[sort]
+
+class SearchForm(forms.Form):
+    q = forms.CharField(
+        label='Запрос',
+        required=False,
+        max_length=200,
+        widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Название, автор или комментарий'})
+    )
+    page = forms.IntegerField(required=False, min_value=1, widget=forms.HiddenInput)
+
+class Unindexed(Func):
+    ''' Unary plus, which tells SQLite not to use an index for the wrapped column. '''
+    template = '+%(expressions)s'
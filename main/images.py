@@ -0,0 +1,89 @@
+''' Normalization of uploaded covers and userpics.
+
+Uploads are bounded to IMAGE_MAX_SIZE, stripped of EXIF and other
+metadata and re-encoded as IMAGE_FORMAT, so every later read, base64
+encode and thumbnail works on a small file. Images over IMAGE_MAX_PIXELS
+are rejected from their header, before any pixel is decoded.
+'''
+
+import os
+from io import BytesIO
+
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, features
+
+from bookshelf.settings import IMAGE_MAX_SIZE, IMAGE_MAX_PIXELS, IMAGE_MAX_UPLOAD_SIZE, IMAGE_FORMAT, IMAGE_QUALITY
+
+FORMAT = IMAGE_FORMAT.upper()
+if FORMAT == 'WEBP' and not features.check('webp'):
+    FORMAT = 'JPEG'
+
+EXTENSIONS = {'WEBP': '.webp', 'JPEG': '.jpg'}
+
+def opened_image(file):
+    ''' Opens an image lazily and checks its size from the header. '''
+
+    if file.size is not None and file.size > IMAGE_MAX_UPLOAD_SIZE:
+        raise ValidationError('Размер изображения не должен превышать %d МБ' % (IMAGE_MAX_UPLOAD_SIZE // 2**20))
+    file.seek(0)
+    try:
+        image = Image.open(file)
+    except (OSError, Image.DecompressionBombError):
+        raise ValidationError('Загрузите корректное изображение')
+    width, height = image.size
+    if width * height > IMAGE_MAX_PIXELS:
+        raise ValidationError('Изображение слишком большое: %d×%d точек' % (width, height))
+    return image
+
+def validate_image(file):
+    # Files already in storage were checked when they were uploaded.
+    if getattr(file, '_committed', True):
+        return
+    opened_image(file)
+    file.seek(0)
+
+def normalized_image(file, name):
+    ''' The image as a ContentFile named after <name>, downscaled and re-encoded. '''
+
+    image = opened_image(file)
+    try:
+        # JPEG decoders can scale by 1/2..1/8 while decoding, much cheaper than a resize afterwards.
+        image.draft(None, IMAGE_MAX_SIZE)
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(IMAGE_MAX_SIZE, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        transparent = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        if FORMAT == 'WEBP' and transparent:
+            image = image.convert('RGBA')
+        elif transparent:
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image.convert('RGBA'), mask=image.convert('RGBA'))
+            image = background
+        else:
+            image = image.convert('RGB')
+
+        # Only options passed to save() are written: EXIF, XMP and comments are left behind.
+        options = {'quality': IMAGE_QUALITY}
+        if FORMAT == 'WEBP':
+            options['method'] = 4
+        else:
+            options.update(optimize=True, progressive=True)
+        buffer = BytesIO()
+        image.save(buffer, FORMAT, **options)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise ValidationError('Не удалось обработать изображение')
+    finally:
+        file.seek(0)
+
+    base = os.path.splitext(os.path.basename(name))[0]
+    content = ContentFile(buffer.getvalue(), name=base + EXTENSIONS[FORMAT])
+    content.normalized = True
+    return content
+
+def normalize_upload(field_file):
+    ''' Swaps a not yet stored upload of an image field for its normalized version. '''
+    if field_file and not field_file._committed and not getattr(field_file.file, 'normalized', False):
+        content = normalized_image(field_file.file, field_file.name)
+        field_file.file = content
+        field_file.name = content.name
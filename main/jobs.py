@@ -0,0 +1,283 @@
+import json, logging
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from random import randint
+
+from django.db import transaction, connections
+from django.core.files.base import ContentFile
+from django.utils import timezone
+
+from .models import ImportJob, ShelfRecord, OrphanedFile
+from .utilities import handle_shelf_file
+from .tracking import RecordChanges, RecordState, record_state
+from bookshelf.settings import BACKGROUND_MODE, BACKGROUND_WORKERS, IMPORT_BATCH_SIZE, IMPORT_MAX_ERRORS
+from bookshelf.settings import MEDIA_CLEANUP_BATCH_SIZE, IMPORT_JOB_STALE_AFTER
+
+logger = logging.getLogger(__name__)
+
+executor = None
+
+STALE_ERROR = 'Загрузка прервалась: обработчик перестал отвечать'
+
+def create_job(kind, owner, source, shelf=None, options=None):
+    ''' Stores the uploaded data and queues it for processing. '''
+
+    job = ImportJob(kind=kind, owner=owner, shelf=shelf, options=options or {})
+    job.source.save(source.name, source, save=False)
+    job.save()
+    enqueue(job.pk)
+    return job
+
+def create_hs_job(owner, incoming_data, options=None):
+    # Raw cover bytes from binary hs formats are stored as base64, which hs.ingest reads as well.
+    content = ContentFile(json.dumps(incoming_data, default=b64_bytes).encode('utf-8'), name='records.json')
+    return create_job(ImportJob.KIND_HS, owner, content, options=options)
+
+def b64_bytes(value):
+    if isinstance(value, (bytes, bytearray)):
+        return b64encode(value).decode('ascii')
+    raise TypeError(f'Object of type {value.__class__.__name__} is not JSON serializable')
+
+def enqueue(job_pk):
+    # In 'queue' mode pending jobs wait for the process_imports command.
+    if BACKGROUND_MODE == 'thread':
+        transaction.on_commit(lambda: submit(run_job, job_pk))
+
+def submit(func, *args):
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix='background')
+    executor.submit(run_in_thread, func, *args)
+
+def run_in_thread(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('Background task %s failed', func.__name__)
+    finally:
+        connections.close_all()
+
+def schedule_media_cleanup():
+    # In 'queue' mode orphaned files wait for the cleanup_media command.
+    if BACKGROUND_MODE == 'thread':
+        transaction.on_commit(lambda: submit(cleanup_media))
+
+def cleanup_media(limit=None):
+    ''' Removes queued orphaned files from storage, batch by batch. '''
+
+    storage = ShelfRecord._meta.get_field('cover').storage
+    count = 0
+    while limit is None or count < limit:
+        batch = list(OrphanedFile.objects.order_by('id').values_list('id', 'name')[:MEDIA_CLEANUP_BATCH_SIZE])
+        if not batch:
+            break
+        for _, name in batch:
+            try:
+                # Thumbnails go with the file; a file shared with remaining rows stays.
+                storage.delete(name)
+            except Exception:
+                logger.exception('Could not delete orphaned file %s', name)
+        OrphanedFile.objects.filter(id__in=[pk for pk, _ in batch]).delete()
+        count += len(batch)
+    return count
+
+def claim(job_pk):
+    ''' Moves a pending job to running; False if another worker got it first. '''
+    now = timezone.now()
+    claimed = ImportJob.objects.filter(pk=job_pk, status=ImportJob.PENDING)\
+        .update(status=ImportJob.RUNNING, started=now, heartbeat=now)
+    return claimed == 1
+
+def fail_stale(jobs):
+    ''' Marks running jobs of <jobs> (a queryset) that stopped reporting progress as failed. '''
+    now = timezone.now()
+    return jobs.filter(status=ImportJob.RUNNING, heartbeat__lt=now - timedelta(seconds=IMPORT_JOB_STALE_AFTER))\
+        .update(status=ImportJob.FAILED, error=STALE_ERROR, finished=now)
+
+def checked(job):
+    ''' <job>, failed first if it stopped reporting progress; for the job status pages. '''
+    if job.status == ImportJob.RUNNING and fail_stale(ImportJob.objects.filter(pk=job.pk)):
+        job.refresh_from_db()
+    return job
+
+def recover_jobs():
+    ''' Picks up the jobs of a process that went down: stale running jobs fail,
+    pending ones are queued again in 'thread' mode (in 'queue' mode drain() finds them).
+
+    Runs when a web process starts (bookshelf.wsgi, bookshelf.asgi); claim()
+    keeps a job queued by two processes from running twice.
+    Returns the numbers of queued and failed jobs.
+    '''
+    failed = fail_stale(ImportJob.objects.all())
+    queued = 0
+    if BACKGROUND_MODE == 'thread':
+        for job_pk in ImportJob.objects.filter(status=ImportJob.PENDING).order_by('created').values_list('pk', flat=True):
+            submit(run_job, job_pk)
+            queued += 1
+    return queued, failed
+
+def recover_on_start():
+    # In 'queue' mode process_imports does it on every pass.
+    if BACKGROUND_MODE == 'thread':
+        submit(recover_jobs)
+
+def run_job(job_pk):
+    if not claim(job_pk):
+        return
+
+    job = ImportJob.objects.select_related('owner', 'shelf').get(pk=job_pk)
+    try:
+        HANDLERS[job.kind](job)
+    except Exception as e:
+        logger.exception('Import job %s failed', job_pk)
+        job.status = ImportJob.FAILED
+        job.error = error_message(e)
+    else:
+        job.status = ImportJob.DONE
+    job.finished = timezone.now()
+    job.save()
+
+    if job.source:
+        job.source.delete(save=True)
+
+def drain(limit=None):
+    ''' Runs pending jobs in the current thread, oldest first. '''
+    pending = ImportJob.objects.filter(status=ImportJob.PENDING).order_by('created').values_list('pk', flat=True)
+    if limit:
+        pending = pending[:limit]
+    count = 0
+    for job_pk in list(pending):
+        run_job(job_pk)
+        count += 1
+    return count
+
+def error_message(e):
+    detail = getattr(e, 'detail', None)
+    if detail is not None:
+        return json.dumps(detail, ensure_ascii=False)
+    return str(e) or e.__class__.__name__
+
+def progress(job, **counters):
+    for name, value in counters.items():
+        setattr(job, name, value)
+    ImportJob.objects.filter(pk=job.pk).update(heartbeat=timezone.now(), **counters)
+
+def process_file(job):
+    with job.source.open('rb') as f:
+        job.result = create_records(handle_shelf_file(f), job.shelf, **job.options,
+                                    progress=lambda **counters: progress(job, **counters))
+
+def process_hs(job):
+    from hs.ingest import ingest
+
+    with job.source.open('rb') as f:
+        incoming_data = json.load(f)
+    job.result = ingest(job.owner, incoming_data, **job.options,
+                        progress=lambda **counters: progress(job, **counters))
+
+def create_records(lines, shelf, on_duplicate=ShelfRecord.DUPLICATES_SKIP, batch_size=IMPORT_BATCH_SIZE, progress=None):
+    ''' Inserts parsed lines in batches, each in its own transaction.
+
+    Only the current batch is kept in memory. A batch is committed before
+    <progress> reports it, so the job counters show how far the import is;
+    if a later batch fails the committed ones stay, and importing the file
+    again with on_duplicate=skip adds only what is missing. Records already
+    on the shelf (same fingerprint) are skipped, updated or added again,
+    depending on <on_duplicate>; that takes an indexed lookup per batch.
+    Returns the import counters and a per-line error report.
+    '''
+
+    counters = {'rows_parsed': 0, 'rows_inserted': 0, 'rows_failed': 0}
+    totals = {'updated': 0, 'skipped': 0}
+    errors = []
+    batch = {}
+
+    def flush():
+        if batch:
+            write_batch(list(batch.values()), shelf, on_duplicate, counters, totals)
+            batch.clear()
+        if progress:
+            progress(**counters)
+
+    for number, element, error in lines:
+        counters['rows_parsed'] += 1
+        if error:
+            counters['rows_failed'] += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({'line': number, 'error': error})
+            continue
+
+        record = ShelfRecord()
+        record.title = element['title']
+        record.author = element['author']
+        record.rating = element['rating']
+        record.read_date = element['read_date']
+        record.shelf = shelf
+        record.random_cover = randint(1, 6)
+        record.update_fingerprint()
+
+        if on_duplicate == ShelfRecord.DUPLICATES_ALLOW:
+            batch[number] = record
+        elif record.fingerprint in batch:
+            if on_duplicate == ShelfRecord.DUPLICATES_UPDATE:
+                batch[record.fingerprint].rating = record.rating
+            else:
+                totals['skipped'] += 1
+        else:
+            batch[record.fingerprint] = record
+
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    result = {
+        'inserted': counters['rows_inserted'],
+        'updated': totals['updated'],
+        'skipped': totals['skipped'],
+        'failed': counters['rows_failed'],
+        'errors': errors,
+    }
+    return result
+
+def write_batch(records, shelf, on_duplicate, counters, totals):
+    ''' Inserts or updates one batch of create_records and commits it with the shelf stats. '''
+
+    now = timezone.now()
+    changes = RecordChanges()
+    with transaction.atomic():
+        if on_duplicate == ShelfRecord.DUPLICATES_ALLOW:
+            existing = {}
+        else:
+            existing = ShelfRecord.fingerprinted(((shelf.pk, record.fingerprint) for record in records),
+                                                 fields=('id', 'rating', 'author'))
+
+        new_records = []
+        changed_records = []
+        for record in records:
+            found = existing.get((shelf.pk, record.fingerprint))
+            if not found:
+                new_records.append(record)
+            elif on_duplicate == ShelfRecord.DUPLICATES_UPDATE:
+                record.pk = found[0]
+                record.updated_at = now
+                changed_records.append(record)
+                stored = RecordState(found[0], shelf.pk, found[1], record.read_date, found[2])
+                changes.updated(stored, stored._replace(rating=record.rating))
+            else:
+                totals['skipped'] += 1
+
+        ShelfRecord.objects.bulk_create(new_records)
+        for record in new_records:
+            changes.added(record_state(record))
+        if changed_records:
+            ShelfRecord.objects.bulk_update(changed_records, ['rating', 'updated_at'])
+        changes.save()
+
+    counters['rows_inserted'] += len(new_records)
+    totals['updated'] += len(changed_records)
+
+HANDLERS = {
+    ImportJob.KIND_FILE: process_file,
+    ImportJob.KIND_HS: process_hs,
+}
@@ -0,0 +1,164 @@
+import asyncio, contextlib, itertools, os, shutil, statistics, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from io import BytesIO
+from unittest import mock
+from urllib.parse import urlencode
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from main.models import BookUser, Shelf, ShelfRecord
+from main.storage import content_storage
+from main.tracking import rebuild_shelf_stats
+from hs.models import ApiToken
+
+class Command(BaseCommand):
+    help = ('Requests/sec and latency of hs shelf requests under concurrent clients: WSGI with a thread per client, '
+            'and ASGI in one event loop with the sync and the async (hs/async/) view. '
+            'Runs on a throwaway test database and media directory.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=50, help='Records on the shelf.')
+        parser.add_argument('--cover-size', type=int, default=30000, help='Bytes per cover file.')
+        parser.add_argument('--covers', default='inline', help='covers option of the requests.')
+        parser.add_argument('--clients', default='1,8,32', help='Comma separated numbers of concurrent clients.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per run.')
+        parser.add_argument('--read-delay', type=float, default=0,
+                            help='Milliseconds added to every image read, as with covers on network storage.')
+        parser.add_argument('--cached', action='store_true',
+                            help='Let the shelf cache answer repeated requests; by default every request builds the payload.')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        media = tempfile.mkdtemp()
+        try:
+            with override_settings(MEDIA_ROOT=media, ALLOWED_HOSTS=['testserver']), slow_reads(options['read_delay']):
+                shelf, key = populate(options['records'], options['cover_size'])
+                self.run(shelf, key, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(media, ignore_errors=True)
+
+    def run(self, shelf, key, options):
+        wsgi, asgi = WSGIHandler(), ASGIHandler()
+        headers = {'authorization': 'Token ' + key, 'host': 'testserver'}
+        # Unique across all runs, the views share their cache keys.
+        numbers = itertools.count()
+
+        def urls(prefix, count):
+            query = {'covers': options['covers']}
+            return [(f'/hs/{prefix}shelf/{shelf.pk}/',
+                     urlencode(query if options['cached'] else dict(query, request=next(numbers))))
+                    for _ in range(count)]
+
+        modes = [
+            ('wsgi', lambda clients, requests: run_wsgi(wsgi, requests, headers, clients), ''),
+            ('asgi sync view', lambda clients, requests: asyncio.run(run_asgi(asgi, requests, headers, clients)), ''),
+            ('asgi async view', lambda clients, requests: asyncio.run(run_asgi(asgi, requests, headers, clients)), 'async/'),
+        ]
+
+        self.stdout.write('%-16s %8s %10s %10s %10s %8s' % ('server', 'clients', 'req/s', 'p50, ms', 'p99, ms', 'errors'))
+        for clients in [int(value) for value in options['clients'].split(',')]:
+            for name, run, prefix in modes:
+                # Warm up: connections, imports, the token cache.
+                run(1, urls(prefix, 2))
+                wall, latencies, errors = run(clients, urls(prefix, options['requests']))
+                latencies.sort()
+                self.stdout.write('%-16s %8d %10.0f %10.1f %10.1f %8d' % (
+                    name, clients, len(latencies) / wall, statistics.median(latencies) * 1000,
+                    latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, errors))
+
+def slow_reads(delay):
+    ''' Delays hs.utilities.represented_image, which the sync and the async views both read images with. '''
+    from hs import utilities, serializers
+
+    represented_image = utilities.represented_image
+
+    def delayed(*args, **kwargs):
+        time.sleep(delay / 1000)
+        return represented_image(*args, **kwargs)
+
+    if not delay:
+        return contextlib.nullcontext()
+    stack = contextlib.ExitStack()
+    for module in (utilities, serializers):
+        stack.enter_context(mock.patch.object(module, 'represented_image', delayed))
+    return stack
+
+def populate(count, cover_size):
+    owner = BookUser.objects.create_user('bench', 'bench@example.com', 'bench')
+    shelf = Shelf.objects.create(name='Bench', owner=owner, private=False)
+    ShelfRecord.objects.bulk_create([
+        ShelfRecord(shelf=shelf, title='Book %d' % i, author='Author %d' % (i % 30), rating=i % 6,
+                    read_date=date(2000, 1, 1) + timedelta(days=i), random_cover=1,
+                    cover=content_storage.save('covers/bench.jpg', BytesIO(os.urandom(cover_size))))
+        for i in range(count)
+    ])
+    rebuild_shelf_stats(Shelf.objects.filter(pk=shelf.pk))
+    return shelf, ApiToken.issue(owner)[1]
+
+def run_wsgi(app, requests, headers, clients):
+    ''' Every client is a thread calling the WSGI application, as in a threaded WSGI server. '''
+
+    def request(url):
+        path, query = url
+        environ = {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+            'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.input': BytesIO(), 'wsgi.url_scheme': 'http', 'wsgi.errors': BytesIO(),
+            'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        }
+        environ.update(('HTTP_' + name.upper().replace('-', '_'), value) for name, value in headers.items())
+        status = []
+        started = time.perf_counter()
+        result = app(environ, lambda status_line, response_headers: status.append(status_line))
+        try:
+            for _ in result:
+                pass
+        finally:
+            result.close()
+        return time.perf_counter() - started, not status[0].startswith('200')
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(request, requests))
+    wall = time.perf_counter() - started
+    return wall, [latency for latency, _ in results], sum(failed for _, failed in results)
+
+async def run_asgi(app, requests, headers, clients):
+    ''' Every client is a coroutine on one event loop, as in a single ASGI server worker. '''
+
+    requests = iter(requests)
+    latencies = []
+    errors = 0
+
+    async def client():
+        nonlocal errors
+        for path, query in requests:
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+                'root_path': '', 'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+                'headers': [(name.encode(), value.encode()) for name, value in headers.items()],
+            }
+            status = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+
+            started = time.perf_counter()
+            await app(scope, receive, send)
+            latencies.append(time.perf_counter() - started)
+            errors += status[0] != 200
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return time.perf_counter() - started, latencies, errors
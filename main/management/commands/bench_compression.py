@@ -0,0 +1,51 @@
+import io
+
+from django.core.management.base import BaseCommand
+from PIL import Image
+from rest_framework.renderers import JSONRenderer
+
+from hs.compression import ENCODINGS, compressed
+from hs.renderers import MessagePackRenderer, msgpack
+from .bench_wire_formats import generate, with_covers, best
+
+LEVELS = {
+    'gzip': (1, 6, 9),
+    'br': (1, 4, 6, 11),
+    'zstd': (1, 3, 9, 19),
+}
+
+class Command(BaseCommand):
+    help = 'Measures bytes on the wire and CPU time of each hs content encoding and level on generated shelves.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=1000, help='Records on the shelf.')
+        parser.add_argument('--covers', type=int, default=300, help='Records with a JPEG cover, each one different.')
+        parser.add_argument('--rounds', type=int, default=3, help='Best of this many runs is reported.')
+
+    def handle(self, *args, **options):
+        records = generate(options['records'], 0)
+        payloads = [('json, no covers', JSONRenderer().render(records))]
+
+        # Distinct covers: repeated ones would let long-window encoders look far better than they are.
+        for i, record in enumerate(records[:options['covers']]):
+            record['cover'] = {'name': 'covers/%d.jpg' % i, 'data': jpeg(i)}
+        payloads.append(('json, covers', JSONRenderer().render(with_covers(records, False))))
+        if msgpack is not None:
+            payloads.append(('msgpack, covers', MessagePackRenderer().render(records)))
+
+        for title, payload in payloads:
+            self.stdout.write('%s: %.2f MB' % (title, len(payload) / 2**20))
+            for encoding in ENCODINGS:
+                for level in LEVELS[encoding]:
+                    size = len(compressed(payload, encoding, level))
+                    elapsed = best(lambda: compressed(payload, encoding, level), options['rounds'])
+                    self.stdout.write('  %-5s %2d %9.1f%% %9.1f ms %8.1f MB/s' % (
+                        encoding, level, size * 100 / len(payload), elapsed, len(payload) / 2**20 / (elapsed / 1000)))
+
+def jpeg(seed):
+    # Noise over a gradient compresses about as badly as a scanned book cover.
+    image = Image.linear_gradient('L').resize((200, 300)).convert('RGB')
+    noise = Image.effect_noise((200, 300), 20 + seed % 40).convert('RGB')
+    buffer = io.BytesIO()
+    Image.blend(image, noise, 0.3).save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
@@ -0,0 +1,63 @@
+import io, os, random, time
+from base64 import b64encode, b64decode
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+
+from hs.renderers import RENDERERS, PARSERS
+
+class Command(BaseCommand):
+    help = 'Compares payload size and encode/decode time of the hs wire formats on a generated shelf.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=1000, help='Records on the shelf.')
+        parser.add_argument('--cover-size', type=int, default=30000, help='Bytes per cover, 0 for none.')
+        parser.add_argument('--rounds', type=int, default=5, help='Best of this many runs is reported.')
+
+    def handle(self, *args, **options):
+        records = generate(options['records'], options['cover_size'])
+        parsers = {parser.media_type: parser() for parser in PARSERS}
+        self.stdout.write('%-8s %10s %12s %12s' % ('format', 'MB', 'encode, ms', 'decode, ms'))
+
+        for renderer_class in RENDERERS:
+            renderer = renderer_class()
+            parser = parsers[renderer.media_type]
+            raw = getattr(renderer, 'raw_covers', False)
+            # Encoding covers to base64 is part of the JSON cost, as in hs.utilities.represented_image.
+            encode = lambda: renderer.render(with_covers(records, raw))
+            payload = encode()
+            decode = lambda: covers_of(parser.parse(io.BytesIO(payload), renderer.media_type), raw)
+            self.stdout.write('%-8s %10.2f %12.1f %12.1f' % (
+                renderer.format, len(payload) / 2**20, best(encode, options['rounds']), best(decode, options['rounds'])))
+
+def generate(count, cover_size):
+    random.seed(0)
+    return [{
+        'id': i + 1,
+        'title': 'Book number %d' % i,
+        'author': 'Author %d' % (i % 300),
+        'comment': 'Comment on book %d' % i if i % 3 else '',
+        'rating': i % 6,
+        'read_date': (date(2000, 1, 1) + timedelta(days=i)).isoformat(),
+        'random_cover': random.randint(1, 6),
+        'cover': {'name': 'covers/%d.jpg' % i, 'data': os.urandom(cover_size)} if cover_size else None,
+    } for i in range(count)]
+
+def with_covers(records, raw):
+    if raw:
+        return records
+    return [dict(record, cover=record['cover'] and {'name': record['cover']['name'],
+                                                    'data': b64encode(record['cover']['data']).decode('ascii')})
+            for record in records]
+
+def covers_of(records, raw):
+    return [record['cover'] and (record['cover']['data'] if raw else b64decode(record['cover']['data']))
+            for record in records]
+
+def best(func, rounds):
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return min(times) * 1000
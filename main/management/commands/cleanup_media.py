@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.jobs import cleanup_media
+from main.storage import content_storage
+from bookshelf.settings import MEDIA_SWEEP_INTERVAL
+
+class Command(BaseCommand):
+    help = 'Removes media files left behind by deleted shelfs and users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new files.')
+        parser.add_argument('--interval', type=float, default=10.0, help='Seconds between polls with --loop.')
+        parser.add_argument('--limit', type=int, default=None, help='Maximum number of files per pass.')
+        parser.add_argument('--sweep', action='store_true',
+                            help='Also look through stored covers and userpics for files no row refers to.')
+        parser.add_argument('--sweep-interval', type=float, default=MEDIA_SWEEP_INTERVAL,
+                            help='Seconds between sweeps with --loop.')
+
+    def handle(self, *args, **options):
+        swept = None
+        while True:
+            # Files deleted within the grace period of main.storage are only removed by a sweep.
+            sweep = options['sweep'] or options['loop']
+            if sweep and (swept is None or time.monotonic() - swept >= options['sweep_interval']):
+                self.sweep()
+                swept = time.monotonic()
+
+            count = cleanup_media(options['limit'])
+            if count:
+                self.stdout.write('Removed %d file(s)' % count)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def sweep(self):
+        for directory in ('covers', 'userpics'):
+            if content_storage.exists(directory):
+                self.stdout.write('%s: swept %d file(s)' % (directory, content_storage.sweep(directory)))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from main.models import Change
+
+class Command(BaseCommand):
+    help = 'Drops sync changelog entries superseded by a later entry for the same object.'
+
+    def handle(self, *args, **options):
+        # Only the latest entry of an object decides what a client gets for any
+        # older token, so the others can go without invalidating tokens.
+        latest = Change.objects.values('owner', 'kind', 'object_id').annotate(last=Max('id')).values('last')
+        count, _ = Change.objects.exclude(id__in=latest).delete()
+        self.stdout.write('Removed %d changelog entries' % count)
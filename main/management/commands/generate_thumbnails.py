@@ -0,0 +1,43 @@
+import os, time
+from functools import partial
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import BookUser, ShelfRecord
+from main.thumbnails import ALIASES, generate_thumbnails, worker_pool
+
+class Command(BaseCommand):
+    help = 'Renders thumbnails of all covers and userpics in parallel, e.g. after THUMBNAIL_ALIASES changed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes.')
+        parser.add_argument('--alias', action='append', dest='aliases', help='Only this alias; may be repeated.')
+        parser.add_argument('--force', action='store_true', help='Render existing thumbnails again.')
+
+    def handle(self, *args, **options):
+        aliases = options['aliases']
+        unknown = set(aliases or ()) - set(ALIASES)
+        if unknown:
+            raise CommandError('Unknown aliases: %s' % ', '.join(sorted(unknown)))
+
+        names = list(ShelfRecord.objects.exclude(cover='').exclude(cover=None).values_list('cover', flat=True))
+        names += BookUser.objects.exclude(userpic='').exclude(userpic=None).values_list('userpic', flat=True)
+
+        started = time.perf_counter()
+        made = failed = 0
+        generate = partial(generate_safely, aliases=aliases, force=options['force'])
+        with worker_pool(max(1, options['workers'])) as pool:
+            for count in pool.map(generate, names, chunksize=16):
+                if count is None:
+                    failed += 1
+                else:
+                    made += count
+        self.stdout.write('%d images, %d thumbnails made, %d failed in %.1f s' % (
+            len(names), made, failed, time.perf_counter() - started))
+
+def generate_safely(name, aliases=None, force=False):
+    # A missing or broken source must not stop the whole run.
+    try:
+        return generate_thumbnails(name, aliases, force)
+    except Exception:
+        return None
@@ -0,0 +1,38 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+
+from main.models import BookUser, ShelfRecord
+from main.images import normalized_image, EXTENSIONS, FORMAT
+
+class Command(BaseCommand):
+    help = 'Re-encodes stored covers and userpics the way new uploads are and reports the bytes saved.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Also files already in the target format.')
+
+    def handle(self, *args, **options):
+        for model, field_name in ((ShelfRecord, 'cover'), (BookUser, 'userpic')):
+            objects = model.objects.exclude(**{field_name: ''}).exclude(**{field_name: None}).order_by('pk')
+            if not options['all']:
+                objects = objects.exclude(**{field_name + '__endswith': EXTENSIONS[FORMAT]})
+
+            count = failed = before = after = 0
+            for instance in objects.iterator():
+                image = getattr(instance, field_name)
+                try:
+                    with image.open('rb') as source:
+                        size = image.size
+                        content = normalized_image(source, image.name)
+                except (ValidationError, OSError):
+                    failed += 1
+                    continue
+                # A regular save: the shelf version, sync log and thumbnails follow,
+                # django_cleanup removes the old file.
+                setattr(instance, field_name, content)
+                instance.save()
+                count += 1
+                before += size
+                after += content.size
+
+            self.stdout.write('%s: %d re-encoded, %d failed, %.1f MB -> %.1f MB' % (
+                model._meta.verbose_name_plural, count, failed, before / 2**20, after / 2**20))
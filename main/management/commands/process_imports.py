@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.jobs import drain, fail_stale
+from main.models import ImportJob
+
+class Command(BaseCommand):
+    help = 'Processes pending import jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new jobs.')
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds between polls with --loop.')
+        parser.add_argument('--limit', type=int, default=None, help='Maximum number of jobs per pass.')
+
+    def handle(self, *args, **options):
+        while True:
+            # Jobs of a worker that went down stay running until they are failed here.
+            failed = fail_stale(ImportJob.objects.all())
+            if failed:
+                self.stdout.write('Failed %d stale import job(s)' % failed)
+            count = drain(options['limit'])
+            if count:
+                self.stdout.write('Processed %d import job(s)' % count)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
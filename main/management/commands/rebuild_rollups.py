@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from main.models import BookUser
+from main.analytics import rebuild_rollups
+
+class Command(BaseCommand):
+    help = 'Recomputes the reading rollups (per month and per author) from the records.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('users', nargs='*', type=int, help='User ids; all users when omitted.')
+        parser.add_argument('--batch-size', type=int, default=100, help='Users rebuilt per transaction.')
+
+    def handle(self, *args, **options):
+        users = BookUser.objects.order_by('id')
+        if options['users']:
+            users = users.filter(pk__in=options['users'])
+
+        ids = list(users.values_list('id', flat=True))
+        for start in range(0, len(ids), options['batch_size']):
+            rebuild_rollups(BookUser.objects.filter(pk__in=ids[start:start + options['batch_size']]))
+        self.stdout.write('Rebuilt rollups of %d user(s)' % len(ids))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from main.search import install_search_index, rebuild_search_index
+
+class Command(BaseCommand):
+    help = 'Creates the full-text search index if needed and refills it from the records.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        if not install_search_index(options['database']):
+            rebuild_search_index(options['database'])
+        self.stdout.write('Search index rebuilt')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Shelf
+from main.tracking import rebuild_shelf_stats
+
+class Command(BaseCommand):
+    help = 'Recomputes record counts, rating sums and last read dates of shelfs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('shelfs', nargs='*', type=int, help='Shelf ids; all shelfs when omitted.')
+
+    def handle(self, *args, **options):
+        shelfs = Shelf.objects.all()
+        if options['shelfs']:
+            shelfs = shelfs.filter(pk__in=options['shelfs'])
+        count = rebuild_shelf_stats(shelfs)
+        self.stdout.write('Rebuilt stats of %d shelf(s)' % count)
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import ShelfRecord
+
+class Command(BaseCommand):
+    help = 'Recomputes ShelfRecord fingerprints, e.g. for records stored before they existed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Recompute every record, not only empty ones.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        records = ShelfRecord.objects.order_by('id').only('id', 'title', 'author', 'read_date', 'fingerprint')
+        if not options['all']:
+            records = records.filter(fingerprint='')
+
+        batch = []
+        count = 0
+        for record in records.iterator(chunk_size=options['batch_size']):
+            record.update_fingerprint()
+            batch.append(record)
+            if len(batch) >= options['batch_size']:
+                count += self.flush(batch)
+        count += self.flush(batch)
+
+        self.stdout.write('Updated %d record(s)' % count)
+
+    def flush(self, batch):
+        with transaction.atomic():
+            ShelfRecord.objects.bulk_update(batch, ['fingerprint'])
+        count = len(batch)
+        batch.clear()
+        return count
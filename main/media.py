@@ -0,0 +1,141 @@
+''' Access-controlled serving of covers, userpics and their thumbnails.
+
+The view answers who may see a file with one query; the bytes are then
+sent by the front server (MEDIA_ACCEL: nginx X-Accel-Redirect to an
+internal location, or X-Sendfile for Apache and lighttpd). Without one,
+FileResponse streams the file with Range support. Stored files never
+change under their name (see main.storage), so responses carry a strong
+ETag and are cached as immutable: private files for a year in the browser,
+public ones for MEDIA_PUBLIC_MAX_AGE, as shared caches keep them too.
+hs clients are authenticated by hs.middleware.MediaTokenMiddleware.
+'''
+
+import mimetypes, os, re
+from urllib.parse import quote
+
+from django.db.models import Q
+from django.http import HttpResponse, FileResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+
+from .models import ShelfRecord, BookUser
+from .storage import content_storage, CONTENT_NAME
+from .thumbnails import thumbnail_source
+from bookshelf.settings import MEDIA_ACCEL, MEDIA_ACCEL_PREFIX, MEDIA_MAX_AGE, MEDIA_PUBLIC_MAX_AGE
+
+PUBLIC = 'public'
+PRIVATE = 'private'
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def media_visibility(user, name):
+    ''' PUBLIC if anyone may see the file, PRIVATE if only <user> (and staff), None if <user> may not. '''
+
+    source = thumbnail_source(name) or name
+    if source.startswith('covers/'):
+        # A stored cover may be shared by records of several shelfs, one visible one is enough.
+        records = ShelfRecord.objects.filter(cover=source)
+        if not user.is_staff:
+            visible = Q(shelf__private=False)
+            if user.is_authenticated:
+                visible |= Q(shelf__owner=user)
+            records = records.filter(visible)
+        private = records.order_by('shelf__private').values_list('shelf__private', flat=True).first()
+        if private is None:
+            return None
+        return PRIVATE if private else PUBLIC
+
+    if source.startswith('userpics/') and user.is_authenticated:
+        if user.userpic.name == source or user.is_staff and BookUser.objects.filter(userpic=source).exists():
+            return PRIVATE
+    return None
+
+def media_etag(name):
+    # Content-addressed names (and thumbnails of them) say what the bytes are, nothing is read from disk.
+    source = thumbnail_source(name) or name
+    if CONTENT_NAME.match(os.path.basename(source)):
+        return '"%s"' % os.path.basename(name).replace('.', '-')
+    stat = os.stat(content_storage.path(name))
+    return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+def byte_range(header, size):
+    ''' (first, last) byte of a single range request, None to send the whole file, False if unsatisfiable. '''
+
+    match = RANGE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        if not int(last):
+            return False
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        return False
+    return first, min(int(last), size - 1) if last else size - 1
+
+class FileRange:
+    ''' Reads <length> bytes of a file from <offset>.
+
+    No fileno() on purpose: a WSGI file_wrapper would sendfile() the file to its end.
+    '''
+
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.file.seek(offset)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+def media_response(request, name, visibility):
+    ''' Response serving the stored file <name>, once the caller has checked access. '''
+
+    path = content_storage.path(name)
+    etag = media_etag(name)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if MEDIA_ACCEL == 'x-accel-redirect':
+            # nginx sends the file, Range included, from an `internal` location.
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = MEDIA_ACCEL_PREFIX + quote(name)
+        elif MEDIA_ACCEL == 'x-sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = path
+        else:
+            response = file_response(request, path, etag, content_type)
+    response['ETag'] = etag
+    max_age = MEDIA_PUBLIC_MAX_AGE if visibility == PUBLIC else MEDIA_MAX_AGE
+    patch_cache_control(response, max_age=max_age, immutable=True, **{visibility: True})
+    return response
+
+def file_response(request, path, etag, content_type):
+    file = open(path, 'rb')
+    size = os.fstat(file.fileno()).st_size
+
+    header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    span = byte_range(header, size) if header and (not if_range or if_range == etag) else None
+
+    if span is False:
+        file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+    elif span:
+        first, last = span
+        response = FileResponse(FileRange(file, first, last - first + 1), status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+        response['Content-Length'] = last - first + 1
+    else:
+        response = FileResponse(file, content_type=content_type)
+    response['Accept-Ranges'] = 'bytes'
+    return response
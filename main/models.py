@@ -1,26 +1,74 @@
-from django.db import models
+from django.db import models, transaction, connections
+from django.db.models import Value, F
 from django.contrib.auth.models import AbstractUser
-from .utilities import get_userpics_upload_path, get_covers_upload_path
+from django.utils import timezone
+from .utilities import get_userpics_upload_path, get_covers_upload_path, get_imports_upload_path
+from .utilities import record_fingerprint
+from .tracking import RecordChanges, RecordState, record_state, log_changes
+from .thumbnails import schedule_thumbnails
+from .images import validate_image, normalize_upload
+from .storage import content_storage
 
 class BookUser(AbstractUser):
     is_activated = models.BooleanField(default=False, verbose_name='Активирован', db_index=True)
-    userpic = models.ImageField(upload_to=get_userpics_upload_path, null=True, blank=True, verbose_name='Аватар')
+    userpic = models.ImageField(upload_to=get_userpics_upload_path, storage=content_storage, db_index=True,
+                                null=True, blank=True, verbose_name='Аватар', validators=[validate_image])
     sex = models.BooleanField(default=True, verbose_name='Пол', choices=[(True, 'Мужской'), (False, 'Женский')])
     email = models.EmailField(verbose_name='Электронная почта', 
                               max_length=254, null=False, blank=False, 
                               unique=True, db_index=True, 
                               error_messages={'unique': 'Пользователь с такой электронной почтой уже существует.'})
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        if 'userpic' in field_names:
+            user._loaded_userpic = user.userpic.name
+        return user
+
+    def save(self, *args, **kwargs):
+        normalize_upload(self.userpic)
+        with transaction.atomic():
+            result = super().save(*args, **kwargs)
+            if 'userpic' not in self.get_deferred_fields() and self.userpic.name != getattr(self, '_loaded_userpic', None):
+                schedule_thumbnails([self.userpic.name])
+                self._loaded_userpic = self.userpic.name
+        return result
+
     def delete(self, *args, **kwargs):
-        for shelf in self.shelf_set.all():
-            shelf.delete()
-        return super().delete(*args, **kwargs)
+        with transaction.atomic():
+            delete_records(ShelfRecord.objects.filter(shelf__owner=self))
+            return super().delete(*args, **kwargs)
+
+class ShelfQuerySet(models.QuerySet):
+
+    def delete(self):
+        # Shelf by shelf through Shelf.delete, so that QuerySet.delete() (the admin's
+        # "delete selected" as well) takes the records out of the stats and logs the deletes.
+        total, counts = 0, {}
+        with transaction.atomic(using=self.db):
+            for shelf in self:
+                deleted, per_model = shelf.delete()
+                total += deleted
+                for label, count in per_model.items():
+                    counts[label] = counts.get(label, 0) + count
+        return total, counts
 
 class Shelf(models.Model):
     name = models.CharField(max_length=20, verbose_name='Название')
     private = models.BooleanField(default=True, verbose_name='Тип полки', 
                                   choices=[(True, 'Частная (видна только Вам)'), (False, 'Открытая (видна всем)')])
     owner = models.ForeignKey(BookUser, on_delete=models.CASCADE, verbose_name='Владелец')
+    record_count = models.PositiveIntegerField(default=0, editable=False, verbose_name='Записей')
+    rating_sum = models.PositiveIntegerField(default=0, editable=False, verbose_name='Сумма оценок')
+    last_read_date = models.DateField(null=True, blank=True, editable=False, verbose_name='Последнее прочтение')
+    version = models.PositiveIntegerField(default=0, editable=False, verbose_name='Версия')
+    updated_at = models.DateTimeField(default=timezone.now, editable=False, verbose_name='Изменена')
+
+    # Maintained by main.tracking with relative updates, never written from an instance.
+    TRACKED = ('record_count', 'rating_sum', 'last_read_date', 'version', 'updated_at')
+
+    objects = ShelfQuerySet.as_manager()
 
     class Meta:
         ordering = ['id']
@@ -29,11 +77,56 @@ class Shelf(models.Model):
 
     def __str__(self):
         return self.name
+
+    @property
+    def average_rating(self):
+        if not self.record_count:
+            return None
+        return self.rating_sum / self.record_count
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            with transaction.atomic():
+                result = super().save(*args, **kwargs)
+                log_changes(Change.SHELF, [(self.owner_id, self.pk, False)])
+            return result
+
+        if kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields 
+                                       if not field.primary_key and field.name not in self.TRACKED]
+        with transaction.atomic():
+            result = super().save(*args, **kwargs)
+            Shelf.objects.filter(pk=self.pk).update(version=F('version') + 1, updated_at=timezone.now())
+            log_changes(Change.SHELF, [(self.owner_id, self.pk, False)])
+        self.refresh_from_db(fields=self.TRACKED)
+        return result
     
     def delete(self, *args, **kwargs):
-        for element in self.shelfrecord_set.all():
-            element.delete()
-        return super().delete(*args, **kwargs)
+        from .analytics import subtract_records
+
+        with transaction.atomic():
+            subtract_records(self.shelfrecord_set.all())
+            delete_records(self.shelfrecord_set.all())
+            # The shelf tombstone stands for its records as well.
+            log_changes(Change.SHELF, [(self.owner_id, self.pk, True)])
+            return super().delete(*args, **kwargs)
+
+class ShelfRecordQuerySet(models.QuerySet):
+
+    def delete(self):
+        ''' Deletes the records set-based (see delete_records) and applies the deletes with main.tracking.
+
+        QuerySet.delete() would bypass ShelfRecord.delete() and leave the shelf
+        stats behind; the admin's "delete selected" calls it as well.
+        '''
+        changes = RecordChanges()
+        with transaction.atomic(using=self.db):
+            records = self.order_by()
+            for state in records.values_list('id', 'shelf_id', 'rating', 'read_date', 'author'):
+                changes.removed(RecordState(*state))
+            deleted = delete_records(records)
+            changes.save()
+        return deleted, {self.model._meta.label: deleted}
 
 class ShelfRecord(models.Model):
     title = models.CharField(max_length=250, verbose_name='Название')
@@ -41,14 +134,249 @@ class ShelfRecord(models.Model):
     comment = models.TextField(verbose_name='Комментарий', default='', blank=True)
     rating = models.SmallIntegerField(default=0, verbose_name='Оценка')
     read_date = models.DateField(db_index=True, verbose_name='Дата')
-    cover = models.ImageField(upload_to=get_covers_upload_path, null=True, blank=True, verbose_name='Обложка')
+    cover = models.ImageField(upload_to=get_covers_upload_path, storage=content_storage, db_index=True,
+                              null=True, blank=True, verbose_name='Обложка', validators=[validate_image])
     shelf = models.ForeignKey(Shelf, on_delete=models.CASCADE, verbose_name='Полка')
     random_cover = models.SmallIntegerField(default=0, verbose_name='Случайная обложка')
+    fingerprint = models.CharField(max_length=40, default='', editable=False, verbose_name='Отпечаток')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменена')
+
+    objects = ShelfRecordQuerySet.as_manager()
+
+    DUPLICATES_SKIP = 'skip'
+    DUPLICATES_UPDATE = 'update'
+    DUPLICATES_ALLOW = 'duplicate'
+    DUPLICATES_CHOICES = [
+        (DUPLICATES_SKIP, 'Пропускать'),
+        (DUPLICATES_UPDATE, 'Обновлять'),
+        (DUPLICATES_ALLOW, 'Добавлять повторно'),
+    ]
     
     class Meta:
-        ordering = ['-read_date']
+        ordering = ['-read_date', '-id']
         verbose_name = 'Элемент полки'
         verbose_name_plural = 'Элементы полки'
+        indexes = [
+            models.Index(fields=['shelf', 'fingerprint'], name='shelfrecord_fingerprint'),
+            models.Index(fields=['shelf', '-read_date', '-id'], name='shelfrecord_shelf_date'),
+            models.Index(fields=['shelf', '-rating', '-read_date', '-id'], name='shelfrecord_shelf_rating'),
+            models.Index(fields=['shelf', 'author', '-read_date', '-id'], name='shelfrecord_shelf_author'),
+        ]
+
+    def __str__(self):
+        return self.title
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        record = super().from_db(db, field_names, values)
+        # Loaded values, so that save() and delete() can adjust the shelf stats.
+        if not record.get_deferred_fields():
+            record._loaded_state = record_state(record)
+        if 'cover' in field_names:
+            record._loaded_cover = record.cover.name
+        return record
+
+    def save(self, *args, **kwargs):
+        self.update_fingerprint()
+        normalize_upload(self.cover)
+        changes = RecordChanges()
+        with transaction.atomic():
+            if self._state.adding:
+                old = None
+            else:
+                old = getattr(self, '_loaded_state', None) or self.stored_state()
+            result = super().save(*args, **kwargs)
+            if old is None:
+                changes.added(record_state(self))
+            else:
+                changes.updated(old, record_state(self))
+            changes.save()
+            if 'cover' not in self.get_deferred_fields() and self.cover.name != getattr(self, '_loaded_cover', None):
+                schedule_thumbnails([self.cover.name])
+                self._loaded_cover = self.cover.name
+        self._loaded_state = record_state(self)
+        return result
+
+    def delete(self, *args, **kwargs):
+        changes = RecordChanges()
+        with transaction.atomic():
+            old = getattr(self, '_loaded_state', None) or self.stored_state()
+            result = super().delete(*args, **kwargs)
+            if old is not None:
+                changes.removed(old)
+                changes.save()
+        return result
+
+    def stored_state(self):
+        stored = ShelfRecord.objects.filter(pk=self.pk).values_list('id', 'shelf_id', 'rating', 'read_date', 'author').first()
+        return stored and RecordState(*stored)
+
+    def update_fingerprint(self):
+        self.fingerprint = record_fingerprint(self.title, self.author, self.read_date)
+
+    @classmethod
+    def fingerprinted(cls, keys, fields=('id',)):
+        ''' Maps (shelf id, fingerprint) pairs to (id, ...) of existing records.
+
+        One indexed query per shelf, split where the fingerprints would go
+        over the query parameter limit of the database (999 on older SQLite).
+        '''
+        by_shelf = {}
+        for shelf_id, fingerprint in set(keys):
+            by_shelf.setdefault(shelf_id, []).append(fingerprint)
+        limit = connections[cls.objects.db].features.max_query_params
+
+        result = {}
+        for shelf_id, fingerprints in by_shelf.items():
+            size = limit - 1 if limit else len(fingerprints)
+            for start in range(0, len(fingerprints), size):
+                rows = cls.objects.filter(shelf_id=shelf_id, fingerprint__in=fingerprints[start:start + size])\
+                    .order_by('id').values_list('fingerprint', *fields)
+                for fingerprint, *values in rows:
+                    result.setdefault((shelf_id, fingerprint), tuple(values))
+        return result
+
+class ImportJob(models.Model):
+    KIND_FILE = 'file'
+    KIND_HS = 'hs'
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    kind = models.CharField(max_length=10, verbose_name='Тип', 
+                            choices=[(KIND_FILE, 'Файл'), (KIND_HS, 'http-сервис')])
+    status = models.CharField(max_length=10, default=PENDING, db_index=True, verbose_name='Состояние',
+                              choices=[(PENDING, 'В очереди'), (RUNNING, 'Выполняется'), 
+                                       (DONE, 'Завершен'), (FAILED, 'Ошибка')])
+    owner = models.ForeignKey(BookUser, on_delete=models.CASCADE, verbose_name='Владелец')
+    shelf = models.ForeignKey(Shelf, on_delete=models.CASCADE, null=True, blank=True, verbose_name='Полка')
+    source = models.FileField(upload_to=get_imports_upload_path, null=True, blank=True, verbose_name='Данные')
+    rows_parsed = models.PositiveIntegerField(default=0, verbose_name='Прочитано')
+    rows_inserted = models.PositiveIntegerField(default=0, verbose_name='Добавлено')
+    rows_failed = models.PositiveIntegerField(default=0, verbose_name='Ошибок')
+    result = models.JSONField(default=dict, blank=True, verbose_name='Результат')
+    error = models.TextField(default='', blank=True, verbose_name='Ошибка')
+    options = models.JSONField(default=dict, blank=True, verbose_name='Параметры')
+    created = models.DateTimeField(auto_now_add=True, verbose_name='Создан')
+    started = models.DateTimeField(null=True, blank=True, verbose_name='Начат')
+    finished = models.DateTimeField(null=True, blank=True, verbose_name='Завершен')
+    heartbeat = models.DateTimeField(null=True, blank=True, verbose_name='Последняя активность')
+
+    class Meta:
+        ordering = ['-created']
+        verbose_name = 'Загрузка'
+        verbose_name_plural = 'Загрузки'
 
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return '%s #%s' % (self.get_kind_display(), self.pk)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+class MonthlyRollup(models.Model):
+    ''' Records of one user read in one month with one rating, kept by main.analytics. '''
+    owner = models.ForeignKey(BookUser, on_delete=models.CASCADE, verbose_name='Читатель')
+    year = models.SmallIntegerField(verbose_name='Год')
+    month = models.SmallIntegerField(verbose_name='Месяц')
+    rating = models.SmallIntegerField(verbose_name='Оценка')
+    record_count = models.IntegerField(default=0, verbose_name='Записей')
+
+    class Meta:
+        verbose_name = 'Статистика за месяц'
+        verbose_name_plural = 'Статистика по месяцам'
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'year', 'month', 'rating'], name='monthlyrollup_key'),
+        ]
+
+class AuthorRollup(models.Model):
+    ''' Records of one user by one author, kept by main.analytics. '''
+    owner = models.ForeignKey(BookUser, on_delete=models.CASCADE, verbose_name='Читатель')
+    author = models.CharField(max_length=250, verbose_name='Автор')
+    record_count = models.IntegerField(default=0, verbose_name='Записей')
+    rating_sum = models.IntegerField(default=0, verbose_name='Сумма оценок')
+
+    class Meta:
+        verbose_name = 'Статистика по автору'
+        verbose_name_plural = 'Статистика по авторам'
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'author'], name='authorrollup_key'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', '-record_count', 'author'], name='authorrollup_top'),
+        ]
+
+    @property
+    def average_rating(self):
+        if not self.record_count:
+            return None
+        return self.rating_sum / self.record_count
+
+class Change(models.Model):
+    ''' Sync changelog entry; its id is the token clients pass to hs/changes/. '''
+    SHELF = 'shelf'
+    RECORD = 'record'
+
+    owner = models.ForeignKey(BookUser, on_delete=models.CASCADE, db_index=False, verbose_name='Владелец')
+    kind = models.CharField(max_length=10, verbose_name='Тип', choices=[(SHELF, 'Полка'), (RECORD, 'Запись')])
+    object_id = models.BigIntegerField(verbose_name='Объект')
+    deleted = models.BooleanField(default=False, verbose_name='Удален')
+    created = models.DateTimeField(default=timezone.now, verbose_name='Создано')
+
+    class Meta:
+        ordering = ['id']
+        verbose_name = 'Изменение'
+        verbose_name_plural = 'Изменения'
+        indexes = [
+            models.Index(fields=['owner', 'id'], name='change_owner_token'),
+            models.Index(fields=['owner', 'kind', 'object_id'], name='change_owner_object'),
+        ]
+
+class OrphanedFile(models.Model):
+    name = models.CharField(max_length=255, verbose_name='Файл')
+    created = models.DateTimeField(verbose_name='Добавлен')
+
+    class Meta:
+        ordering = ['id']
+        verbose_name = 'Файл к удалению'
+        verbose_name_plural = 'Файлы к удалению'
+
+    def __str__(self):
+        return self.name
+
+def delete_records(records):
+    ''' Deletes records with two statements, whatever their number.
+
+    Cover names are copied into the OrphanedFile queue by INSERT ... SELECT
+    and the files are removed later in the background (main.jobs.cleanup_media).
+    '''
+
+    # Deleted by plain SQL on purpose: with django_cleanup's post_delete
+    # handler registered, QuerySet.delete() would load every record and
+    # unlink its cover inside the request (and ShelfRecordQuerySet.delete
+    # comes back here). Nothing else refers to ShelfRecord, so there is
+    # nothing to cascade.
+    from .jobs import schedule_media_cleanup
+
+    records = records.order_by()
+    covers = records.exclude(cover__isnull=True).exclude(cover='')\
+        .annotate(queued=Value(timezone.now(), output_field=models.DateTimeField()))\
+        .values_list('cover', 'queued')
+    sql, params = covers.query.sql_with_params()
+    ids_sql, ids_params = records.values('pk').query.sql_with_params()
+    connection = connections[records.db]
+    table = connection.ops.quote_name(OrphanedFile._meta.db_table)
+    records_table = connection.ops.quote_name(ShelfRecord._meta.db_table)
+    pk = connection.ops.quote_name(ShelfRecord._meta.pk.column)
+
+    with transaction.atomic(using=records.db):
+        with connection.cursor() as cursor:
+            cursor.execute(f'INSERT INTO {table} (name, created) {sql}', params)
+            queued = cursor.rowcount
+            cursor.execute(f'DELETE FROM {records_table} WHERE {pk} IN ({ids_sql})', ids_params)
+            deleted = cursor.rowcount
+        if queued:
+            schedule_media_cleanup()
+    return deleted
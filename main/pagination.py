@@ -0,0 +1,129 @@
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from django.db.models import Q
+
+from bookshelf.settings import PAGINATION_ESTIMATE_LIMIT
+
+class InvalidCursor(ValueError):
+    pass
+
+class KeysetPage:
+
+    def __init__(self, object_list, next_cursor, previous_cursor, count=None, count_is_estimate=False):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.count = count
+        self.count_is_estimate = count_is_estimate
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+class KeysetPaginator:
+    ''' Cursor pagination over a unique ordering, e.g. ('-read_date', '-id').
+
+    Every page is a single indexed range query, no matter how deep it is.
+    Cursors are opaque strings; the special cursor LAST opens the last page.
+    '''
+
+    LAST = 'last'
+
+    def __init__(self, queryset, per_page, keys=('-read_date', '-id')):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.keys = [(key.lstrip('-'), key.startswith('-')) for key in keys]
+
+    def get_page(self, cursor=None, count='none'):
+        if cursor == self.LAST:
+            direction, values = 'prev', None
+        elif cursor:
+            direction, values = self.decode(cursor)
+        else:
+            direction, values = 'next', None
+
+        backwards = (direction == 'prev')
+        queryset = self.queryset.order_by(*self.ordering(backwards))
+        if values is not None:
+            queryset = queryset.filter(self.after(values, backwards))
+
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if backwards:
+            object_list.reverse()
+
+        if backwards:
+            has_next, has_previous = (cursor != self.LAST), has_more
+        else:
+            has_next, has_previous = has_more, (values is not None)
+
+        next_cursor = None
+        previous_cursor = None
+        if object_list:
+            if has_next:
+                next_cursor = self.encode('next', object_list[-1])
+            if has_previous:
+                previous_cursor = self.encode('prev', object_list[0])
+
+        total, is_estimate = self.count(count)
+        return KeysetPage(object_list, next_cursor, previous_cursor, total, is_estimate)
+
+    def count(self, mode):
+        if mode == 'exact':
+            return self.queryset.count(), False
+        elif mode == 'estimate':
+            # Counting stops at the limit, so the cost does not grow with the shelf.
+            total = self.queryset.order_by()[:PAGINATION_ESTIMATE_LIMIT].count()
+            return total, total >= PAGINATION_ESTIMATE_LIMIT
+        return None, False
+
+    def ordering(self, backwards):
+        result = []
+        for name, descending in self.keys:
+            if descending != backwards:
+                result.append('-' + name)
+            else:
+                result.append(name)
+        return result
+
+    def after(self, values, backwards):
+        ''' Rows strictly past <values> in the direction of travel. '''
+        condition = Q()
+        equal = {}
+        for (name, descending), value in zip(self.keys, values):
+            lookup = 'lt' if descending != backwards else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+
+        # The redundant bound on the first key lets the database seek the index
+        # instead of scanning it from the start and filtering the OR-ed terms.
+        name, descending = self.keys[0]
+        lookup = 'lte' if descending != backwards else 'gte'
+        return Q(**{f'{name}__{lookup}': values[0]}) & condition
+
+    def encode(self, direction, obj):
+        raw = json.dumps([direction] + [self.field(name).value_to_string(obj) for name, _ in self.keys])
+        return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def decode(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            raw = json.loads(urlsafe_b64decode(padded.encode('ascii')))
+            direction, values = raw[0], raw[1:]
+            if direction not in ('next', 'prev') or len(values) != len(self.keys):
+                raise InvalidCursor(cursor)
+            values = [self.field(name).to_python(value) for (name, _), value in zip(self.keys, values)]
+        except InvalidCursor:
+            raise
+        except Exception:
+            raise InvalidCursor(cursor)
+        return direction, values
+
+    def field(self, name):
+        return self.queryset.model._meta.get_field(name)
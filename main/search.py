@@ -0,0 +1,117 @@
+import re
+
+from django.db import connections, router
+
+from .models import ShelfRecord, Shelf
+
+FTS_TABLE = 'main_shelfrecord_fts'
+
+# Column weights for bm25(): a hit in the title counts more than one in the comment.
+FTS_WEIGHTS = (10.0, 5.0, 1.0)
+
+TERM = re.compile(r'\w+', re.UNICODE)
+
+def install_search_index(using='default'):
+    ''' Creates the FTS5 index over ShelfRecord title, author and comment.
+
+    The index stores no text of its own (external content), triggers keep
+    it in step with every write, including bulk and raw deletes. SQLite
+    drops the triggers whenever a migration remakes the records table, so
+    missing ones are created again (this runs after every migrate). Returns
+    True if the index or a trigger was created and the index refilled from
+    the records.
+    '''
+
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return False
+
+    qn = connection.ops.quote_name
+    fts, records = qn(FTS_TABLE), qn(ShelfRecord._meta.db_table)
+    statements = {
+        FTS_TABLE: f'''CREATE VIRTUAL TABLE {fts} USING fts5(
+            title, author, comment,
+            content={records}, content_rowid='id', prefix='2 3',
+            tokenize='unicode61 remove_diacritics 2')''',
+        FTS_TABLE + '_ai': f'''CREATE TRIGGER {qn(FTS_TABLE + '_ai')} AFTER INSERT ON {records} BEGIN
+            INSERT INTO {fts} (rowid, title, author, comment) VALUES (new.id, new.title, new.author, new.comment);
+        END''',
+        FTS_TABLE + '_ad': f'''CREATE TRIGGER {qn(FTS_TABLE + '_ad')} AFTER DELETE ON {records} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, title, author, comment)
+            VALUES ('delete', old.id, old.title, old.author, old.comment);
+        END''',
+        FTS_TABLE + '_au': f'''CREATE TRIGGER {qn(FTS_TABLE + '_au')} AFTER UPDATE OF title, author, comment ON {records} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, title, author, comment)
+            VALUES ('delete', old.id, old.title, old.author, old.comment);
+            INSERT INTO {fts} (rowid, title, author, comment) VALUES (new.id, new.title, new.author, new.comment);
+        END''',
+    }
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger') AND name IN (%s, %s, %s, %s)",
+                       list(statements))
+        existing = {name for name, in cursor.fetchall()}
+        missing = [name for name in statements if name not in existing]
+        if not missing:
+            return False
+        for name in missing:
+            cursor.execute(statements[name])
+    rebuild_search_index(using)
+    return True
+
+def rebuild_search_index(using='default'):
+    connection = connections[using]
+    fts = connection.ops.quote_name(FTS_TABLE)
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+def match_expression(query):
+    ''' Turns user input into an FTS5 query: every word must match, as a prefix. '''
+    terms = TERM.findall(query)
+    return ' '.join('"%s"*' % term for term in terms)
+
+def search_records(query, user=None, shelf=None, limit=20, offset=0):
+    ''' Ranked records matching <query> on shelfs visible to <user>.
+
+    Returns a list of ShelfRecord with the shelf selected, best match first,
+    and whether there are more results past <limit>.
+    '''
+
+    expression = match_expression(query)
+    if not expression:
+        return [], False
+
+    using = router.db_for_read(ShelfRecord)
+    qn = connections[using].ops.quote_name
+    fts = qn(FTS_TABLE)
+    records = qn(ShelfRecord._meta.db_table)
+    shelfs = qn(Shelf._meta.db_table)
+
+    conditions = [f'{fts} MATCH %s']
+    params = [expression]
+    if shelf is not None:
+        conditions.append('r.shelf_id = %s')
+        params.append(shelf.pk)
+    if user is not None and user.is_authenticated:
+        conditions.append('(s.private = %s OR s.owner_id = %s)')
+        params += [False, user.pk]
+    else:
+        conditions.append('s.private = %s')
+        params.append(False)
+
+    weights = ', '.join(str(weight) for weight in FTS_WEIGHTS)
+    sql = f'''SELECT r.id FROM {fts}
+        JOIN {records} r ON r.id = {fts}.rowid
+        JOIN {shelfs} s ON s.id = r.shelf_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY bm25({fts}, {weights}), r.id
+        LIMIT %s OFFSET %s'''
+    params += [limit + 1, offset]
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        ids = [row[0] for row in cursor.fetchall()]
+
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    found = ShelfRecord.objects.select_related('shelf').in_bulk(ids)
+    return [found[pk] for pk in ids if pk in found], has_more
@@ -0,0 +1,165 @@
+''' Content-addressed storage of covers and userpics.
+
+A file is stored as <directory>/ab/cd/<sha256 of the content><extension>:
+the same content always gets the same name, a second upload of it writes
+nothing, and a name never points to other content, so its URL can be
+cached forever. The two fan-out levels keep directories small.
+
+A stored file may be shared by any number of rows. delete() removes it
+only when no FileField on the storage refers to it any more (one indexed
+lookup per field), so django_cleanup and the OrphanedFile queue can go on
+deleting names as if every row had its own file.
+'''
+
+import hashlib, os, re, tempfile, time
+from contextlib import suppress
+
+from django.apps import apps
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db.models import FileField
+
+from .thumbnails import delete_thumbnails, replace_file, TEMP_PREFIX
+from bookshelf.settings import MEDIA_DEDUP_GRACE
+
+FAN_OUT = re.compile(r'^[0-9a-f]{2}$')
+CONTENT_NAME = re.compile(r'^[0-9a-f]{64}(\.\w+)?$')
+
+def content_name(name, content):
+    ''' <name> with the base name replaced by the digest of <content>, under two fan-out directories. '''
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    digest = digest.hexdigest()
+    directory, base = os.path.split(name)
+    extension = os.path.splitext(base)[1].lower()
+    return '/'.join(part for part in (directory, digest[:2], digest[2:4], digest + extension) if part)
+
+def content_digest(name):
+    ''' The sha256 of the file stored under <name>, taken from the name; None for names stored before. '''
+    base = os.path.basename(name)
+    if CONTENT_NAME.match(base):
+        return os.path.splitext(base)[0]
+    return None
+
+def modified_within_grace(path):
+    try:
+        return time.time() - os.path.getmtime(path) < MEDIA_DEDUP_GRACE
+    except FileNotFoundError:
+        return False
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        return super().save(content_name(name, content), content, max_length=max_length)
+
+    def get_available_name(self, name, max_length=None):
+        # A file already stored under the name has the same content and is reused.
+        if max_length is not None and len(name) > max_length:
+            raise SuspiciousFileOperation(f'Storage can not find an available filename for "{name}".')
+        return name
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        try:
+            # Touched, so that a delete() racing with the commit of this upload leaves it alone.
+            os.utime(full_path)
+            return name
+        except FileNotFoundError:
+            # Not stored yet, or just moved aside by delete(): written below.
+            pass
+
+        directory = os.path.dirname(full_path)
+        if self.directory_permissions_mode is not None:
+            old_umask = os.umask(0o777 & ~self.directory_permissions_mode)
+            try:
+                os.makedirs(directory, self.directory_permissions_mode, exist_ok=True)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+        # A concurrent upload of the same content writes the same bytes.
+        replace_file(full_path, content.chunks(), self.file_permissions_mode or 0o644)
+        return name
+
+    def delete(self, name):
+        ''' Removes the file and its thumbnails, unless a row still refers to it or it was stored just now.
+
+        A file written or reused within MEDIA_DEDUP_GRACE seconds may belong to
+        a transaction that has not committed yet; it is left to sweep().
+        '''
+        if not name or self.referenced([name]) or self.recent(name):
+            return
+        if self.unlink(name):
+            delete_thumbnails(name)
+
+    def unlink(self, name):
+        ''' Removes the file unless an upload reuses it meanwhile; True if it was removed.
+
+        The file is first moved aside in one rename. An upload of the same
+        content after the rename stores the file again, one that touched it
+        before shows in the mtime of the moved file, which is then put back.
+        '''
+        path = self.path(name)
+        fd, aside = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TEMP_PREFIX)
+        os.close(fd)
+        try:
+            os.replace(path, aside)
+        except FileNotFoundError:
+            os.remove(aside)
+            return False
+        if modified_within_grace(aside):
+            os.replace(aside, path)
+            return False
+        # sweep() may have taken it already.
+        with suppress(FileNotFoundError):
+            os.remove(aside)
+        return True
+
+    def recent(self, name):
+        return modified_within_grace(self.path(name))
+
+    def fields(self):
+        return [(model, field.name) for model in apps.get_models() for field in model._meta.get_fields()
+                if isinstance(field, FileField) and field.storage is self]
+
+    def referenced(self, names):
+        ''' Those of <names> some row refers to. '''
+        found = set()
+        for model, field_name in self.fields():
+            found.update(model._base_manager.filter(**{field_name + '__in': names})
+                         .values_list(field_name, flat=True).distinct())
+        return found
+
+    def sweep(self, directory):
+        ''' Deletes the files under <directory> no row refers to, one fan-out directory at a time.
+
+        They are left by deletes that fell into the grace period and by
+        uploads whose transaction rolled back. Returns how many were removed.
+        '''
+        count = 0
+        for first in filter(FAN_OUT.match, self.listdir(directory)[0]):
+            for second in filter(FAN_OUT.match, self.listdir(f'{directory}/{first}')[0]):
+                path = f'{directory}/{first}/{second}'
+                files = self.listdir(path)[1]
+                names = [f'{path}/{file}' for file in files if CONTENT_NAME.match(file)]
+                referenced = self.referenced(names) if names else set()
+                for name in names:
+                    if name not in referenced and not self.recent(name) and self.unlink(name):
+                        delete_thumbnails(name)
+                        count += 1
+                # Left by interrupted uploads.
+                for file in files:
+                    name = f'{path}/{file}'
+                    if file.startswith(TEMP_PREFIX) and not self.recent(name):
+                        super().delete(name)
+        return count
+
+content_storage = ContentAddressedStorage()
@@ -1,8 +1,29 @@
 from django import template
 
+from main.thumbnails import thumbnail_url
+
 register = template.Library()
 
 @register.filter
 def addstr(arg1, arg2):
     """concatenate arg1 & arg2"""
-    return str(arg1) + str(arg2)
\ No newline at end of file
+    return str(arg1) + str(arg2)
+
+@register.filter
+def pluralize_ru(number, forms):
+    """pick one of 'книга,книги,книг' for number"""
+    one, few, many = forms.split(',')
+    number = abs(int(number))
+    if number % 10 == 1 and number % 100 != 11:
+        return one
+    if 2 <= number % 10 <= 4 and not 12 <= number % 100 <= 14:
+        return few
+    return many
+
+@register.filter
+def thumb(image, alias):
+    """url of a thumbnail made when the image was saved, without touching storage"""
+    name = getattr(image, 'name', None)
+    if not name:
+        return ''
+    return thumbnail_url(name, alias)
@@ -1,3 +1,1050 @@
-from django.test import TestCase
+import datetime, hashlib, json, os, shutil, struct, tempfile, time, zlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models, transaction
+from django.template import Template, Context
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from .forms import RecordListForm
+from .images import normalized_image
+from .models import BookUser, Shelf, ShelfRecord, ImportJob, OrphanedFile, delete_records
+from .jobs import recover_jobs, checked, create_records, progress, cleanup_media, STALE_ERROR
+from .pagination import KeysetPaginator
+from .search import search_records, install_search_index
+from .storage import content_storage, content_digest
+from .utilities import handle_shelf_file, parsed_line, parsed_read_date
+from .thumbnails import ALIASES, thumbnail_name, thumbnail_source, generate_thumbnails, ensure_thumbnail
+from .tracking import rebuild_shelf_stats
+from .analytics import rebuild_rollups
+from .models import MonthlyRollup, AuthorRollup
+from hs.authentication import tokens
+from hs.models import ApiToken
+
+class ShelfRecordListingPlanTest(TestCase):
+    ''' Every sort/filter option of shelf listings has to be served by an index, without a temp B-tree sort. '''
+
+    OPTIONS = [
+        {},
+        {'sort': 'rating'},
+        {'sort': 'author'},
+        {'rating': '3'},
+        {'author': 'Author 1'},
+        {'date_from': '2020-02-01', 'date_to': '2020-05-01'},
+        {'sort': 'rating', 'rating': '2'},
+        {'sort': 'rating', 'author': 'Author 1'},
+        {'sort': 'rating', 'date_from': '2020-02-01'},
+        {'sort': 'author', 'author': 'Author 2'},
+        {'sort': 'author', 'rating': '3'},
+        {'sort': 'author', 'date_to': '2020-03-01'},
+        {'rating': '4', 'author': 'Author 1', 'date_from': '2020-03-01'},
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        cls.shelf = Shelf.objects.create(name='Shelf', owner=owner)
+        ShelfRecord.objects.bulk_create([
+            ShelfRecord(
+                title='Book %d' % i,
+                author='Author %d' % (i % 3),
+                rating=i % 6,
+                read_date=datetime.date(2020, 1, 1) + datetime.timedelta(days=i * 7),
+                shelf=cls.shelf,
+            )
+            for i in range(40)
+        ])
+
+    def assertIndexedPlan(self, queryset):
+        plan = queryset.explain()
+        self.assertNotIn('TEMP B-TREE', plan)
+        self.assertIn('USING INDEX shelfrecord_shelf_', plan)
+
+    def test_listing_pages_use_an_index(self):
+        for options in self.OPTIONS:
+            with self.subTest(**options):
+                form = RecordListForm(options)
+                records, keys = form.apply(ShelfRecord.objects.filter(shelf=self.shelf))
+                paginator = KeysetPaginator(records, 2, keys)
+                first_page = paginator.get_page()
+                self.assertTrue(first_page.has_next)
+
+                for backwards, cursor in ((False, None), (False, first_page.next_cursor), (True, None)):
+                    queryset = records.order_by(*paginator.ordering(backwards))
+                    if cursor:
+                        queryset = queryset.filter(paginator.after(paginator.decode(cursor)[1], backwards))
+                    self.assertIndexedPlan(queryset[:3])
+
+    def test_listing_pages_follow_the_order(self):
+        for options in self.OPTIONS:
+            with self.subTest(**options):
+                form = RecordListForm(options)
+                records, keys = form.apply(ShelfRecord.objects.filter(shelf=self.shelf))
+                paginator = KeysetPaginator(records, 2, keys)
+
+                ids = []
+                cursor = None
+                while True:
+                    page = paginator.get_page(cursor)
+                    ids += [record.id for record in page.object_list]
+                    if not page.has_next:
+                        break
+                    cursor = page.next_cursor
+
+                self.assertEqual(ids, list(records.order_by(*keys).values_list('id', flat=True)))
+
+class ShelfRecordSearchTest(TestCase):
+    ''' The full-text index follows record writes and search respects private shelfs. '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        cls.other = BookUser.objects.create_user('guest', 'guest@example.com', 'password')
+        public = Shelf.objects.create(name='Public', owner=cls.owner, private=False)
+        private = Shelf.objects.create(name='Private', owner=cls.owner, private=True)
+        ShelfRecord.objects.create(title='Война и мир', author='Лев Толстой', read_date=datetime.date(2020, 1, 1),
+                                   shelf=public)
+        ShelfRecord.objects.create(title='Анна Каренина', author='Лев Толстой', comment='Перечитать',
+                                   read_date=datetime.date(2020, 2, 1), shelf=private)
+
+    def titles(self, query, user=None):
+        return {record.title for record in search_records(query, user)[0]}
+
+    def test_prefix_search_respects_private_shelfs(self):
+        self.assertEqual(self.titles('толст', self.owner), {'Война и мир', 'Анна Каренина'})
+        self.assertEqual(self.titles('толст', self.other), {'Война и мир'})
+        self.assertEqual(self.titles('толст'), {'Война и мир'})
+        self.assertEqual(self.titles('перечит', self.owner), {'Анна Каренина'})
+
+    def test_index_follows_writes(self):
+        record = ShelfRecord.objects.get(title='Война и мир')
+        record.title = 'Воскресение'
+        record.save()
+        self.assertEqual(self.titles('война', self.owner), set())
+        self.assertEqual(self.titles('воскрес', self.owner), {'Воскресение'})
+
+        record.delete()
+        self.assertEqual(self.titles('воскрес', self.owner), set())
+
+class SearchIndexInstallTest(TransactionTestCase):
+    ''' install_search_index() puts back triggers a migration dropped and refills the index. '''
+
+    def triggers(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s",
+                           [ShelfRecord._meta.db_table])
+            return sorted(name for name, in cursor.fetchall())
+
+    def titles(self, query, user):
+        return {record.title for record in search_records(query, user)[0]}
+
+    def remove_field(self, field):
+        with connection.schema_editor() as editor:
+            editor.remove_field(ShelfRecord, field)
+
+    def test_missing_triggers_are_installed_again(self):
+        owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        shelf = Shelf.objects.create(name='Shelf', owner=owner)
+        record = ShelfRecord.objects.create(title='Война и мир', author='Лев Толстой',
+                                            read_date=datetime.date(2020, 1, 1), shelf=shelf)
+        installed = self.triggers()
+        self.assertEqual(len(installed), 3)
+
+        # Adding a field makes SQLite remake the records table, which drops its triggers.
+        field = models.CharField(max_length=10, default='')
+        field.set_attributes_from_name('extra')
+        with connection.schema_editor() as editor:
+            editor.add_field(ShelfRecord, field)
+        self.addCleanup(install_search_index)
+        self.addCleanup(self.remove_field, field)
+        self.assertEqual(self.triggers(), [])
+
+        ShelfRecord.objects.filter(pk=record.pk).update(title='Воскресение')
+        self.assertTrue(install_search_index())
+        self.assertEqual(self.triggers(), installed)
+        self.assertEqual(self.titles('воскрес', owner), {'Воскресение'})
+        self.assertEqual(self.titles('война', owner), set())
+        self.assertFalse(install_search_index())
+
+        record.refresh_from_db()
+        record.title = 'Анна Каренина'
+        record.save()
+        self.assertEqual(self.titles('каренин', owner), {'Анна Каренина'})
+
+class ContentStorageTest(TestCase):
+    ''' Identical uploads share one file, which stays until no row refers to it. '''
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        # Files are only a moment old here, the grace period would keep them all.
+        grace = mock.patch('main.storage.MEDIA_DEDUP_GRACE', 0)
+        grace.start()
+        self.addCleanup(grace.stop)
+
+    def test_identical_content_is_stored_once(self):
+        name = content_storage.save('covers/a.webp', ContentFile(b'cover'))
+        self.assertRegex(name, r'^covers/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.webp$')
+        self.assertEqual(content_storage.save('covers/b.WEBP', ContentFile(b'cover')), name)
+        self.assertNotEqual(content_storage.save('covers/a.webp', ContentFile(b'other')), name)
+
+    def test_digest_is_read_from_the_name(self):
+        name = content_storage.save('covers/a.webp', ContentFile(b'cover'))
+        self.assertEqual(content_digest(name), hashlib.sha256(b'cover').hexdigest())
+        self.assertIsNone(content_digest('covers/a_x7Kq2.webp'))
+
+    def test_shared_file_outlives_its_first_row(self):
+        name = content_storage.save('covers/a.webp', ContentFile(b'cover'))
+        owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        shelf = Shelf.objects.create(name='Shelf', owner=owner)
+        first, second = [ShelfRecord.objects.create(title=title, author='Author', read_date=datetime.date(2020, 1, 1),
+                                                    shelf=shelf, cover=name) for title in ('First', 'Second')]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(content_storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(content_storage.exists(name))
+
+    def test_recent_files_wait_for_a_sweep(self):
+        with mock.patch('main.storage.MEDIA_DEDUP_GRACE', 60):
+            name = content_storage.save('covers/a.webp', ContentFile(b'cover'))
+            content_storage.delete(name)
+            self.assertTrue(content_storage.exists(name))
+            self.assertEqual(content_storage.sweep('covers'), 0)
+            self.age(name)
+            self.assertEqual(content_storage.sweep('covers'), 1)
+            self.assertFalse(content_storage.exists(name))
+
+    def test_delete_leaves_a_file_reused_meanwhile(self):
+        with mock.patch('main.storage.MEDIA_DEDUP_GRACE', 60):
+            name = content_storage.save('covers/a.webp', ContentFile(b'cover'))
+            self.age(name)
+            recent = content_storage.recent
+
+            def reused_after_the_check(checked):
+                # Another request stores the same content right after delete() looked at the file.
+                result = recent(checked)
+                content_storage.save('covers/b.webp', ContentFile(b'cover'))
+                return result
+
+            with mock.patch.object(content_storage, 'recent', reused_after_the_check):
+                content_storage.delete(name)
+            self.assertTrue(content_storage.exists(name))
+            self.assertEqual(os.listdir(os.path.dirname(content_storage.path(name))), [os.path.basename(name)])
+
+            self.age(name)
+            content_storage.delete(name)
+            self.assertFalse(content_storage.exists(name))
+
+    def test_cleanup_loop_sweeps(self):
+        passes = []
+
+        def sleep(seconds):
+            if len(passes) == 3:
+                raise KeyboardInterrupt
+            passes.append(seconds)
+
+        with mock.patch.object(content_storage, 'sweep', return_value=0) as sweep, \
+                mock.patch('main.management.commands.cleanup_media.time.sleep', sleep):
+            content_storage.save('covers/a.webp', ContentFile(b'cover'))
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('cleanup_media', loop=True, interval=0, sweep_interval=0, stdout=StringIO())
+            self.assertEqual(sweep.call_count, 4)
+
+            sweep.reset_mock()
+            passes.clear()
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('cleanup_media', loop=True, interval=0, stdout=StringIO())
+            self.assertEqual(sweep.call_count, 1)
+
+            sweep.reset_mock()
+            call_command('cleanup_media', stdout=StringIO())
+            self.assertEqual(sweep.call_count, 0)
+
+    def age(self, name):
+        old = time.time() - 3600
+        os.utime(content_storage.path(name), (old, old))
+
+class SetBasedDeleteTest(TestCase):
+    ''' Shelfs and users take their records along in two statements; the covers wait in the OrphanedFile queue. '''
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        for patcher in (mock.patch('main.storage.MEDIA_DEDUP_GRACE', 0), mock.patch('main.jobs.BACKGROUND_MODE', 'queue')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.shelf = Shelf.objects.create(name='Shelf', owner=self.owner)
+        self.kept = Shelf.objects.create(name='Kept', owner=self.owner)
+        self.own = content_storage.save('covers/own.webp', ContentFile(b'own'))
+        self.shared = content_storage.save('covers/shared.webp', ContentFile(b'shared'))
+        for number, cover in enumerate((self.own, self.shared, '', None)):
+            self.record(self.shelf, 'Book %d' % number, cover)
+        self.record(self.kept, 'Kept', self.shared)
+
+    def record(self, shelf, title, cover):
+        return ShelfRecord.objects.create(title=title, author='Author', read_date=datetime.date(2020, 1, 1),
+                                          shelf=shelf, cover=cover)
+
+    def test_statements_do_not_grow_with_records(self):
+        for number in range(4, 40):
+            self.record(self.shelf, 'Book %d' % number, self.own)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(delete_records(ShelfRecord.objects.filter(shelf=self.shelf)), 40)
+        statements = [query['sql'] for query in queries.captured_queries if not query['sql'].startswith('SAVEPOINT')
+                      and not query['sql'].startswith('RELEASE')]
+        self.assertEqual(len(statements), 2)
+        self.assertFalse(ShelfRecord.objects.filter(shelf=self.shelf).exists())
+        self.assertEqual(list(ShelfRecord.objects.values_list('title', flat=True)), ['Kept'])
+
+    def test_covers_are_queued_not_removed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(delete_records(ShelfRecord.objects.filter(shelf=self.shelf).order_by('title')), 4)
+        self.assertEqual(sorted(OrphanedFile.objects.values_list('name', flat=True)), sorted([self.own, self.shared]))
+        self.assertTrue(content_storage.exists(self.own))
+
+        self.assertEqual(cleanup_media(), 2)
+        self.assertFalse(OrphanedFile.objects.exists())
+        self.assertFalse(content_storage.exists(self.own))
+        # Still on the kept shelf.
+        self.assertTrue(content_storage.exists(self.shared))
+
+    def test_cleanup_media_command(self):
+        self.shelf.delete()
+        self.assertEqual(OrphanedFile.objects.count(), 2)
+        out = StringIO()
+        with mock.patch('main.jobs.MEDIA_CLEANUP_BATCH_SIZE', 1):
+            call_command('cleanup_media', limit=1, stdout=out)
+            self.assertEqual(out.getvalue(), 'Removed 1 file(s)\n')
+            self.assertEqual(OrphanedFile.objects.count(), 1)
+            call_command('cleanup_media', stdout=out)
+        self.assertFalse(OrphanedFile.objects.exists())
+        self.assertFalse(content_storage.exists(self.own))
+
+        self.owner.delete()
+        self.assertFalse(ShelfRecord.objects.exists())
+        call_command('cleanup_media', stdout=StringIO())
+        self.assertFalse(content_storage.exists(self.shared))
+
+    def test_rolled_back_delete_queues_nothing(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            delete_records(ShelfRecord.objects.filter(shelf=self.shelf))
+            raise RuntimeError
+        self.assertEqual(ShelfRecord.objects.count(), 5)
+        self.assertFalse(OrphanedFile.objects.exists())
+
+    def test_failed_removal_is_not_retried_forever(self):
+        OrphanedFile.objects.create(name='covers/missing.webp', created=timezone.now())
+        with mock.patch.object(content_storage, 'delete', side_effect=OSError), self.assertLogs('main.jobs', 'ERROR'):
+            self.assertEqual(cleanup_media(), 1)
+        self.assertFalse(OrphanedFile.objects.exists())
+
+class ShelfFileParserTest(TestCase):
+    ''' Lines of a shelf file: title, author, unused, stars, "Month day, year", fields counted from the end. '''
+
+    def parse(self, text):
+        return list(handle_shelf_file(BytesIO(text.encode('utf-8'))))
+
+    def test_quoted_and_unquoted_commas(self):
+        self.assertEqual(parsed_line('"Title, with comma",Author,x,***,"January 5, 2020"'),
+                         {'title': 'Title, with comma', 'author': 'Author', 'rating': 3,
+                          'read_date': datetime.date(2020, 1, 5)})
+        self.assertEqual(parsed_line('"Say ""hi""", Автор, 1, , "May 31, 2021"'),
+                         {'title': 'Say "hi"', 'author': 'Автор', 'rating': 0, 'read_date': datetime.date(2021, 5, 31)})
+        self.assertEqual(parsed_line('War,Peace,Tolstoy,x,*****,"March 1, 1999"')['title'], 'War,Peace')
+
+    def test_bad_lines(self):
+        rows = self.parse('Good,Author,x,*,"June 1, 2020"\n'
+                          'Bad month,Author,x,*,"Smarch 1, 2020"\n'
+                          '\n'
+                          'Bad day,Author,x,*,"February 30, 2020"\n'
+                          'No comma,Author,x,*,"June 1 2020"\n'
+                          'Short,Author\n'
+                          ' , , \n'
+                          'Last,Author,x,**,"June 2, 2020"\n')
+        self.assertEqual([(number, error) for number, _, error in rows], [
+            (1, None),
+            (2, 'Parsing error: Month parsing error'),
+            (4, 'Parsing error: day is out of range for month'),
+            (5, 'Parsing error: not enough values to unpack (expected 2, got 1)'),
+            (6, 'Parsing error: expected 5 fields, got 2'),
+            (8, None),
+        ])
+        self.assertEqual(rows[-1][1]['read_date'], datetime.date(2020, 6, 2))
+
+    def test_error_without_a_message(self):
+        with mock.patch('main.utilities.parsed_row', side_effect=KeyError()):
+            self.assertEqual(self.parse('Book,Author,x,*,"June 1, 2020"\n'), [(1, None, 'Parsing error: KeyError')])
+
+    def test_read_dates_are_cached(self):
+        parsed_read_date.cache_clear()
+        lines = ''.join('Book %d,Author,x,*,"%s"\n' % (number, date)
+                        for number, date in enumerate(['April 1, 2020', 'April 2, 2020'] * 50))
+        self.assertTrue(all(error is None for _, _, error in self.parse(lines)))
+        info = parsed_read_date.cache_info()
+        self.assertEqual((info.misses, info.hits), (2, 98))
+        self.assertIs(parsed_read_date('April 1, 2020'), parsed_read_date('April 1, 2020'))
+
+        # Errors are raised again every time, not remembered.
+        for _ in range(2):
+            with self.assertRaisesMessage(ValueError, 'Month parsing error'):
+                parsed_read_date('Smarch 1, 2020')
+        self.assertEqual(parsed_read_date.cache_info().currsize, 2)
+
+class ImportJobRecoveryTest(TestCase):
+    ''' Jobs left by a process that went down are queued again or failed, never left waiting. '''
+
+    def setUp(self):
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+
+    def job(self, status, idle=0):
+        heartbeat = timezone.now() - datetime.timedelta(seconds=idle)
+        return ImportJob.objects.create(kind=ImportJob.KIND_FILE, owner=self.owner, status=status,
+                                        heartbeat=None if status == ImportJob.PENDING else heartbeat)
+
+    @mock.patch('main.jobs.IMPORT_JOB_STALE_AFTER', 60)
+    @mock.patch('main.jobs.BACKGROUND_MODE', 'thread')
+    def test_recover_jobs(self):
+        pending = self.job(ImportJob.PENDING)
+        lost = self.job(ImportJob.RUNNING, idle=120)
+        alive = self.job(ImportJob.RUNNING, idle=10)
+
+        with mock.patch('main.jobs.submit') as submit:
+            self.assertEqual(recover_jobs(), (1, 1))
+        self.assertEqual([call.args[1] for call in submit.call_args_list], [pending.pk])
+
+        lost.refresh_from_db()
+        self.assertEqual((lost.status, lost.error), (ImportJob.FAILED, STALE_ERROR))
+        self.assertIsNotNone(lost.finished)
+        alive.refresh_from_db()
+        self.assertEqual(alive.status, ImportJob.RUNNING)
+
+    @mock.patch('main.jobs.IMPORT_JOB_STALE_AFTER', 60)
+    def test_status_page_fails_a_stale_job(self):
+        lost = self.job(ImportJob.RUNNING, idle=120)
+        self.client.force_login(self.owner)
+        response = self.client.get('/shelf/import/%d/' % lost.pk)
+        self.assertEqual(response.context['job'].status, ImportJob.FAILED)
+        self.assertEqual(checked(self.job(ImportJob.RUNNING, idle=10)).status, ImportJob.RUNNING)
+
+class ImportProgressTest(TransactionTestCase):
+    ''' File imports commit batch by batch, so their progress is visible while they run. '''
+
+    def committed(self, job, shelf):
+        # Another thread has its own connection and sees only committed rows.
+        def read():
+            try:
+                stored = ImportJob.objects.get(pk=job.pk)
+                return stored.rows_parsed, stored.rows_inserted, ShelfRecord.objects.filter(shelf=shelf).count()
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(1) as pool:
+            return pool.submit(read).result()
+
+    def test_counters_are_committed_with_every_batch(self):
+        owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        shelf = Shelf.objects.create(name='Shelf', owner=owner)
+        job = ImportJob.objects.create(kind=ImportJob.KIND_FILE, owner=owner, shelf=shelf)
+        seen = []
+
+        def lines():
+            for number in range(1, 8):
+                if number in (4, 6):
+                    seen.append(self.committed(job, shelf))
+                yield number, {'title': 'Book %d' % number, 'author': 'Author', 'rating': 3,
+                               'read_date': datetime.date(2020, 1, number)}, None
+
+        result = create_records(lines(), shelf, batch_size=2, progress=lambda **counters: progress(job, **counters))
+
+        self.assertEqual(seen, [(2, 2, 2), (4, 4, 4)])
+        self.assertEqual(result['inserted'], 7)
+        self.assertEqual(self.committed(job, shelf), (7, 7, 7))
+        shelf.refresh_from_db()
+        self.assertEqual(shelf.record_count, 7)
+
+class FileImportDuplicatesTest(TestCase):
+    ''' Records already on the shelf, or repeated in the file, are skipped, updated or added again. '''
+
+    def setUp(self):
+        owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.shelf = Shelf.objects.create(name='Shelf', owner=owner)
+        ShelfRecord.objects.create(title='Stored', author='Author', rating=2, read_date=datetime.date(2020, 1, 1),
+                                   shelf=self.shelf)
+
+    def lines(self):
+        rows = [('Stored', 5), ('New', 3), ('New', 4)]
+        return [(number, {'title': title, 'author': 'Author', 'rating': rating,
+                          'read_date': datetime.date(2020, 1, 1)}, None)
+                for number, (title, rating) in enumerate(rows, 1)]
+
+    def ratings(self):
+        self.shelf.refresh_from_db()
+        self.assertEqual(self.shelf.rating_sum, sum(self.shelf.shelfrecord_set.values_list('rating', flat=True)))
+        return sorted(self.shelf.shelfrecord_set.values_list('title', 'rating'))
+
+    def test_skip(self):
+        result = create_records(self.lines(), self.shelf, ShelfRecord.DUPLICATES_SKIP)
+        self.assertEqual((result['inserted'], result['updated'], result['skipped']), (1, 0, 2))
+        self.assertEqual(self.ratings(), [('New', 3), ('Stored', 2)])
+
+    def test_update(self):
+        result = create_records(self.lines(), self.shelf, ShelfRecord.DUPLICATES_UPDATE)
+        self.assertEqual((result['inserted'], result['updated'], result['skipped']), (1, 1, 0))
+        self.assertEqual(self.ratings(), [('New', 4), ('Stored', 5)])
+
+    def test_duplicate(self):
+        result = create_records(self.lines(), self.shelf, ShelfRecord.DUPLICATES_ALLOW)
+        self.assertEqual((result['inserted'], result['updated'], result['skipped']), (3, 0, 0))
+        self.assertEqual(self.ratings(), [('New', 3), ('New', 4), ('Stored', 2), ('Stored', 5)])
+
+    def test_repeats_across_batches(self):
+        result = create_records(self.lines(), self.shelf, ShelfRecord.DUPLICATES_SKIP, batch_size=1)
+        self.assertEqual((result['inserted'], result['skipped']), (1, 2))
+        self.assertEqual(self.shelf.shelfrecord_set.count(), 2)
+
+    def test_lookup_stays_under_the_parameter_limit(self):
+        other = Shelf.objects.create(name='Other', owner=self.shelf.owner)
+        records = [ShelfRecord.objects.create(title='Book %d' % i, author='Author', read_date=datetime.date(2020, 1, 1),
+                                              shelf=self.shelf if i < 5 else other) for i in range(6)]
+        keys = [(record.shelf_id, record.fingerprint) for record in records] + [(self.shelf.pk, 'missing')]
+
+        with mock.patch.object(connection.features, 'max_query_params', 3):
+            with self.assertNumQueries(4):
+                found = ShelfRecord.fingerprinted(keys)
+        self.assertEqual(found, {(record.shelf_id, record.fingerprint): (record.pk,) for record in records})
+
+class ShelfStatsTest(TestCase):
+    ''' The denormalized record count, rating sum and last read date follow every kind of record write. '''
+
+    def setUp(self):
+        owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.first = Shelf.objects.create(name='First', owner=owner)
+        self.second = Shelf.objects.create(name='Second', owner=owner)
+
+    def assertStats(self, shelf, record_count, rating_sum, last_read_date):
+        shelf.refresh_from_db()
+        stats = (shelf.record_count, shelf.rating_sum, shelf.last_read_date)
+        self.assertEqual(stats, (record_count, rating_sum, last_read_date))
+        rebuild_shelf_stats(Shelf.objects.filter(pk=shelf.pk))
+        shelf.refresh_from_db()
+        self.assertEqual((shelf.record_count, shelf.rating_sum, shelf.last_read_date), stats)
+
+    def record(self, day, rating, shelf=None):
+        return ShelfRecord.objects.create(title='Day %d' % day, author='Author', rating=rating,
+                                          read_date=datetime.date(2020, 1, day), shelf=shelf or self.first)
+
+    def test_record_writes(self):
+        self.assertStats(self.first, 0, 0, None)
+        early, late = self.record(1, 2), self.record(9, 4)
+        self.assertStats(self.first, 2, 6, datetime.date(2020, 1, 9))
+
+        late.rating = 5
+        late.save()
+        self.assertStats(self.first, 2, 7, datetime.date(2020, 1, 9))
+
+        late.read_date = datetime.date(2019, 12, 1)
+        late.save()
+        self.assertStats(self.first, 2, 7, datetime.date(2020, 1, 1))
+
+        early.shelf = self.second
+        early.save()
+        self.assertStats(self.first, 1, 5, datetime.date(2019, 12, 1))
+        self.assertStats(self.second, 1, 2, datetime.date(2020, 1, 1))
+
+        ShelfRecord.objects.get(pk=late.pk).delete()
+        self.assertStats(self.first, 0, 0, None)
+
+    def test_file_import(self):
+        self.record(5, 1)
+        lines = [(number, {'title': 'Book %d' % number, 'author': 'Author', 'rating': number % 6,
+                           'read_date': datetime.date(2020, 1, number)}, None) for number in range(1, 8)]
+        create_records(lines, self.first, batch_size=3)
+        self.assertStats(self.first, 8, 1 + sum(number % 6 for number in range(1, 8)), datetime.date(2020, 1, 7))
+
+        create_records([(1, {'title': 'Book 7', 'author': 'Author', 'rating': 0,
+                             'read_date': datetime.date(2020, 1, 7)}, None)], self.first, ShelfRecord.DUPLICATES_UPDATE)
+        self.assertStats(self.first, 8, 1 + sum(number % 6 for number in range(1, 7)), datetime.date(2020, 1, 7))
+
+    def test_queryset_delete(self):
+        records = [self.record(day, day) for day in (1, 2, 3)]
+        ShelfRecord.objects.filter(pk=records[2].pk).delete()
+        self.assertStats(self.first, 2, 3, datetime.date(2020, 1, 2))
+
+        ShelfRecord.objects.filter(shelf=self.first, rating__lt=2).delete()
+        self.assertStats(self.first, 1, 2, datetime.date(2020, 1, 2))
+
+    def test_admin_delete_selected(self):
+        admin = BookUser.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin)
+        records = [self.record(day, day) for day in (1, 2, 3)]
+        self.record(4, 4, self.second)
+
+        response = self.client.post('/admin/main/shelfrecord/', {
+            'action': 'delete_selected', 'post': 'yes', '_selected_action': [records[0].pk, records[2].pk]})
+        self.assertEqual(response.status_code, 302)
+        self.assertStats(self.first, 1, 2, datetime.date(2020, 1, 2))
+        self.assertStats(self.second, 1, 4, datetime.date(2020, 1, 4))
+
+class RollupsTest(TestCase):
+    ''' The incrementally kept reading rollups agree with rebuild_rollups() after every kind of record write. '''
+
+    def setUp(self):
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.other = BookUser.objects.create_user('other', 'other@example.com', 'password')
+        self.first = Shelf.objects.create(name='First', owner=self.owner)
+        self.second = Shelf.objects.create(name='Second', owner=self.owner)
+        self.foreign = Shelf.objects.create(name='Foreign', owner=self.other)
+
+    def rollups(self):
+        months = set(MonthlyRollup.objects.filter(record_count__gt=0)
+                     .values_list('owner', 'year', 'month', 'rating', 'record_count'))
+        authors = set(AuthorRollup.objects.filter(record_count__gt=0)
+                      .values_list('owner', 'author', 'record_count', 'rating_sum'))
+        return months, authors
+
+    def assertRollups(self):
+        incremental = self.rollups()
+        rebuild_rollups(BookUser.objects.all())
+        self.assertEqual(incremental, self.rollups())
+
+    def record(self, month, rating, author='A0', shelf=None):
+        return ShelfRecord.objects.create(title='Book %d' % month, author=author, rating=rating,
+                                          read_date=datetime.date(2020, month, 1), shelf=shelf or self.first)
+
+    def test_record_writes(self):
+        records = [self.record(month, month % 6, 'A%d' % (month % 2)) for month in range(1, 7)]
+        self.record(1, 5, shelf=self.foreign)
+        self.assertRollups()
+
+        records[0].rating = 5
+        records[0].author = 'A2'
+        records[0].save()
+        self.assertRollups()
+
+        records[1].read_date = datetime.date(2019, 2, 1)
+        records[1].save()
+        self.assertRollups()
+
+        records[2].shelf = self.foreign
+        records[2].save()
+        self.assertRollups()
+
+        records[3].delete()
+        self.assertRollups()
+
+        ShelfRecord.objects.filter(pk__in=[records[4].pk, records[5].pk]).delete()
+        self.assertRollups()
+        self.assertEqual(self.rollups()[1], {(self.owner.pk, 'A2', 1, 5), (self.owner.pk, 'A0', 1, 2),
+                                             (self.other.pk, 'A0', 1, 5), (self.other.pk, 'A1', 1, 3)})
+
+    def test_imports(self):
+        from hs.ingest import ingest
+
+        self.record(1, 3)
+        lines = [(number, {'title': 'Book %d' % number, 'author': 'A%d' % (number % 3), 'rating': number % 6,
+                           'read_date': datetime.date(2020, number, 1)}, None) for number in range(1, 8)]
+        create_records(lines, self.first, batch_size=3)
+        self.assertRollups()
+        create_records(lines[:2], self.first, ShelfRecord.DUPLICATES_UPDATE)
+        self.assertRollups()
+
+        records = [{'code': code, 'shelf_code': 's', 'title': 'Book %d' % code, 'author': 'A%d' % code,
+                    'rating': code, 'comment': '', 'random_cover': 1, 'read_date': '2021-0%d-01' % code, 'cover': None}
+                   for code in (1, 2, 3)]
+        shelfs = [{'code': 's', 'id': self.second.pk, 'title': '', 'private': True}]
+        ingest(self.owner, {'shelfs': shelfs, 'records': records})
+        self.assertRollups()
+        records[0]['rating'] = 5
+        ingest(self.owner, {'shelfs': shelfs, 'records': records}, ShelfRecord.DUPLICATES_UPDATE)
+        self.assertRollups()
+
+    def test_shelf_deletes(self):
+        for month in range(1, 4):
+            self.record(month, month)
+            self.record(month, month, shelf=self.second)
+            self.record(month, 0, shelf=self.foreign)
+
+        self.first.delete()
+        self.assertRollups()
+        Shelf.objects.filter(owner=self.owner).delete()
+        self.assertRollups()
+        self.assertEqual(self.rollups()[1], {(self.other.pk, 'A0', 3, 0)})
+
+class ShelfPageCacheTest(TestCase):
+    ''' The cached records fragment of a shelf page is replaced by any tracked write to the shelf. '''
+
+    def test_write_invalidates_the_fragment(self):
+        cache.clear()
+        owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        shelf = Shelf.objects.create(name='Shelf', owner=owner, private=False)
+        record = ShelfRecord.objects.create(title='Before', author='Author', read_date=datetime.date(2020, 1, 1),
+                                            shelf=shelf)
+        self.assertContains(self.client.get('/shelf/%d/' % shelf.pk), 'Before')
+
+        # Not a tracked write: the cached fragment is still served.
+        ShelfRecord.objects.filter(pk=record.pk).update(title='Untracked')
+        self.assertContains(self.client.get('/shelf/%d/' % shelf.pk), 'Before')
+
+        record.title = 'After'
+        record.save()
+        self.assertContains(self.client.get('/shelf/%d/' % shelf.pk), 'After')
+
+        ShelfRecord.objects.create(title='Added', author='Author', read_date=datetime.date(2020, 1, 2), shelf=shelf)
+        self.assertContains(self.client.get('/shelf/%d/' % shelf.pk), 'Added')
+
+        # A queryset delete (the admin's "delete selected") moves the shelf to a new version as well.
+        ShelfRecord.objects.filter(title='Added').delete()
+        self.assertNotContains(self.client.get('/shelf/%d/' % shelf.pk), 'Added')
+
+@override_settings(MEDIA_ACCEL='')
+class MediaAccessTest(TestCase):
+    ''' /media/ serves a file to whoever may see it, session or hs token, and 404 to everyone else. '''
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        tokens.clear()
+        self.addCleanup(tokens.clear)
+
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.other = BookUser.objects.create_user('other', 'other@example.com', 'password')
+        self.staff = BookUser.objects.create_user('staff', 'staff@example.com', 'password', is_staff=True)
+        self.private = content_storage.save('covers/private.webp', ContentFile(b'0123456789'))
+        self.public = content_storage.save('covers/public.webp', ContentFile(b'public'))
+        self.userpic = content_storage.save('userpics/reader.webp', ContentFile(b'userpic'))
+        BookUser.objects.filter(pk=self.owner.pk).update(userpic=self.userpic)
+        for name, private in ((self.private, True), (self.public, False)):
+            shelf = Shelf.objects.create(name='Shelf', owner=self.owner, private=private)
+            ShelfRecord.objects.create(title='Book', author='Author', read_date=datetime.date(2020, 1, 1),
+                                       shelf=shelf, cover=name)
+        self.key = ApiToken.issue(self.owner)[1]
+
+    def get(self, name, user=None, **headers):
+        self.client.logout()
+        if user is not None:
+            self.client.force_login(user)
+        return self.client.get('/media/' + name, **headers)
+
+    def statuses(self, name):
+        return {
+            'anonymous': self.get(name).status_code,
+            'owner': self.get(name, self.owner).status_code,
+            'other': self.get(name, self.other).status_code,
+            'staff': self.get(name, self.staff).status_code,
+            'token': self.get(name, HTTP_AUTHORIZATION='Token ' + self.key).status_code,
+            'bad token': self.get(name, HTTP_AUTHORIZATION='Token unknown').status_code,
+        }
+
+    def test_private_cover(self):
+        self.assertEqual(self.statuses(self.private), {'anonymous': 404, 'owner': 200, 'other': 404, 'staff': 200,
+                                                       'token': 200, 'bad token': 404})
+        response = self.get(self.private, HTTP_AUTHORIZATION='Token ' + self.key)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(sorted(response['Cache-Control'].split(', ')), ['immutable', 'max-age=31536000', 'private'])
+
+    def test_public_cover(self):
+        self.assertEqual(set(self.statuses(self.public).values()), {200})
+        # Shared caches forget a public cover soon, its shelf may be made private.
+        self.assertEqual(sorted(self.get(self.public)['Cache-Control'].split(', ')), ['immutable', 'max-age=3600', 'public'])
+
+    def test_token_is_only_read_for_media(self):
+        response = self.client.get('/profile/export/', HTTP_AUTHORIZATION='Token ' + self.key)
+        self.assertEqual(response.status_code, 302)
+
+    def test_userpic(self):
+        self.assertEqual(self.statuses(self.userpic), {'anonymous': 404, 'owner': 200, 'other': 404, 'staff': 200,
+                                                       'token': 200, 'bad token': 404})
+
+    def test_thumbnail_follows_its_source(self):
+        name = thumbnail_name(self.private, next(iter(ALIASES)))
+        os.makedirs(os.path.dirname(content_storage.path(name)))
+        with open(content_storage.path(name), 'wb') as f:
+            f.write(b'thumbnail')
+        self.assertEqual(self.get(name).status_code, 404)
+        self.assertEqual(self.get(name, HTTP_AUTHORIZATION='Token ' + self.key).status_code, 200)
+
+    def test_missing_file(self):
+        self.assertEqual(self.get('covers/missing.webp', self.staff).status_code, 404)
+
+    def test_ranges(self):
+        etag = self.get(self.public)['ETag']
+
+        response = self.get(self.private, self.owner, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+
+        response = self.get(self.private, self.owner, HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+
+        response = self.get(self.private, self.owner, HTTP_RANGE='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+        # A range of another version of the file is not applied.
+        response = self.get(self.private, self.owner, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+        own_etag = self.get(self.private, self.owner)['ETag']
+        response = self.get(self.private, self.owner, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=own_etag)
+        self.assertEqual(response.status_code, 206)
+
+    def test_not_modified(self):
+        etag = self.get(self.private, self.owner)['ETag']
+        response = self.get(self.private, self.owner, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.get(self.private, self.owner, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+        # Access is checked first: a known ETag tells nothing to whoever may not see the file.
+        self.assertEqual(self.get(self.private, HTTP_IF_NONE_MATCH=etag).status_code, 404)
+
+def png_header(width, height):
+    ''' A PNG that has only its header: the size is known, there are no pixels. '''
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', b'')
+
+def image_file(size=(16, 8), mode='RGB', color='red', format='PNG', **options):
+    content = BytesIO()
+    Image.new(mode, size, color).save(content, format, **options)
+    return ContentFile(content.getvalue(), name='cover.' + format.lower())
+
+class ImageNormalizationTest(TestCase):
+    ''' Uploads are checked from their header, then downscaled, turned upright and re-encoded without metadata. '''
+
+    def normalized(self, file):
+        content = normalized_image(file, 'covers/cover.png')
+        return Image.open(BytesIO(content.read())), content.name
+
+    def assertRejected(self, file, message):
+        with self.assertRaisesMessage(ValidationError, message):
+            normalized_image(file, 'covers/cover.png')
+
+    def test_size_is_checked_from_the_header(self):
+        with mock.patch('main.images.IMAGE_MAX_PIXELS', 1000):
+            self.assertRejected(ContentFile(png_header(40, 30), name='a.png'), '40×30')
+        self.assertRejected(ContentFile(png_header(8000, 8000), name='a.png'), '8000×8000')
+        # Pillow refuses it outright as a decompression bomb.
+        self.assertRejected(ContentFile(png_header(100000, 100000), name='a.png'), 'Загрузите корректное изображение')
+
+    def test_broken_files(self):
+        self.assertRejected(ContentFile(b'not an image', name='a.png'), 'Загрузите корректное изображение')
+        data = image_file((64, 64), color=None).read()
+        self.assertRejected(ContentFile(data[:len(data) // 2], name='a.png'), 'Не удалось обработать изображение')
+
+    def test_upload_size_limit(self):
+        with mock.patch('main.images.IMAGE_MAX_UPLOAD_SIZE', 2**20):
+            self.assertRejected(ContentFile(b'\0' * (2**20 + 1), name='a.png'), 'не должен превышать 1 МБ')
+
+    def test_exif_orientation_is_applied_and_stripped(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90° clockwise to display.
+        exif[0x010e] = 'Private description'
+        image, name = self.normalized(image_file((40, 20), format='JPEG', exif=exif.tobytes()))
+        self.assertEqual(image.size, (20, 40))
+        self.assertEqual(dict(image.getexif()), {})
+        self.assertNotIn('exif', image.info)
+        self.assertEqual((image.format, name), ('WEBP', 'cover.webp'))
+
+    def test_large_images_are_downscaled(self):
+        image, _ = self.normalized(image_file((2400, 1200)))
+        self.assertEqual(image.size, (800, 400))
+        image, _ = self.normalized(image_file((300, 200)))
+        self.assertEqual(image.size, (300, 200))
+
+    def test_jpeg_fallback(self):
+        with mock.patch('main.images.FORMAT', 'JPEG'):
+            image, name = self.normalized(image_file(mode='RGBA', color=(255, 0, 0, 0)))
+        self.assertEqual((image.format, name), ('JPEG', 'cover.jpg'))
+        # Transparency is flattened onto white.
+        self.assertEqual(image.convert('RGB').getpixel((8, 4)), (255, 255, 255))
+        image, _ = self.normalized(image_file(mode='RGBA', color=(255, 0, 0, 0)))
+        self.assertEqual(image.mode, 'RGBA')
+
+    def test_model_save_normalizes_the_upload(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, True)
+        with override_settings(MEDIA_ROOT=media), mock.patch('main.thumbnails.THUMBNAIL_WORKERS', 0):
+            owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+            shelf = Shelf.objects.create(name='Shelf', owner=owner)
+            record = ShelfRecord(title='Book', author='Author', read_date=datetime.date(2020, 1, 1), shelf=shelf)
+            record.cover = image_file((1600, 800), format='JPEG')
+            record.save()
+            self.assertTrue(record.cover.name.endswith('.webp'))
+            with Image.open(content_storage.path(record.cover.name)) as stored:
+                self.assertEqual((stored.format, stored.size), ('WEBP', (800, 400)))
+
+class ThumbnailsTest(TestCase):
+    ''' Thumbnails are rendered after the commit that saves an image, under names pages compute themselves. '''
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        workers = mock.patch('main.thumbnails.THUMBNAIL_WORKERS', 0)
+        workers.start()
+        self.addCleanup(workers.stop)
+        self.name = content_storage.save('covers/a.png', image_file((300, 200)))
+
+    def stored_thumbnails(self):
+        return sorted(os.path.relpath(os.path.join(directory, file), content_storage.path(''))
+                      for directory, _, files in os.walk(content_storage.path('thumbnails')) for file in files)
+
+    def test_thumbnail_source(self):
+        for alias in ALIASES:
+            self.assertEqual(thumbnail_source(thumbnail_name(self.name, alias)), self.name)
+        self.assertIsNone(thumbnail_source(self.name))
+        self.assertIsNone(thumbnail_source('thumbnails/' + self.name))
+        self.assertIsNone(thumbnail_source('thumbnails/covers/a.png.999x999_q85.png'))
+
+    def test_saved_image_is_rendered_after_commit(self):
+        owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        shelf = Shelf.objects.create(name='Shelf', owner=owner)
+        with self.captureOnCommitCallbacks() as callbacks:
+            record = ShelfRecord.objects.create(title='Book', author='Author', read_date=datetime.date(2020, 1, 1),
+                                                shelf=shelf, cover=self.name)
+        self.assertEqual(self.stored_thumbnails(), [])
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.stored_thumbnails(), sorted(thumbnail_name(self.name, alias) for alias in ALIASES))
+        for alias, options in ALIASES.items():
+            with Image.open(content_storage.path(thumbnail_name(self.name, alias))) as image:
+                self.assertEqual(image.width, options['size'][0])
+
+        # Saving the record again without a new cover renders nothing.
+        with self.captureOnCommitCallbacks() as callbacks:
+            record.save()
+        self.assertEqual(callbacks, [])
+
+    def test_filter(self):
+        template = Template("{% load main_extras %}{{ cover|thumb:'cover' }}|{{ missing|thumb:'cover' }}")
+        record = ShelfRecord(cover=self.name)
+        self.assertEqual(template.render(Context({'cover': record.cover, 'missing': ShelfRecord().cover})),
+                         '/media/%s|' % thumbnail_name(self.name, 'cover'))
+        self.assertEqual(self.stored_thumbnails(), [])
+
+    def test_concurrent_renders_keep_one_file_per_alias(self):
+        expected = sorted(thumbnail_name(self.name, alias) for alias in ALIASES)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = [pool.submit(generate_thumbnails, self.name, force=True) for _ in range(64)]
+            futures += [pool.submit(ensure_thumbnail, self.name, alias) for alias in ALIASES]
+            for future in futures:
+                future.result()
+        self.assertEqual(self.stored_thumbnails(), expected)
+        self.assertEqual(ensure_thumbnail(self.name, 'cover'), thumbnail_name(self.name, 'cover'))
+        self.assertEqual(generate_thumbnails(self.name), 0)
+
+class ExportTest(TestCase):
+    ''' CSV and NDJSON exports of a shelf or the whole library, to the owner and to readers of public shelfs only. '''
+
+    def setUp(self):
+        tokens.clear()
+        self.addCleanup(tokens.clear)
+        self.owner = BookUser.objects.create_user('reader', 'reader@example.com', 'password')
+        self.other = BookUser.objects.create_user('other', 'other@example.com', 'password')
+        self.shelf = Shelf.objects.create(name='Read, "finally"', owner=self.owner, private=True)
+        self.public = Shelf.objects.create(name='Public', owner=self.owner, private=False)
+        self.foreign = Shelf.objects.create(name='Foreign', owner=self.other, private=True)
+        self.records = [
+            self.record(self.shelf, 'Title, with "quotes"', 5, datetime.date(2021, 3, 9), comment='Так себе\nвторая строка'),
+            self.record(self.shelf, 'Unrated', 0, datetime.date(2020, 12, 31)),
+            self.record(self.public, 'Public book', 3, datetime.date(2019, 1, 1)),
+        ]
+        self.record(self.foreign, 'Foreign book', 4, datetime.date(2022, 2, 2))
+        self.key = ApiToken.issue(self.owner)[1]
+
+    def record(self, shelf, title, rating, read_date, comment=''):
+        return ShelfRecord.objects.create(title=title, author='Автор', rating=rating, read_date=read_date,
+                                          comment=comment, shelf=shelf)
+
+    def content(self, response):
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_csv_reads_back(self):
+        self.client.force_login(self.owner)
+        response = self.client.get('/shelf/export/%d/' % self.shelf.pk)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="shelf_%d.csv"' % self.shelf.pk)
+        lines = self.content(response).splitlines(keepends=True)
+        parsed = [(data, error) for _, data, error in handle_shelf_file(line.encode('utf-8') for line in lines)]
+        self.assertEqual(parsed, [
+            ({'title': 'Title, with "quotes"', 'author': 'Автор', 'rating': 5, 'read_date': datetime.date(2021, 3, 9)}, None),
+            ({'title': 'Unrated', 'author': 'Автор', 'rating': 0, 'read_date': datetime.date(2020, 12, 31)}, None),
+        ])
+        self.assertIn('"Read, ""finally"""', lines[0])
+
+    def test_ndjson_library(self):
+        self.client.force_login(self.owner)
+        response = self.client.get('/profile/export/', {'type': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="library.ndjson"')
+        with self.assertNumQueries(1):
+            content = self.content(response)
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [record.pk for record in self.records])
+        self.assertEqual(rows[0], {
+            'id': self.records[0].pk, 'shelf': self.shelf.pk, 'shelf_name': 'Read, "finally"',
+            'title': 'Title, with "quotes"', 'author': 'Автор', 'comment': 'Так себе\nвторая строка',
+            'rating': 5, 'read_date': '2021-03-09', 'random_cover': self.records[0].random_cover, 'cover': None,
+        })
+        self.assertEqual(len(content.splitlines()), len(rows))
+
+    def test_other_users_shelfs(self):
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get('/shelf/export/%d/' % self.shelf.pk).status_code, 403)
+        content = self.content(self.client.get('/shelf/export/%d/' % self.public.pk, {'type': 'ndjson'}))
+        self.assertEqual([json.loads(line)['title'] for line in content.splitlines()], ['Public book'])
+        content = self.content(self.client.get('/profile/export/', {'type': 'ndjson'}))
+        self.assertEqual([json.loads(line)['title'] for line in content.splitlines()], ['Foreign book'])
+
+        self.client.logout()
+        self.assertEqual(self.client.get('/shelf/export/%d/' % self.shelf.pk).status_code, 403)
+        self.assertEqual(self.client.get('/shelf/export/%d/' % self.public.pk).status_code, 200)
+        self.assertEqual(self.client.get('/profile/export/').status_code, 302)
+
+    def test_hs_exports(self):
+        auth = {'HTTP_AUTHORIZATION': 'Token ' + self.key}
+        content = self.content(self.client.get('/hs/export/', **auth))
+        self.assertEqual([json.loads(line)['id'] for line in content.splitlines()], [record.pk for record in self.records])
+        content = self.content(self.client.get('/hs/shelf/%d/export/' % self.shelf.pk, {'type': 'csv'}, **auth))
+        self.assertEqual(len(content.splitlines()), 2)
+
+        self.assertEqual(self.client.get('/hs/shelf/%d/export/' % self.foreign.pk, **auth).status_code, 403)
+        self.assertEqual(self.client.get('/hs/shelf/%d/export/' % self.shelf.pk).status_code, 403)
+        self.assertEqual(self.client.get('/hs/shelf/%d/export/' % self.public.pk).status_code, 200)
+        self.assertEqual(self.client.get('/hs/export/').status_code, 401)
+
+    def test_unknown_type(self):
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get('/profile/export/', {'type': 'xml'}).status_code, 404)
+        self.assertEqual(self.client.get('/shelf/export/%d/' % self.shelf.pk, {'type': 'xml'}).status_code, 404)
+        response = self.client.get('/hs/export/', {'type': 'xml'}, HTTP_AUTHORIZATION='Token ' + self.key)
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,132 @@
+''' Thumbnails of covers and userpics, made once when an image is saved.
+
+Every alias of THUMBNAIL_ALIASES is rendered in a pool of worker
+processes right after the commit; pages only build the URL from the
+thumbnail name (see the thumb template filter), which easy_thumbnails
+derives from the source name and the alias options alone.
+'''
+
+import logging, multiprocessing, os, tempfile
+from contextlib import suppress
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from bookshelf.settings import THUMBNAIL_ALIASES, THUMBNAIL_BASEDIR, THUMBNAIL_WORKERS
+
+logger = logging.getLogger(__name__)
+
+ALIASES = THUMBNAIL_ALIASES['']
+
+# Temporary files of replace_file(), next to the files they become.
+TEMP_PREFIX = '.upload-'
+
+pool = None
+
+def thumbnail_name(name, alias):
+    # easy_thumbnails defines models, so it is imported once the app registry is ready.
+    from easy_thumbnails.files import Thumbnailer
+    return Thumbnailer(name=name).get_thumbnail_name(ALIASES[alias])
+
+def thumbnail_source(name):
+    ''' Name of the image <name> is a thumbnail of, None if it is not one of ours. '''
+    prefix = THUMBNAIL_BASEDIR + '/'
+    if not name.startswith(prefix):
+        return None
+    # <basedir>/<source>.<options><extension>
+    source = os.path.splitext(name[len(prefix):])[0].rpartition('.')[0]
+    if source and any(thumbnail_name(source, alias) == name for alias in ALIASES):
+        return source
+    return None
+
+def thumbnail_url(name, alias):
+    return default_storage.url(thumbnail_name(name, alias))
+
+def generate_thumbnails(name, aliases=None, force=False):
+    ''' Renders the thumbnails of a stored image, skipping existing ones unless <force>. Returns how many were made. '''
+
+    from easy_thumbnails.files import get_thumbnailer
+
+    count = 0
+    with default_storage.open(name) as source:
+        thumbnailer = get_thumbnailer(source, relative_name=name)
+        for alias in aliases or ALIASES:
+            target = thumbnail_name(name, alias)
+            if not force and default_storage.exists(target):
+                continue
+            thumbnail = thumbnailer.generate_thumbnail(ALIASES[alias])
+            # Written under the exact name, pages compute it without asking storage. Replaced
+            # in one step: ensure_thumbnail and the pool may render the same thumbnail at once.
+            path = default_storage.path(target)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            replace_file(path, thumbnail.chunks(), default_storage.file_permissions_mode or 0o644)
+            count += 1
+    return count
+
+def replace_file(path, chunks, mode=0o644):
+    ''' Writes <chunks> to a temporary file next to <path> and renames it over <path>.
+
+    The rename is atomic: readers see the old file or the whole new one, never
+    a missing or half-written file, and concurrent writers do not collide.
+    '''
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TEMP_PREFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+
+def ensure_thumbnail(name, alias):
+    ''' Name of a thumbnail that is known to exist, rendering it here if the pool has not got to it yet. '''
+    target = thumbnail_name(name, alias)
+    if not default_storage.exists(target):
+        generate_thumbnails(name, [alias])
+    return target
+
+def delete_thumbnails(name):
+    for alias in ALIASES:
+        default_storage.delete(thumbnail_name(name, alias))
+
+def schedule_thumbnails(names):
+    ''' Queues thumbnails of freshly saved images for after the commit. '''
+    names = [name for name in names if name]
+    if names:
+        transaction.on_commit(lambda: submit_thumbnails(names))
+
+def submit_thumbnails(names):
+    # With no workers configured thumbnails are made in the calling thread.
+    if not THUMBNAIL_WORKERS:
+        for name in names:
+            generate_logged(name)
+        return
+    for name in names:
+        get_pool().submit(generate_thumbnails, name).add_done_callback(log_failure)
+
+def get_pool(workers=THUMBNAIL_WORKERS):
+    global pool
+    if pool is None:
+        pool = worker_pool(workers)
+    return pool
+
+def worker_pool(workers):
+    # Spawned, not forked: the web process has threads and open database connections.
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=django.setup)
+
+def generate_logged(name):
+    try:
+        generate_thumbnails(name)
+    except Exception:
+        logger.exception('Could not make thumbnails of %s', name)
+
+def log_failure(future):
+    error = future.exception()
+    if error is not None:
+        logger.error('Could not make thumbnails', exc_info=error)
@@ -0,0 +1,118 @@
+from collections import namedtuple
+
+from django.db.models import F, Value, Count, Sum, Subquery, OuterRef, DateField, IntegerField
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+RecordState = namedtuple('RecordState', ['id', 'shelf_id', 'rating', 'read_date', 'author'])
+
+def record_state(record):
+    return RecordState(record.pk, record.shelf_id, record.rating, record.read_date, record.author)
+
+class RecordChanges:
+    ''' Collects record writes and applies them to the denormalized shelf stats,
+    to the reading rollups of main.analytics and to the sync changelog.
+
+    Call it inside the transaction that writes the records, after the writes:
+    every touched shelf gets one UPDATE with relative increments, so
+    concurrent writers do not overwrite each other's counts.
+    '''
+
+    def __init__(self):
+        self.shelfs = {}
+        self.rollups = {}
+        self.log = {}
+
+    def shelf(self, shelf_id):
+        return self.shelfs.setdefault(shelf_id, {'count': 0, 'rating': 0, 'latest': None, 'recheck': False})
+
+    def rollup(self, state, sign):
+        self.rollups[state] = self.rollups.get(state, 0) + sign
+
+    def added(self, state):
+        self.rollup(state, 1)
+        self.log[(state.shelf_id, state.id)] = False
+        changes = self.shelf(state.shelf_id)
+        changes['count'] += 1
+        changes['rating'] += state.rating
+        if state.read_date and (changes['latest'] is None or state.read_date > changes['latest']):
+            changes['latest'] = state.read_date
+
+    def removed(self, state):
+        self.rollup(state, -1)
+        self.log[(state.shelf_id, state.id)] = True
+        changes = self.shelf(state.shelf_id)
+        changes['count'] -= 1
+        changes['rating'] -= state.rating
+        # The removed date may have been the latest one; it is looked up again.
+        changes['recheck'] = True
+
+    def updated(self, old, new):
+        if old.shelf_id != new.shelf_id or old.read_date != new.read_date:
+            self.removed(old)
+            self.added(new)
+        else:
+            self.shelf(new.shelf_id)['rating'] += new.rating - old.rating
+            self.rollup(old, -1)
+            self.rollup(new, 1)
+            self.log[(new.shelf_id, new.id)] = False
+
+    def save(self):
+        from .models import Shelf, Change
+        from .analytics import update_rollups
+
+        shelf_ids = {shelf_id for shelf_id, _ in self.log}
+        owners = dict(Shelf.objects.filter(pk__in=shelf_ids).values_list('pk', 'owner_id')) if shelf_ids else {}
+
+        update_rollups({state: sign for state, sign in self.rollups.items() if sign}, owners)
+        self.rollups = {}
+
+        # Keyed by owner and record: a record moved between shelfs of one owner is a single upsert.
+        entries = {}
+        for (shelf_id, record_id), deleted in self.log.items():
+            if shelf_id in owners:
+                entries[(owners[shelf_id], record_id)] = deleted
+        log_changes(Change.RECORD, [(owner, record_id, deleted) for (owner, record_id), deleted in entries.items()])
+        self.log = {}
+
+        now = timezone.now()
+        for shelf_id, changes in self.shelfs.items():
+            # Any record write moves the shelf to a new version, see main.caching.
+            values = {'version': F('version') + 1, 'updated_at': now}
+            if changes['count']:
+                values['record_count'] = F('record_count') + changes['count']
+            if changes['rating']:
+                values['rating_sum'] = F('rating_sum') + changes['rating']
+            if changes['recheck']:
+                values['last_read_date'] = latest_read_date()
+            elif changes['latest']:
+                latest = Value(changes['latest'], output_field=DateField())
+                values['last_read_date'] = Greatest(Coalesce('last_read_date', latest), latest)
+            Shelf.objects.filter(pk=shelf_id).update(**values)
+        self.shelfs = {}
+
+def latest_read_date():
+    from .models import ShelfRecord
+
+    # A single seek on the (shelf, -read_date, -id) index.
+    return Subquery(ShelfRecord.objects.filter(shelf=OuterRef('pk'))
+                    .order_by('-read_date').values('read_date')[:1])
+
+def rebuild_shelf_stats(shelfs):
+    ''' Recomputes the stats of <shelfs> (a Shelf queryset) from their records in one statement. '''
+    from .models import ShelfRecord
+
+    records = ShelfRecord.objects.filter(shelf=OuterRef('pk')).order_by().values('shelf')
+    return shelfs.update(
+        record_count=Coalesce(Subquery(records.annotate(value=Count('id')).values('value')), 0),
+        rating_sum=Coalesce(Subquery(records.annotate(value=Sum('rating')).values('value'),
+                                     output_field=IntegerField()), 0),
+        last_read_date=latest_read_date(),
+    )
+
+def log_changes(kind, entries):
+    ''' Appends (owner id, object id, deleted) entries to the sync changelog. '''
+    from .models import Change
+
+    Change.objects.bulk_create([Change(owner_id=owner, kind=kind, object_id=object_id, deleted=deleted)
+                                for owner, object_id, deleted in entries], batch_size=500)
@@ -4,7 +4,8 @@ from .views import index, user_logout, UserLoginView, RegisterUser, user_activat
 from .views import ping, profile, ChangeUserInfoView, PasswordChangeView, DeleteUserView
 from .views import UserPasswordResetView, UserPasswordResetDoneView, UserPasswordResetConfirmView
 from .views import shelf_add, shelf_detail, record_add, shelf_change, shelf_delete, record_detail
-from .views import record_change, record_delete, shelf_upload
+from .views import record_change, record_delete, shelf_upload, import_detail, shelf_export, library_export
+from .views import search, stats
 
 app_name = 'main'
 
@@ -14,6 +15,8 @@ urlpatterns = [
     path('shelf/add/', shelf_add, name='shelf_add'),
     path('shelf/<int:pk>/', shelf_detail, name='shelf_detail'),
     path('shelf/upload/<int:pk>/', shelf_upload, name='shelf_upload'),
+    path('shelf/import/<int:pk>/', import_detail, name='import_detail'),
+    path('shelf/export/<int:pk>/', shelf_export, name='shelf_export'),
     path('shelf/change/<int:pk>/', shelf_change, name='shelf_change'),
     path('shelf/delete/<int:pk>/', shelf_delete, name='shelf_delete'),
     path('shelf/record/change/<int:pk>/', record_change, name='record_change'),
@@ -25,7 +28,10 @@ urlpatterns = [
     path('profile/password/change/', PasswordChangeView.as_view(), name='password_change'),
     path('profile/change/', ChangeUserInfoView.as_view(), name='profile_change'),
     path('profile/delete/', DeleteUserView.as_view(), name='delete_user'),
+    path('profile/export/', library_export, name='library_export'),
+    path('profile/stats/', stats, name='stats'),
     path('profile/', profile, name='profile'),
+    path('search/', search, name='search'),
     path('login/', UserLoginView.as_view(), name='login'),
     path('register/activate/<str:sign>/', user_activate, name='register_activate'),
     path('register/done/', register_done, name='register_done'),
@@ -2,7 +2,9 @@ from django.template.loader import render_to_string
 from django.core.signing import Signer
 from django.utils.encoding import smart_str
 from datetime import datetime, date
+from functools import lru_cache
 from os.path import splitext
+import csv, hashlib
 
 from bookshelf.settings import ALLOWED_HOSTS
 
@@ -38,96 +40,85 @@ def get_upload_path(instance, filename):
     # Migration problem.
     return get_userpics_upload_path(instance, filename)
 
+# Covers and userpics are named by main.storage after their content, only the directory and extension are kept.
+
 def get_userpics_upload_path(instance, filename):
-    return 'userpics/%s%s' % (datetime.now().timestamp(), splitext(filename)[1])
+    return 'userpics/%s' % filename
 
 def get_covers_upload_path(instance, filename):
-    return 'covers/%s%s' % (datetime.now().timestamp(), splitext(filename)[1])
+    return 'covers/%s' % filename
+
+def get_imports_upload_path(instance, filename):
+    return 'imports/%s%s' % (datetime.now().timestamp(), splitext(filename)[1])
+
+def record_fingerprint(title, author, read_date):
+    ''' Identity of a record within a shelf: case and whitespace insensitive title and author plus the date. '''
+    if isinstance(read_date, date):
+        read_date = read_date.isoformat()
+    normalized = '\x1f'.join((' '.join(title.split()).casefold(), ' '.join(author.split()).casefold(), str(read_date)))
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+MONTHS = {
+    'January': 1, 'February': 2, 'March': 3, 'April': 4, 'May': 5, 'June': 6,
+    'July': 7, 'August': 8, 'September': 9, 'October': 10, 'November': 11, 'December': 12,
+}
+
+MONTH_NAMES = {number: name for name, number in MONTHS.items()}
+
+def formatted_read_date(read_date):
+    ''' The inverse of parsed_read_date. '''
+    return '%s %d, %d' % (MONTH_NAMES[read_date.month], read_date.day, read_date.year)
 
 def handle_shelf_file(f):
+    ''' Yields (line number, parsed data, error) for each non-empty row of the file. '''
 
-    data = []
+    lines = (smart_str(line, encoding='utf-8') for line in f)
+    reader = csv.reader(lines, skipinitialspace=True)
 
-    for line in f:
-        encoded_line = smart_str(line, encoding='utf-8')
+    while True:
         try:
-            parsed_data = parsed_line(encoded_line)
-        except:
-            raise Exception('Parsing error')
-        
-        data.append(parsed_data)
-
-    return data        
+            row = next(reader)
+        except StopIteration:
+            break
+        except csv.Error as e:
+            yield reader.line_num, None, 'Parsing error: %s' % e
+            continue
+
+        if not row or not ''.join(row).strip():
+            continue
+        try:
+            parsed_data = parsed_row(row)
+        except Exception as e:
+            yield reader.line_num, None, 'Parsing error: %s' % (str(e) or e.__class__.__name__)
+        else:
+            yield reader.line_num, parsed_data, None
 
 def parsed_line(line):
-    
-    result = {}
-
-    #Date
-    ind = line.rfind('"')
-    rem = line[:ind]
-    ind = rem.rfind('"')
-    raw_date = rem[ind+1:].strip()
-    result['read_date'] = parsed_read_date(raw_date)
-
-    #Rating
-    rem = rem[:ind-1]
-    ind = rem.rfind(',')
-    raw_rating = rem[ind+1:].strip()
-    result['rating'] = len(raw_rating)
-
-    #Author
-    rem = rem[:ind]
-    ind = rem.rfind(',')
-    rem = rem[:ind]
-    ind = rem.rfind(',')
-    result['author'] = rem[ind+1:].strip()
-
-    #Title
-    raw_title = rem[:ind].strip()
-    if raw_title[len(raw_title)-1] == '"':
-        raw_title = raw_title[:len(raw_title)-1]
-    if raw_title[0] == '"':
-        raw_title = raw_title[1:]
-    result['title'] = raw_title.strip()
+    return parsed_row(next(csv.reader([line], skipinitialspace=True)))
+
+def parsed_row(row):
+    ''' Title, author, <unused>, rating as stars, read date; fields are taken from the end,
+    so unquoted commas are still allowed in the title. '''
+
+    if len(row) < 5:
+        raise ValueError('expected 5 fields, got %d' % len(row))
 
+    result = {
+        'title': ','.join(row[:-4]).strip(),
+        'author': row[-4].strip(),
+        'rating': len(row[-2].strip()),
+        'read_date': parsed_read_date(row[-1].strip()),
+    }
     return result
 
+@lru_cache(maxsize=4096)
 def parsed_read_date(raw_date):
-    ind = raw_date.find(',')
-    day_and_month = raw_date[:ind]
-    year = raw_date[ind+2:ind+6]
-    ind = day_and_month.find(' ')
-    month = day_and_month[:ind].strip()
-    day = day_and_month[ind+1:].strip()
-
-    year_numeric = int(year)
-    if month == 'January':
-        month_numeric = 1
-    elif month == 'February':
-        month_numeric = 2
-    elif month == 'March':
-        month_numeric = 3
-    elif month == 'April':
-        month_numeric = 4
-    elif month == 'May':
-        month_numeric = 5
-    elif month == 'June':
-        month_numeric = 6
-    elif month == 'July':
-        month_numeric = 7
-    elif month == 'August':
-        month_numeric = 8
-    elif month == 'September':
-        month_numeric = 9
-    elif month == 'October':
-        month_numeric = 10
-    elif month == 'November':
-        month_numeric = 11
-    elif month == 'December':
-        month_numeric = 12
-    else:
-        raise Exception('Month parsing error')
-
-    day_numeric = int(day)
-    return date(year_numeric, month_numeric, day_numeric)
\ No newline at end of file
+    ''' "January 5, 2020" -> date(2020, 1, 5). A log repeats the same few hundred dates. '''
+
+    month_and_day, year = raw_date.split(',')
+    month, day = month_and_day.split()
+    try:
+        month_numeric = MONTHS[month]
+    except KeyError:
+        raise ValueError('Month parsing error')
+    return date(int(year), month_numeric, int(day))
@@ -13,15 +13,24 @@ from django.views.generic.edit import DeleteView
 from django.views.generic.base import ContextMixin
 from django.core.signing import BadSignature
 from django.core.exceptions import PermissionDenied
-from django.core.paginator import Paginator
+from django.http import Http404
 from django.urls import reverse_lazy
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from random import randint
 
 from .forms import UserLoginForm, UserRegistrationForm, ChangeUserInfoForm, ShelfForm, RecorddAddForm
-from .forms import UploadFileForm
-from .utilities import signer, handle_shelf_file
-from .models import BookUser, Shelf, ShelfRecord
-from bookshelf.settings import DEBUG
+from .forms import UploadFileForm, RecordListForm, SearchForm
+from .utilities import signer
+from .pagination import KeysetPaginator, InvalidCursor
+from .models import BookUser, Shelf, ShelfRecord, ImportJob
+from .jobs import create_job, checked
+from .exports import EXPORT_TYPES, export_response, shelf_records, library_records
+from .search import search_records
+from .analytics import reading_stats
+from .caching import shelf_cache_key, cached
+from .media import media_visibility, media_response
+from bookshelf.settings import DEBUG, SEARCH_PAGE_SIZE
 
 if DEBUG:
     logger = logging.getLogger(__name__)
@@ -113,6 +122,14 @@ def profile(request):
 
     return render(request, 'main/profile.html', context)
 
+@login_required
+def stats(request):
+    context = {
+        'stats': reading_stats(request.user),
+        'months': ['Янв', 'Фев', 'Мар', 'Апр', 'Май', 'Июн', 'Июл', 'Авг', 'Сен', 'Окт', 'Ноя', 'Дек'],
+    }
+    return render(request, 'main/stats.html', context)
+
 class ChangeUserInfoView(SuccessMessageMixin, LoginRequiredMixin, UpdateView, ContextMixin):
 
     model = BookUser
@@ -203,7 +220,7 @@ def shelf_detail(request, pk):
 
     shelf = get_object_or_404(Shelf, pk=pk)
     user = request.user
-    is_owner = (shelf.owner == user)
+    is_owner = (shelf.owner_id == user.pk)
     access_denied = (shelf.private and not is_owner)
     
     if access_denied:
@@ -213,23 +230,40 @@ def shelf_detail(request, pk):
         }
         return render(request, 'layout/simple.html', context)
     else:
-        records = ShelfRecord.objects.filter(shelf=shelf.pk)
-        paginator = Paginator(records, 15)
-        if 'page' in request.GET:
-            page_num = request.GET['page']
-        else:
-            page_num = 1
-
-        page = paginator.get_page(page_num)
-        valid_numbers = get_valid_numbers_of_page(paginator.num_pages, 2, int(page_num))
+        form = RecordListForm(request.GET)
+        key = shelf_cache_key('shelf_detail', shelf, is_owner, request.GET.lists())
+
+        def records_page():
+            records, keys = form.apply(ShelfRecord.objects.filter(shelf=shelf.pk))
+            # The whole shelf is counted by the shelf row itself.
+            count = 'estimate' if form.is_filtered() else 'none'
+            paginator = KeysetPaginator(records, 15, keys)
+            try:
+                page = paginator.get_page(request.GET.get('cursor'), count=count)
+            except InvalidCursor:
+                page = paginator.get_page(count=count)
+            if count == 'none':
+                page.count = shelf.record_count
+
+            query = request.GET.copy()
+            query.pop('cursor', None)
+
+            context = {
+                'shelfrecords': page.object_list,
+                'is_owner': is_owner,
+                'page': page,
+                'last_cursor': KeysetPaginator.LAST,
+                'query': query.urlencode(),
+            }
+            return render_to_string('main/shelf_records.html', context, request)
+
         context = {
             'name': shelf.name,
-            'shelfrecords': page.object_list,
+            'shelf': shelf,
             'is_owner': is_owner,
             'pk': pk,
-            'page': page,
-            'valid_numbers': valid_numbers,
-            'num_pages': paginator.num_pages
+            'form': form,
+            'records': mark_safe(cached(key, records_page)),
         }
         return render(request, 'main/shelf_detail.html', context)
     
@@ -364,15 +398,15 @@ def record_delete(request, pk):
 
 def page_not_found_view(request, exception):
     context = {'status': '404', 'status_message': 'Страница не найдена'}
-    return render(request, 'main/bad_code.html', context)
+    return render(request, 'main/bad_code.html', context, status=404)
 
 def forbidden_view(request, exception):
     context = {'status': '403', 'status_message': 'Доступ запрещен'}
-    return render(request, 'main/bad_code.html', context)
+    return render(request, 'main/bad_code.html', context, status=403)
 
 def server_error_view(request):
     context = {'status': '500', 'status_message': 'Внутренняя ошибка'}
-    return render(request, 'main/bad_code.html', context)
+    return render(request, 'main/bad_code.html', context, status=500)
 
 @login_required
 def shelf_upload(request, pk):
@@ -383,47 +417,70 @@ def shelf_upload(request, pk):
     if request.method == 'POST':
         form = UploadFileForm(request.POST, request.FILES)
         if form.is_valid():
-            data = handle_shelf_file(request.FILES['file'])
-            create_records(data, shelf)
-            return redirect('main:shelf_detail', pk=pk)
+            options = {'on_duplicate': form.cleaned_data['on_duplicate']}
+            job = create_job(ImportJob.KIND_FILE, request.user, request.FILES['file'], shelf, options)
+            return redirect('main:import_detail', pk=job.pk)
     else:
         form = UploadFileForm()
 
     return render(request, 'main/shelf_upload.html', {'form': form})
 
-def create_records(data, shelf):
+@login_required
+def import_detail(request, pk):
+    job = get_object_or_404(ImportJob, pk=pk)
+    if job.owner != request.user:
+        raise PermissionDenied()
 
-    for element in data:
+    context = {'job': checked(job)}
+    return render(request, 'main/import_detail.html', context)
 
-        record = ShelfRecord()
-        record.title = element['title']
-        record.author = element['author']
-        record.rating = element['rating']
-        record.read_date = element['read_date']
-        record.shelf = shelf
-        record.random_cover = randint(1, 6)
-        record.save()
+def shelf_export(request, pk):
+    shelf = get_object_or_404(Shelf, pk=pk)
+    if shelf.private and shelf.owner != request.user:
+        raise PermissionDenied()
 
-    return 0
-    
-def get_valid_numbers_of_page(num_pages, half_portion, number):
-    result = []
-    if num_pages <= 0 or number > num_pages or half_portion <= 0:
-        return result
-    else:
-        max_elements = min(num_pages, 2 * half_portion + 1)
-        result.append(number)
-        stop_it = False
-        for i in range(1, 2 * half_portion + 1):
-            for j in [-1, 1]:
-                current = number + j * i
-                if current > 0 and current <= num_pages:
-                    result.append(current)
-                if len(result) >= max_elements:
-                    stop_it = True
-                    break
-            if stop_it:
-                break
-
-    result.sort()
-    return result
+    export_type = request.GET.get('type', 'csv')
+    if export_type not in EXPORT_TYPES:
+        raise Http404()
+
+    return export_response(shelf_records(shelf), export_type, 'shelf_%d' % shelf.pk)
+
+@login_required
+def library_export(request):
+    export_type = request.GET.get('type', 'csv')
+    if export_type not in EXPORT_TYPES:
+        raise Http404()
+
+    return export_response(library_records(request.user), export_type, 'library')
+
+def search(request):
+    form = SearchForm(request.GET)
+    records, has_next, page = [], False, 1
+
+    if form.is_valid() and form.cleaned_data['q']:
+        page = form.cleaned_data['page'] or 1
+        records, has_next = search_records(form.cleaned_data['q'], request.user, 
+                                           limit=SEARCH_PAGE_SIZE, offset=(page - 1) * SEARCH_PAGE_SIZE)
+
+    query = request.GET.copy()
+    query.pop('page', None)
+
+    context = {
+        'form': form,
+        'records': records,
+        'page': page,
+        'has_next': has_next,
+        'query': query.urlencode(),
+        'searched': bool(form.is_valid() and form.cleaned_data['q']),
+    }
+    return render(request, 'main/search.html', context)
+
+def media(request, name):
+    # Files nobody may see are reported as missing, not as forbidden.
+    visibility = media_visibility(request.user, name)
+    if visibility is None:
+        raise Http404()
+    try:
+        return media_response(request, name, visibility)
+    except FileNotFoundError:
+        raise Http404()